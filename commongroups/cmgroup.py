@@ -2,16 +2,22 @@
 
 """Compound group class."""
 
+from datetime import datetime
+from io import BytesIO
 from os.path import join as pjoin
 import logging
 import json
 
+from boltons.fileutils import mkdir_p
 import pandas as pd
 from pandas import DataFrame, ExcelWriter
 
-from commongroups.query import QueryMethod
+from commongroups.query import QueryMethod, ORD_KEY, set_dependencies
+from commongroups.diff import ALIAS_SEP
+from commongroups.snapshot import QUERY_COLUMNS
 from commongroups.hypertext import cmg_to_html
 from commongroups.errors import MissingParamError
+from commongroups.outputs import output_file, save_output
 from commongroups import logconf  # pylint: disable=unused-import
 logger = logging.getLogger(__name__)  # pylint: disable=invalid-name
 
@@ -24,6 +30,46 @@ BASE_PARAMS = [
     'code'
 ]
 
+# Parameters that may be given in addition to the BASE_PARAMS.
+OPTIONAL_PARAMS = [
+    'parent',
+    'include',
+    'exclude',
+    'threshold'
+]
+
+# Identifiers of compounds listed in member files, besides the ORD_KEY.
+MEMBER_ALIASES = ['casrn', 'cid']
+
+# Fixed creation time of Excel workbooks, so that unchanged data give
+# identical files (see :mod:`commongroups.outputs`).
+XLSX_CREATED = datetime(2017, 1, 1)
+
+
+def validate_params(params):
+    """
+    Check that a group definition contains all of the :data:`BASE_PARAMS`.
+
+    Parameters:
+        params (dict): Compound group parameters.
+
+    Raises:
+        :class:`commongroups.errors.MissingParamError`: If any of the base
+            parameters is absent.
+    """
+    for key in BASE_PARAMS:
+        if key not in params:
+            raise MissingParamError(key)
+
+
+def alias_text(value):
+    """Format a compound identifier as text; missing values are blank."""
+    if value is None or (isinstance(value, float) and value != value):
+        return ''
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
 
 class CMGroup(object):
     """
@@ -57,6 +103,8 @@ class CMGroup(object):
         self.results_path = env.results_path
         self.query = None
         self._compounds = None
+        self._store = None
+        self._detected_parent = None
         logger.info('Created %s', self)
 
     def __repr__(self):
@@ -75,16 +123,105 @@ class CMGroup(object):
         """Compound group name (convenience method to retrieve from params)."""
         return self.params['name']
 
+    @property
+    def parent(self):
+        """
+        ID of the parent group, if any, to whose members this group belongs.
+
+        This is either given as the ``parent`` parameter or detected by
+        comparing group definitions (see :func:`set_detected_parent`).
+        """
+        return self.params.get('parent') or self._detected_parent
+
+    @property
+    def dependencies(self):
+        """
+        List of IDs of groups that must be processed before this one.
+
+        These are the parent group, if any, and for the ``SET`` method, the
+        groups referenced in the set expression.
+        """
+        deps = [self.parent] if self.parent else []
+        deps.extend(dep for dep in set_dependencies(self.params)
+                    if dep not in deps)
+        return deps
+
+    def set_detected_parent(self, cmg_id):
+        """Set a parent group that was inferred rather than declared."""
+        logger.debug('Detected parent group of %s: %s', self, cmg_id)
+        self._detected_parent = cmg_id
+
     @property
     def compounds(self):
         """
         If populated, return a ``DataFrame`` of compounds in the group.
 
+        If the data have been moved to disk using :func:`spill`, they are
+        reloaded from the on-disk store when this attribute is accessed.
+
         Warning: ``DataFrame`` objects are easily modified by accident. Making
         this a read-only attribute does not prevent accidental modification.
         """
+        if self._compounds is None and self._store:
+            logger.debug('Reloading compounds for %s from %s',
+                         self, self._store)
+            if self._store.endswith('.xlsx'):
+                return pd.read_excel(self._store, sheet_name='compounds',
+                                     engine='openpyxl').drop('cmg_id', axis=1)
+            return pd.read_pickle(self._store)
         return self._compounds
 
+    @property
+    def spilled(self):
+        """Whether compound data are held on disk rather than in memory."""
+        return self._compounds is None and self._store is not None
+
+    def memory_usage(self):
+        """Return the number of bytes used by compound data held in memory."""
+        if self._compounds is None:
+            return 0
+        return int(self._compounds.memory_usage(deep=True).sum())
+
+    def spill(self, path=None):
+        """
+        Move compound data to an on-disk store and release them from memory.
+
+        The data remain accessible through the ``compounds`` attribute, which
+        reloads them from disk on demand.
+
+        Parameters:
+            path (str): Optional path of the store file. Defaults to a file
+                named after the ``cmg_id`` in the project ``data`` directory.
+
+        Returns:
+            Number of bytes released from memory.
+        """
+        if self._compounds is None:
+            return 0
+        freed = self.memory_usage()
+        if not path:
+            path = pjoin(self.data_path, '{}.pkl'.format(self.cmg_id))
+        logger.debug('Spilling compounds for %s to %s', self, path)
+        self._compounds.to_pickle(path)
+        self._store = path
+        self._compounds = None
+        return freed
+
+    def restore(self, info):
+        """
+        Restore a group that was processed and output in an earlier run.
+
+        The group's info is updated from the earlier run, and its compounds are
+        reloaded on demand from its Excel output.
+
+        Parameters:
+            info (dict): Info of the group as processed in the earlier run.
+        """
+        logger.debug('Restoring %s from earlier output', self)
+        self.add_info(info)
+        self._compounds = None
+        self._store = pjoin(self.results_path, '{}.xlsx'.format(self.cmg_id))
+
     def add_info(self, info):
         """
         Add information to the group as key-value pairs.
@@ -94,31 +231,110 @@ class CMGroup(object):
         """
         self.info.update(info)
 
-    def create_query(self):
+    def create_query(self, within=None, optimize=False, operands=None,
+                     columns=None):
         """
         Create query method based on compound group parameters.
 
         Add a callable :class:`commongroups.query.QueryMethod` attribute.
+
+        Parameters:
+            within (iterable): Optional compound IDs to restrict the query to.
+            optimize: Whether (or ``'check'``) to rewrite the query using fast
+                predicates; see :class:`commongroups.query.QueryMethod`.
+            operands (dict): For the ``SET`` method, compounds of the groups
+                referenced in the set expression, keyed by ``cmg_id``.
+            columns (list): Optional columns returned by the query.
         """
-        self.query = QueryMethod(self.params)
+        self.query = QueryMethod(self.params, within=within, optimize=optimize,
+                                 operands=operands, columns=columns)
         self.query.create_expression()
 
-    def process(self, con):
+    def process(self, con, deps=None, optimize=False, snapshot=None):
         """
         Execute the database query and store results in the ``CMGroup`` object.
 
         Populate the ``compounds`` list with query results; add a computed
         summary of results to the ``info`` attribute.
 
+        If the group has a parent and the processed parent group is among
+        ``deps``, only the members of the parent group are evaluated. Groups
+        defined by the ``SET`` method are computed from the groups they
+        reference, which must be among ``deps``.
+
+        If a snapshot of compounds is given, the query only returns the
+        compounds' IDs and structures, and their other identifiers and names
+        are joined to the results from the snapshot.
+
         Parameters:
             con (:class:`sqlalchemy.engine.Engine`): Database connection.
+            deps (dict): Optional processed :class:`CMGroup` objects that this
+                group depends on, keyed by ``cmg_id``.
+            optimize: Whether (or ``'check'``) to rewrite the query using fast
+                predicates; see :class:`commongroups.query.QueryMethod`.
+            snapshot (:class:`commongroups.snapshot.Snapshot`): Optional
+                snapshot of compounds matching the database.
         """
-        self.create_query()
+        within = None
+        info = {}
+        if self.parent:
+            if deps and self.parent in deps:
+                within = deps[self.parent].compounds[ORD_KEY]
+                info['parent'] = self.parent
+            else:
+                logger.warning('Parent group %s of %s is not available;'
+                               ' evaluating all compounds', self.parent, self)
+        operands = {dep: deps[dep].compounds
+                    for dep in set_dependencies(self.params)
+                    if deps and dep in deps}
+        columns = QUERY_COLUMNS if snapshot is not None else None
+        self.create_query(within=within, optimize=optimize, operands=operands,
+                          columns=columns)
         res = self.query(con)
+        if snapshot is not None and self.query.set_expression is None:
+            res = snapshot.join(res)
+        info.update({'about': self.query.describe(),
+                     'sql': self.query.get_literal(),
+                     'count': len(res)})
+        self.add_info(info)
+        self._compounds = res
+        self._store = None
+
+    def count(self, con, mode='count', optimize=False, sample=None):
+        """
+        Count the compounds in the group, without retrieving them.
+
+        The number of compounds selected by the group's query, counted by the
+        database (``COUNT(*)``) or, in ``'estimate'`` mode, estimated (see
+        :meth:`commongroups.query.QueryMethod.estimate`), is stored as
+        ``count`` in the ``info`` attribute, along with the ``count_mode``.
+        Since no compounds are retrieved, a group with a parent is counted
+        among all compounds, and groups defined by the ``SET`` method are not
+        counted (``None``).
+
+        Parameters:
+            con (:class:`sqlalchemy.engine.Engine`): Database connection.
+            mode (str): ``'count'`` or ``'estimate'``.
+            optimize (bool): Whether to rewrite the query using fast
+                predicates; see :class:`commongroups.query.QueryMethod`.
+            sample (float): For estimates, an optional percentage of the
+                compounds to sample.
+
+        Returns:
+            Number of compounds (int), or ``None``.
+        """
+        self.create_query(optimize=optimize)
+        if self.query.set_expression is not None:
+            num = None
+        elif mode == 'estimate':
+            num = self.query.estimate(con, sample=sample)
+        else:
+            num = self.query.count(con)
         self.add_info({'about': self.query.describe(),
                        'sql': self.query.get_literal(),
-                       'count': len(res)})
-        self._compounds = res
+                       'count': num,
+                       'count_mode': mode})
+        return num
 
     def to_dict(self):
         """Return a dict of ``CMGroup`` parameters and info."""
@@ -126,13 +342,58 @@ class CMGroup(object):
         return ret
 
     def to_json(self, path=None):
-        """Serialize ``CMGroup`` parameters and info as JSON."""
+        """
+        Serialize ``CMGroup`` parameters and info as JSON.
+
+        The file is replaced atomically, and only if its content has changed
+        (see :mod:`commongroups.outputs`).
+        """
         if not path:
             path = pjoin(self.results_path, '{}.json'.format(self.cmg_id))
         logger.info('Writing JSON file: %s', path)
-        with open(path, 'w') as json_file:
+        with output_file(path, self.results_path,
+                         text_mode=True) as json_file:
             json.dump(self.to_dict(), json_file, indent=2, sort_keys=True)
 
+    def to_members(self, path=None):
+        """
+        Output the sorted list of compound IDs of the group's members.
+
+        The IDs (:data:`commongroups.query.ORD_KEY`) are written one per line
+        to ``members/<cmg_id>.txt`` in the results directory, if changed,
+        followed by the compounds' other identifiers (:data:`MEMBER_ALIASES`),
+        separated by tabs. A compound listed in several rows, e.g. with more
+        than one CASRN, is written once, with its distinct identifiers of each
+        kind joined by :data:`commongroups.diff.ALIAS_SEP`. These lists can be
+        compared between runs (see
+        :mod:`commongroups.diff`) and are indexed to look up the groups of
+        compounds (see :mod:`commongroups.invindex`).
+        """
+        if not path:
+            mkdir_p(pjoin(self.results_path, 'members'))
+            path = pjoin(self.results_path, 'members',
+                         '{}.txt'.format(self.cmg_id))
+        logger.info('Writing members file: %s', path)
+        cpds = self.compounds
+        cols = [cpds[ORD_KEY]] + [
+            cpds[col] if col in cpds else [None] * len(cpds)
+            for col in MEMBER_ALIASES
+        ]
+        members = {}
+        for row in zip(*cols):
+            aliases = members.setdefault(row[0], [[] for _ in MEMBER_ALIASES])
+            for values, val in zip(aliases, row[1:]):
+                val = alias_text(val)
+                if val and val not in values:
+                    values.append(val)
+        with output_file(path, self.results_path,
+                         text_mode=True) as members_file:
+            for key in sorted(members):
+                members_file.write('\t'.join(
+                    [alias_text(key)]
+                    + [ALIAS_SEP.join(values) for values in members[key]]
+                ) + '\n')
+
     def to_html(self, *args, **kwargs):
         """
         Output HTML display of the compound group.
@@ -146,7 +407,9 @@ class CMGroup(object):
         Output compound group data to an Excel spreadsheet.
 
         Parameters and info are tabulated on the first sheet, and the full
-        compounds ``DataFrame`` is exported to the second sheet.
+        compounds ``DataFrame`` is exported to the second sheet. The workbook
+        is assembled in memory, and the file is replaced atomically if its
+        content has changed.
         """
         meta_frame = pd.concat(
             [DataFrame(self.params, columns=self.params.keys(),
@@ -160,11 +423,14 @@ class CMGroup(object):
         path = pjoin(self.results_path,
                      '{0}.xlsx'.format(self.cmg_id))
         logger.info('Writing Excel file: %s', path)
-        with ExcelWriter(path) as writer:
+        buf = BytesIO()
+        with ExcelWriter(buf, engine='xlsxwriter') as writer:
+            writer.book.set_properties({'created': XLSX_CREATED})
             meta_frame.to_excel(writer,
                                 sheet_name='params+info',
                                 index_label='parameter')
             cpds_frame.to_excel(writer, sheet_name='compounds', index=False)
+        save_output(path, self.results_path, buf.getvalue())
 
     # TODO: Ability to apply group definition logic to a single compound,
     #       not in the database. This would seem to call for abstracting the
@@ -0,0 +1,235 @@
+# coding: utf-8
+
+"""
+Compare the members of compound groups between two runs.
+
+Each run writes a sorted list of the member IDs of each group to the
+``members`` subdirectory of its results directory (see
+:func:`commongroups.cmgroup.CMGroup.to_members`). Two such directories are
+compared group by group, in parallel, by merging the sorted lists in a single
+pass. For each group that changed, the added and removed compound IDs are
+written to a file, and a summary table lists the changes in all groups.
+
+Usage::
+
+   python -m commongroups.diff <old results> <new results> [-o <output>]
+"""
+
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import csv
+from functools import partial
+import json
+import logging
+import os
+from os.path import exists, join as pjoin
+
+from boltons.fileutils import atomic_save, mkdir_p
+
+from commongroups import logconf  # pylint: disable=unused-import
+logger = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+MANIFEST = 'cmgroups.jsonl'
+MEMBERS_DIR = 'members'
+
+# Separator of several identifiers of the same kind for one member, e.g. the
+# CASRNs of a compound with more than one.
+ALIAS_SEP = ';'
+SUMMARY_FIELDS = ['cmg_id', 'status', 'before', 'after', 'added', 'removed']
+
+
+def read_member_rows(path):
+    """
+    Generate the rows of a members file, in order.
+
+    Each row is a list of the member's ID followed by its other identifiers
+    (see :func:`commongroups.cmgroup.CMGroup.to_members`). A missing file is
+    treated as an empty list.
+    """
+    if not exists(path):
+        return
+    with open(path, 'r') as members_file:
+        for line in members_file:
+            line = line.rstrip('\n')
+            if line:
+                yield line.split('\t')
+
+
+def read_members(path):
+    """Generate the member IDs listed in a members file, in order."""
+    for row in read_member_rows(path):
+        yield row[0]
+
+
+def _distinct(keys):
+    """Generate the IDs of a sorted sequence, skipping repeats."""
+    last = None
+    for key in keys:
+        if key != last:
+            yield key
+            last = key
+
+
+def merge_diff(old, new):
+    """
+    Compare two sorted sequences of IDs in a single pass.
+
+    Repeated IDs, as in member lists written by earlier versions (one line per
+    row of the compounds table), are counted once.
+
+    Parameters:
+        old (iterable): IDs in the earlier run, in ascending order.
+        new (iterable): IDs in the later run, in ascending order.
+
+    Returns:
+        Tuple of the list of added IDs, the list of removed IDs, and the
+        numbers of distinct IDs in ``old`` and ``new``.
+    """
+    added, removed = [], []
+    n_old = n_new = 0
+    old, new = _distinct(old), _distinct(new)
+    a, b = next(old, None), next(new, None)
+    while a is not None or b is not None:
+        if b is None or (a is not None and a < b):
+            removed.append(a)
+            n_old += 1
+            a = next(old, None)
+        elif a is None or b < a:
+            added.append(b)
+            n_new += 1
+            b = next(new, None)
+        else:
+            n_old += 1
+            n_new += 1
+            a, b = next(old, None), next(new, None)
+    return added, removed, n_old, n_new
+
+
+def diff_group(cmg_id, old_path, new_path, out_path):
+    """
+    Compare the members of one group between two runs.
+
+    If the membership changed, the added and removed IDs are written to
+    ``<cmg_id>.tsv`` in ``out_path``.
+
+    Parameters:
+        cmg_id (str): ID of the compound group.
+        old_path (str): Results directory of the earlier run.
+        new_path (str): Results directory of the later run.
+        out_path (str): Directory for the output file.
+
+    Returns:
+        Dict summarizing the changes, with keys :data:`SUMMARY_FIELDS`.
+    """
+    filename = '{}.txt'.format(cmg_id)
+    old_file = pjoin(old_path, MEMBERS_DIR, filename)
+    new_file = pjoin(new_path, MEMBERS_DIR, filename)
+    added, removed, n_old, n_new = merge_diff(read_members(old_file),
+                                              read_members(new_file))
+    if not exists(old_file):
+        status = 'new'
+    elif not exists(new_file):
+        status = 'deleted'
+    elif added or removed:
+        status = 'changed'
+    else:
+        status = 'same'
+    if added or removed:
+        path = pjoin(out_path, '{}.tsv'.format(cmg_id))
+        with atomic_save(path, text_mode=True) as diff_file:
+            diff_file.write('change\tdtxsid\n')
+            for key in added:
+                diff_file.write('added\t{}\n'.format(key))
+            for key in removed:
+                diff_file.write('removed\t{}\n'.format(key))
+    return {'cmg_id': cmg_id, 'status': status, 'before': n_old,
+            'after': n_new, 'added': len(added), 'removed': len(removed)}
+
+
+def run_group_ids(path):
+    """
+    Return the IDs of the groups of the run whose results are in a directory.
+
+    These are the groups recorded in the run's manifest (:data:`MANIFEST`),
+    so that members files left from earlier runs, of groups that have since
+    been removed or renamed, are ignored. Without a manifest, all groups with
+    members files are returned.
+    """
+    manifest = pjoin(path, MANIFEST)
+    if exists(manifest):
+        ids = []
+        with open(manifest, 'r') as manifest_file:
+            for line in manifest_file:
+                try:
+                    ids.append(json.loads(line)['params']['cmg_id'])
+                except (ValueError, KeyError, TypeError):
+                    continue
+        return ids
+    members_path = pjoin(path, MEMBERS_DIR)
+    if not exists(members_path):
+        return []
+    return [name[:-len('.txt')] for name in os.listdir(members_path)
+            if name.endswith('.txt')]
+
+
+def group_ids(*paths):
+    """Return the sorted IDs of the groups of the runs in any path."""
+    ids = set()
+    for path in paths:
+        ids.update(run_group_ids(path))
+    return sorted(ids)
+
+
+def diff_runs(old_path, new_path, out_path=None, workers=None):
+    """
+    Compare the members of all compound groups between two runs.
+
+    Groups are compared in parallel processes. The changes in each group are
+    written as described in :func:`diff_group`, and a summary of all groups to
+    ``summary.csv``, in ``out_path``.
+
+    Parameters:
+        old_path (str): Results directory of the earlier run.
+        new_path (str): Results directory of the later run.
+        out_path (str): Output directory; defaults to ``diff`` in ``new_path``.
+        workers (int): Number of processes; defaults to the number of CPUs.
+
+    Returns:
+        List of dicts summarizing the changes in each group.
+    """
+    out_path = out_path or pjoin(new_path, 'diff')
+    mkdir_p(out_path)
+    ids = group_ids(old_path, new_path)
+    logger.info('Comparing %i groups: %s -> %s', len(ids), old_path, new_path)
+    compare = partial(diff_group, old_path=old_path, new_path=new_path,
+                      out_path=out_path)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        summary = list(executor.map(compare, ids,
+                                    chunksize=max(1, len(ids) // 64)))
+    path = pjoin(out_path, 'summary.csv')
+    logger.info('Writing diff summary: %s', path)
+    with atomic_save(path, text_mode=True) as summary_file:
+        writer = csv.DictWriter(summary_file, SUMMARY_FIELDS)
+        writer.writeheader()
+        writer.writerows(summary)
+    changed = sum(1 for row in summary if row['status'] != 'same')
+    logger.info('%i of %i groups changed', changed, len(summary))
+    return summary
+
+
+def main():
+    """Compare the members of compound groups between two runs."""
+    desc = 'Compare the members of compound groups between two runs.'
+    parser = argparse.ArgumentParser(description=desc)
+    parser.add_argument('old', help='results directory of the earlier run')
+    parser.add_argument('new', help='results directory of the later run')
+    parser.add_argument('-o', '--output',
+                        help='output directory (default: <new>/diff)')
+    parser.add_argument('-j', '--jobs', type=int,
+                        help='number of parallel processes')
+    args = parser.parse_args()
+    diff_runs(args.old, args.new, args.output, args.jobs)
+
+
+if __name__ == '__main__':
+    main()
@@ -9,27 +9,78 @@ import os
 from os.path import join as pjoin
 
 from boltons.fileutils import mkdir_p
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.exc import DBAPIError
 
 from commongroups.errors import MissingParamError
 from commongroups import logconf  # pylint: disable=unused-import
 logger = logging.getLogger(__name__)  # pylint: disable=invalid-name
 
+# Relations loaded into the database buffer cache by default when prewarming.
+PREWARM = ['compounds', 'molidx']
 
-def add_project_handler(log_file):
+
+def add_project_handler(log_path, structured=False):
     """
     Add a project-specific :class:`FileHandler` for all logging output.
 
     This enables logging to a file that's kept within the project
-    directory.
+    directory. The file is named by the time it is created. Each project has
+    one such file per process, however many :class:`CommonEnv` objects are
+    created for it. Records are written by the logging thread (see
+    :mod:`commongroups.logconf`).
+
+    Parameters:
+        log_path (str): The project's log directory.
+        structured (bool): Instead, add a handler writing only the records
+            of structured data, such as the timings and counts of each
+            processed group, as JSON Lines (``.jsonl``).
+
+    Returns:
+        The :class:`FileHandler`.
+    """
+    def create():
+        name = datetime.now().strftime('%Y%m%dT%H%M%S')
+        if structured:
+            handler = logging.FileHandler(pjoin(log_path, name + '.jsonl'))
+            handler.setFormatter(logconf.JsonFormatter())
+            handler.addFilter(logconf.has_record)
+        else:
+            handler = logging.FileHandler(pjoin(log_path, name + '.log'))
+            handler.setFormatter(logging.Formatter(logconf.FORMAT))
+        return handler
+    key = (os.path.abspath(log_path), 'jsonl' if structured else 'log')
+    return logconf.add_handler(key, create)
+
+
+def create_database_engine(url, options=None, session_params=None):
+    """
+    Create a SQLAlchemy engine with optional pool and session settings.
+
+    Parameters:
+        url (str): Database URL.
+        options (dict): Keyword arguments for
+            :func:`sqlalchemy.create_engine`, e.g. ``pool_size``,
+            ``max_overflow``, ``pool_pre_ping``, ``server_side_cursors``.
+        session_params (dict): Database settings applied to every new
+            connection, e.g. ``{"statement_timeout": "30min",
+            "work_mem": "256MB"}``.
+
+    Returns:
+        :class:`sqlalchemy.engine.Engine` object.
     """
-    loggers = list(logconf.CONFIG['loggers'].keys())
-    proj_handler = logging.FileHandler(log_file, mode='w')
-    fmt = logging.getLogger('commongroups').handlers[0].formatter
-    proj_handler.setFormatter(fmt)
-    for item in loggers:
-        lgr = logging.getLogger(item)
-        lgr.addHandler(proj_handler)
+    engine = create_engine(url, **(options or {}))
+    if session_params:
+        @event.listens_for(engine, 'connect')
+        def set_session_params(dbapi_con, _):
+            """Apply session parameters to a new DBAPI connection."""
+            cursor = dbapi_con.cursor()
+            for name, value in sorted(session_params.items()):
+                cursor.execute('SELECT set_config(%s, %s, false)',
+                               (name, str(value)))
+            cursor.close()
+            dbapi_con.commit()
+    return engine
 
 
 class CommonEnv(object):
@@ -44,8 +95,9 @@ class CommonEnv(object):
     corresponding to ``project_path`` and subdirectories ``data``, ``log``, and
     ``results``. The project directory is created within the "home" directory
     corresponding to ``env_path``.  A new log file is created in the ``log``
-    subdirectory each time a new ``CommonEnv`` with the same project name is
-    created.
+    subdirectory by the first ``CommonEnv`` for the project in each process.
+    If the ``log_json`` option is set, the timings and counts of processed
+    groups are also logged as JSON Lines in the same directory.
 
     Parameters:
         name (str): Project name, used to name the project directory.
@@ -73,9 +125,7 @@ class CommonEnv(object):
         # Set up per-project logging to file.
         log_path = pjoin(self._project_path, 'log')
         mkdir_p(log_path)
-        log_file = pjoin(log_path,
-                         datetime.now().strftime('%Y%m%dT%H%M%S') + '.log')
-        add_project_handler(log_file)
+        add_project_handler(log_path)
 
         # Set up data and results directories.
         self._data_path = pjoin(self._project_path, 'data')
@@ -88,6 +138,8 @@ class CommonEnv(object):
         logger.info('Project path: %s', self._project_path)
 
         self.set_config(kwargs)
+        if self.config.get('log_json'):
+            add_project_handler(log_path, structured=True)
         self.database = None
 
     # The following attributes are read-only because changing them would
@@ -146,9 +198,65 @@ class CommonEnv(object):
             self.config.update(opts)
 
     def connect_database(self):
-        """Instantiate a SQLAlchemy engine for connecting to the database."""
+        """
+        Instantiate a SQLAlchemy engine for connecting to the database.
+
+        If the ``database_url`` option is a list of several URLs, the compounds
+        database is taken to be sharded across these databases, and a list of
+        engines is created. Queries are then run on all shards concurrently
+        (see :func:`commongroups.query.get_sharded_results`).
+
+        Engines are configured using the ``engine_options`` and
+        ``session_params`` options, if given (see
+        :func:`create_database_engine`).
+        """
         if 'database_url' not in self.config:
             raise MissingParamError('database_url')
-        con = create_engine(self.config['database_url'])
+        urls = self.config['database_url']
+        if isinstance(urls, str):
+            urls = [urls]
+        con = [create_database_engine(url,
+                                      self.config.get('engine_options'),
+                                      self.config.get('session_params'))
+               for url in urls]
+        if len(con) == 1:
+            con = con[0]
+        else:
+            logger.info('Connecting to %i database shards', len(con))
         self.database = con
         return con
+
+    def prewarm_database(self, relations=None):
+        """
+        Load the most used tables and indexes into the database's cache.
+
+        This avoids slow queries at the start of a batch while the cache is
+        cold. Uses the ``pg_prewarm`` extension if it is installed; otherwise,
+        only tables can be prewarmed, by reading them through.
+
+        Parameters:
+            relations (list): Names of tables and indexes to load. Defaults to
+                the ``prewarm`` option, if it is a list, or :data:`PREWARM`.
+        """
+        if not self.database:
+            self.connect_database()
+        if relations is None:
+            relations = self.config.get('prewarm')
+        if not isinstance(relations, list):
+            relations = PREWARM
+        engines = self.database
+        if not isinstance(engines, list):
+            engines = [engines]
+        for engine in engines:
+            for rel in relations:
+                logger.info('Prewarming database relation: %s', rel)
+                try:
+                    engine.execute(text('SELECT pg_prewarm(:rel)'), rel=rel)
+                except DBAPIError:
+                    logger.warning('Cannot use pg_prewarm for %s;'
+                                   ' reading it through instead', rel)
+                    try:
+                        engine.execute(text(
+                            'SELECT count(*) FROM {}'.format(rel)))
+                    except DBAPIError:
+                        logger.warning('Cannot prewarm %s', rel)
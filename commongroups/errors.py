@@ -31,3 +31,14 @@ class NoCredentialsError(CommonError):
     def __str__(self):
         msg = 'Cannot read Google API credentials key file: {0}'
         return msg.format(self.path)
+
+
+class PreflightError(CommonError):
+    """Raised when group definitions fail the checks before a run."""
+    def __init__(self, failed, *args, **kwargs):
+        self.failed = failed
+        super().__init__(self, *args, **kwargs)
+
+    def __str__(self):
+        msg = 'Group definitions failed pre-flight checks: {0}'
+        return msg.format(', '.join(self.failed))
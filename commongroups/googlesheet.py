@@ -11,10 +11,7 @@ import json
 import logging
 import os
 
-import gspread
-from oauth2client.service_account import ServiceAccountCredentials as SAC
-
-from commongroups.cmgroup import CMGroup, BASE_PARAMS
+from commongroups.cmgroup import CMGroup, BASE_PARAMS, OPTIONAL_PARAMS
 from commongroups.errors import NoCredentialsError
 from commongroups import logconf  # pylint: disable=unused-import
 logger = logging.getLogger(__name__)  # pylint: disable=invalid-name
@@ -43,6 +40,11 @@ class SheetManager(object):
         because of the "New Sheets".
     """
     def __init__(self, title, worksheet, key_file):
+        # The Google API libraries are slow to import and only needed here.
+        import gspread
+        from oauth2client.service_account import (
+            ServiceAccountCredentials as SAC
+        )
         _key_file = os.path.abspath(key_file)
         try:
             creds = SAC.from_json_keyfile_name(_key_file, SCOPE)
@@ -70,7 +72,9 @@ class SheetManager(object):
         """
         Read parameters and info from spreadsheet rows iteratively.
 
-        Stops reading the spreadsheet when a blank row is encountered.
+        Stops reading the spreadsheet when a blank row is encountered. Columns
+        after the :data:`BASE_PARAMS` are read as info, except for non-blank
+        :data:`OPTIONAL_PARAMS`, which are read as parameters.
 
         Yields:
             Parameters and info for each group (row), as nested dicts.
@@ -88,6 +92,9 @@ class SheetManager(object):
             vals = wks.row_values(i)
             params = {k: v for (k, v) in zip(BASE_PARAMS, vals[:npars])}
             info = {k: v for (k, v) in zip(ikeys, vals[npars:])}
+            for key in OPTIONAL_PARAMS:
+                if info.get(key):
+                    params[key] = info.pop(key)
             yield {'params': params, 'info': info}
 
     def get_cmgs(self, env):
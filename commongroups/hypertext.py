@@ -4,22 +4,33 @@
 Functions for generating HTML output.
 """
 
+from functools import lru_cache
 import logging
 import os
 from os.path import join as pjoin
-from pkg_resources import resource_filename
 from urllib.parse import urlencode
 
-from ashes import AshesEnv
-
 from commongroups.errors import MissingParamError
+from commongroups.outputs import save_output
 from commongroups import logconf  # pylint: disable=unused-import
 logger = logging.getLogger(__name__)  # pylint: disable=invalid-name
 
-TEMPLATES_DIR = resource_filename(__name__, 'templates')
 DIR_TITLE = 'Compound group processing results'
 
 
+@lru_cache(maxsize=None)
+def templates_dir():
+    """Return the path of the directory of HTML templates."""
+    from pkg_resources import resource_filename
+    return resource_filename(__name__, 'templates')
+
+
+def render(template, context):
+    """Render one of the HTML templates with a context dict."""
+    from ashes import AshesEnv
+    return AshesEnv([templates_dir()]).render(template, context)
+
+
 def pubchem_image(cid_or_container, size=500):
     """
     Generate HTML code for a PubChem molecular structure graphic and link.
@@ -46,12 +57,22 @@ def pubchem_image(cid_or_container, size=500):
     return ret
 
 
-def get_notes(cmg):
-    """Retrieve ``notes`` from CMGroup info, if exists."""
-    if 'notes' in cmg.info:
-        return cmg.info['notes']
+def directory_item(cmg):
+    """
+    Summarize a compound group as an entry in the HTML directory.
+
+    Parameters:
+        cmg: A :class:`CMGroup` object, or a dict of its parameters and info
+            as returned by :func:`CMGroup.to_dict` (e.g. read from a
+            manifest).
+    """
+    if isinstance(cmg, dict):
+        params, info = cmg['params'], cmg.get('info', {})
     else:
-        return ''
+        params, info = cmg.params, cmg.info
+    return {'cmg_id': params['cmg_id'],
+            'name': params['name'],
+            'notes': info.get('notes', '')}
 
 
 def info_to_context(info):
@@ -107,12 +128,10 @@ def cmg_to_html(cmg, formats=None, img_source='PubChem', img_size=500):
                'items': items,
                'formats': formats}
 
-    templater = AshesEnv([TEMPLATES_DIR])
-    html = templater.render('cmgroup.html', context)
+    html = render('cmgroup.html', context)
     path = pjoin(cmg.results_path, 'html', '{}.html'.format(cmg.cmg_id))
     logger.info('Writing HTML file: %s', path)
-    with open(path, 'w') as html_file:
-        html_file.write(html)
+    save_output(path, cmg.results_path, html)
 
 
 def directory(cmgs, env, title=DIR_TITLE, formats=None):
@@ -122,21 +141,18 @@ def directory(cmgs, env, title=DIR_TITLE, formats=None):
     Writes and HTML file in the environment's ``results/html`` directory.
 
     Parameters:
-        cmgs: Iterable of :class:`CMGroup` objects.
+        cmgs: Iterable of :class:`CMGroup` objects, or of dicts of their
+            parameters and info (see :func:`directory_item`).
         env: :class:`CommonEnv` to contain output.
         title (str): Title of page.
         formats (list): List of file extensions to use to create links to other
             formats of this collection, e.g. ``json``, ``xlsx``.
     """
-    items = [{'cmg_id': cmg.cmg_id,
-              'name': cmg.name,
-              'notes': get_notes(cmg)} for cmg in cmgs]
+    items = [directory_item(cmg) for cmg in cmgs]
     context = {'title': title,
                'items': items,
                'formats': formats}
-    templater = AshesEnv([TEMPLATES_DIR])
-    html = templater.render('directory.html', context)
+    html = render('directory.html', context)
     path = pjoin(env.results_path, 'html', 'index.html')
     logger.info('Writing HTML file: %s', path)
-    with open(path, 'w') as html_file:
-        html_file.write(html)
+    save_output(path, env.results_path, html)
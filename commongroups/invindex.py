@@ -0,0 +1,336 @@
+# coding: utf-8
+
+"""
+Inverted index from compounds to the groups that contain them.
+
+The index is built from the member lists of the groups of a run, in the
+``members`` subdirectory of its results directory (see
+:func:`commongroups.cmgroup.CMGroup.to_members`), and stored in
+``results/index`` as sorted NumPy arrays, which are memory-mapped when the
+index is opened:
+
+-  ``ids.npy``: Sorted compound IDs (``dtxsid``).
+-  ``offsets.npy``, ``postings.npy``: The groups of the compound ``ids[k]``
+   are ``postings[offsets[k]:offsets[k + 1]]``, as numbers of groups.
+-  ``alias_keys.npy``, ``alias_ids.npy``: Sorted other identifiers of
+   compounds (CASRN, CID), and the position of each compound in ``ids``. An
+   identifier shared by several compounds is listed once for each of them.
+-  ``groups.json``: The ``cmg_id`` of each group number, and array sizes.
+
+Lookups of many identifiers at once are vectorized: binary searches for all
+identifiers, then a single gather of the postings of all compounds found.
+
+Usage::
+
+   python -m commongroups.invindex <results> <identifier>... [-f <file>]
+   python -m commongroups.invindex <results> --rebuild
+"""
+
+import argparse
+from io import BytesIO
+import json
+import logging
+from os.path import exists, join as pjoin
+import sys
+
+from boltons.fileutils import mkdir_p
+import numpy as np
+
+from commongroups.diff import (group_ids, read_member_rows, ALIAS_SEP,
+                               MEMBERS_DIR)
+from commongroups.outputs import save_output
+from commongroups import logconf  # pylint: disable=unused-import
+logger = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+INDEX_DIR = 'index'
+ARRAYS = ['ids', 'offsets', 'postings', 'alias_keys', 'alias_ids']
+
+
+def _as_keys(values):
+    """Convert identifiers to a fixed-width byte string array."""
+    return np.array([str(val).encode('ascii', 'replace') for val in values],
+                    dtype=bytes)
+
+
+def _ranges(starts, counts):
+    """Concatenate the ranges ``starts[k]:starts[k] + counts[k]``."""
+    ends = np.cumsum(counts)
+    total = int(ends[-1]) if len(ends) else 0
+    return np.arange(total, dtype=np.int64) + np.repeat(starts - ends + counts,
+                                                        counts)
+
+
+def _read_group(results_path, cmg_id):
+    """Read the member IDs and alias pairs of one group."""
+    ids = []
+    aliases = []
+    path = pjoin(results_path, MEMBERS_DIR, '{}.txt'.format(cmg_id))
+    for row in read_member_rows(path):
+        ids.append(row[0])
+        aliases.extend((alias, row[0]) for field in row[1:]
+                       for alias in field.split(ALIAS_SEP) if alias)
+    return ids, aliases
+
+
+class InvertedIndex(object):
+    """
+    Look up the groups that contain compounds, by ``dtxsid``, CASRN, or CID.
+
+    Parameters:
+        results_path (str): Results directory containing the index.
+
+    Raises:
+        FileNotFoundError: If the index does not exist; see
+            :func:`build_index`.
+        ValueError: If the index files are inconsistent, e.g. while the index
+            is being rewritten.
+    """
+    def __init__(self, results_path):
+        path = pjoin(results_path, INDEX_DIR)
+        with open(pjoin(path, 'groups.json'), 'r') as meta_file:
+            meta = json.load(meta_file)
+        self.groups = meta['groups']
+        for name in ARRAYS:
+            arr = np.load(pjoin(path, '{}.npy'.format(name)), mmap_mode='r')
+            if len(arr) != meta['sizes'][name]:
+                raise ValueError('Inconsistent index: {}'.format(path))
+            setattr(self, name, arr)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def positions(self, keys):
+        """
+        Find compounds in the index by any of their identifiers.
+
+        A ``dtxsid`` identifies one compound, but a CASRN or CID may be shared
+        by several compounds, all of which are found.
+
+        Parameters:
+            keys (iterable): Identifiers (``dtxsid``, CASRN, or CID).
+
+        Returns:
+            Tuple of two arrays with one element per compound found: the
+            position of the identifier in ``keys``, in ascending order, and
+            the position of the compound in :attr:`ids`.
+        """
+        keys = _as_keys(keys)
+        found = np.zeros(len(keys), dtype=bool)
+        pos = np.zeros(len(keys), dtype=np.int64)
+        if len(self.ids) and len(keys):
+            pos = np.searchsorted(self.ids, keys)
+            pos[pos == len(self.ids)] = 0
+            found = self.ids[pos] == keys
+        owners = [np.flatnonzero(found)]
+        hits = [pos[found]]
+        if len(self.alias_keys) and len(keys):
+            todo = np.flatnonzero(~found)
+            start = np.searchsorted(self.alias_keys, keys[todo], side='left')
+            stop = np.searchsorted(self.alias_keys, keys[todo], side='right')
+            owners.append(np.repeat(todo, stop - start))
+            hits.append(np.asarray(self.alias_ids)[_ranges(start,
+                                                           stop - start)])
+        owners, hits = np.concatenate(owners), np.concatenate(hits)
+        order = np.argsort(owners, kind='stable')
+        return owners[order], hits[order].astype(np.int64)
+
+    def lookup(self, keys):
+        """
+        Look up the groups of many compounds at once.
+
+        The postings of all compounds found are gathered at once, and only
+        then split by identifier and mapped to group IDs.
+
+        Parameters:
+            keys (iterable): Identifiers (``dtxsid``, CASRN, or CID).
+
+        Returns:
+            List of lists of ``cmg_id``, in the order of ``keys``; for an
+            identifier shared by several compounds, the groups that contain
+            any of them.
+        """
+        keys = list(keys)
+        owners, pos = self.positions(keys)
+        # Identifiers shared by several compounds found.
+        shared = np.zeros(len(keys), dtype=bool)
+        shared[owners[1:][owners[1:] == owners[:-1]]] = True
+        offsets = np.asarray(self.offsets)
+        starts = offsets[pos]
+        counts = offsets[pos + 1] - starts
+        owners = np.repeat(owners, counts)
+        nums = np.asarray(self.postings)[_ranges(starts, counts)]
+        nums = nums.astype(np.int64)
+        merge = shared[owners]
+        if merge.any():
+            # Merge the groups of compounds that share an identifier.
+            combined = np.sort(owners[merge] * len(self.groups) + nums[merge])
+            distinct = np.ones(len(combined), dtype=bool)
+            distinct[1:] = combined[1:] != combined[:-1]
+            merged = np.divmod(combined[distinct], len(self.groups))
+            owners = np.concatenate([owners[~merge], merged[0]])
+            nums = np.concatenate([nums[~merge], merged[1]])
+            order = np.argsort(owners, kind='stable')
+            owners, nums = owners[order], nums[order]
+        bounds = np.searchsorted(owners, np.arange(len(keys) + 1)).tolist()
+        names = np.array(self.groups, dtype=object)[nums].tolist()
+        return [names[bounds[num]:bounds[num + 1]]
+                for num in range(len(keys))]
+
+    def groups_of(self, key):
+        """Return the IDs of the groups that contain a compound."""
+        return self.lookup([key])[0]
+
+
+def _distinct_pairs(keys, values):
+    """Sort pairs of arrays by key, then value, and drop repeated pairs."""
+    order = np.lexsort((values, keys))
+    keys, values = keys[order], values[order]
+    keep = np.ones(len(keys), dtype=bool)
+    keep[1:] = (keys[1:] != keys[:-1]) | (values[1:] != values[:-1])
+    return keys[keep], values[keep]
+
+
+def _write_index(results_path, groups, pairs, aliases):
+    """
+    Write the index arrays.
+
+    Parameters:
+        groups (list): ``cmg_id`` of each group number.
+        pairs (tuple): Arrays of compound IDs and of their group numbers.
+        aliases (tuple): Arrays of alias keys and of their compound IDs.
+    """
+    keys, nums = _distinct_pairs(*pairs)
+    ids, starts = np.unique(keys, return_index=True)
+    arrays = {
+        'ids': ids,
+        'offsets': np.append(starts, len(keys)).astype(np.int64),
+        'postings': nums.astype(np.int32)
+    }
+    alias_keys, alias_targets = _distinct_pairs(*aliases)
+    if len(alias_keys) and len(ids):
+        pos = np.searchsorted(ids, alias_targets)
+        pos[pos == len(ids)] = 0
+        valid = ids[pos] == alias_targets
+        alias_keys, pos = alias_keys[valid], pos[valid]
+    else:
+        alias_keys = alias_keys[:0]
+        pos = np.array([], dtype=np.int64)
+    arrays['alias_keys'] = alias_keys
+    arrays['alias_ids'] = pos.astype(np.int64)
+
+    path = pjoin(results_path, INDEX_DIR)
+    mkdir_p(path)
+    for name in ARRAYS:
+        buf = BytesIO()
+        np.save(buf, arrays[name])
+        save_output(pjoin(path, '{}.npy'.format(name)), results_path,
+                    buf.getvalue())
+    meta = {'groups': groups,
+            'sizes': {name: len(arrays[name]) for name in ARRAYS}}
+    save_output(pjoin(path, 'groups.json'), results_path,
+                json.dumps(meta, indent=1, sort_keys=True))
+    logger.info('Indexed %i compounds in %i groups', len(ids), len(groups))
+
+
+def build_index(results_path, cmg_ids=None, groups=None):
+    """
+    Build or update the inverted index of a results directory.
+
+    Parameters:
+        results_path (str): Results directory.
+        cmg_ids (iterable): Optional IDs of groups that have been (re)processed
+            since the index was last built. Only their member lists are read;
+            entries for other groups are kept from the existing index. If not
+            given, or if there is no index yet, the index is built from the
+            member lists of all groups.
+        groups (iterable): Optional IDs of all groups of the run; by default,
+            those recorded in its manifest (see
+            :func:`commongroups.diff.run_group_ids`). Other groups, e.g. with
+            members files left from earlier runs, are not indexed.
+
+    Returns:
+        :class:`InvertedIndex` object.
+    """
+    groups = group_ids(results_path) if groups is None else sorted(set(groups))
+    old = None
+    if cmg_ids is not None:
+        try:
+            old = InvertedIndex(results_path)
+        except (OSError, ValueError):
+            logger.info('Building new index of compounds in groups')
+    if old is None:
+        update = groups
+        kept_keys = np.array([], dtype=bytes)
+        kept_nums = np.array([], dtype=np.int64)
+        kept_aliases = (np.array([], dtype=bytes), np.array([], dtype=bytes))
+    else:
+        cmg_ids = set(cmg_ids)
+        current = set(groups)
+        update = sorted(cmg_ids & current)
+        known = set(old.groups)
+        groups = [cmg_id for cmg_id in old.groups if cmg_id in current] + \
+            [cmg_id for cmg_id in groups if cmg_id not in known]
+        # Renumber the postings of groups kept from the old index, and drop
+        # those of groups that are updated or no longer part of the run.
+        number = {cmg_id: num for num, cmg_id in enumerate(groups)}
+        renumber = np.array([-1 if cmg_id in cmg_ids
+                             else number.get(cmg_id, -1)
+                             for cmg_id in old.groups], dtype=np.int64)
+        counts = np.diff(old.offsets)
+        all_keys = np.repeat(np.asarray(old.ids), counts)
+        all_nums = renumber[np.asarray(old.postings, dtype=np.int64)]
+        keep = all_nums >= 0
+        kept_keys, kept_nums = all_keys[keep], all_nums[keep]
+        kept_aliases = (np.asarray(old.alias_keys),
+                        np.asarray(old.ids)[np.asarray(old.alias_ids)])
+
+    new_keys, new_nums, alias_keys, alias_targets = [], [], [], []
+    number = {cmg_id: num for num, cmg_id in enumerate(groups)}
+    for cmg_id in update:
+        ids, aliases = _read_group(results_path, cmg_id)
+        if not exists(pjoin(results_path, MEMBERS_DIR,
+                            '{}.txt'.format(cmg_id))):
+            logger.warning('No members file for %s', cmg_id)
+        new_keys.extend(ids)
+        new_nums.extend([number[cmg_id]] * len(ids))
+        alias_keys.extend(alias for alias, _ in aliases)
+        alias_targets.extend(target for _, target in aliases)
+
+    pairs = (np.concatenate([kept_keys.astype(bytes), _as_keys(new_keys)]),
+             np.concatenate([kept_nums,
+                             np.array(new_nums, dtype=np.int64)]))
+    aliases = (np.concatenate([_as_keys(alias_keys),
+                               kept_aliases[0].astype(bytes)]),
+               np.concatenate([_as_keys(alias_targets),
+                               kept_aliases[1].astype(bytes)]))
+    _write_index(results_path, groups, pairs, aliases)
+    return InvertedIndex(results_path)
+
+
+def main():
+    """Look up the groups that contain compounds."""
+    desc = 'Look up the compound groups that contain compounds.'
+    parser = argparse.ArgumentParser(description=desc)
+    parser.add_argument('results', help='results directory of a run')
+    parser.add_argument('keys', nargs='*',
+                        help='compound identifiers (DTXSID, CASRN, or CID)')
+    parser.add_argument('-f', '--file',
+                        help='file of identifiers, one per line')
+    parser.add_argument('--rebuild', action='store_true',
+                        help='rebuild the index from the member lists')
+    args = parser.parse_args()
+
+    if args.rebuild:
+        index = build_index(args.results)
+    else:
+        index = InvertedIndex(args.results)
+    keys = list(args.keys)
+    if args.file:
+        with open(args.file, 'r') as key_file:
+            keys.extend(line.strip() for line in key_file if line.strip())
+    for key, groups in zip(keys, index.lookup(keys)):
+        sys.stdout.write('{0}\t{1}\n'.format(key, ','.join(groups)))
+
+
+if __name__ == '__main__':
+    main()
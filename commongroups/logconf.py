@@ -1,39 +1,60 @@
 # coding: utf-8
 
-"""Logging configuration."""
+"""
+Logging configuration.
+
+Loggers do not write to the console or to files themselves: they put records
+on a queue (:data:`QUEUE_HANDLER`), and a background thread (a
+:class:`logging.handlers.QueueListener`) passes them on to the console and to
+any other handlers added with :func:`add_handler`, such as the log files of
+projects. Logging calls therefore do no I/O in the thread that makes them.
+
+Records with a ``record`` attribute (passed as
+``extra={'record': {...}}``) carry structured data, such as the timings and
+counts of each processed group, and can be written as JSON Lines by a handler
+using :class:`JsonFormatter` and :func:`has_record`.
+"""
 
 from __future__ import unicode_literals
 
-import sys
+import atexit
+import json
 import logging
 import logging.config
+from logging.handlers import QueueHandler, QueueListener
+import os
+import queue
+import sys
+import threading
+
+FORMAT = '%(asctime)s %(name)s %(levelname)s %(message)s'
+
+# Handler of the logging output of all configured loggers.
+QUEUE_HANDLER = QueueHandler(queue.Queue(-1))
 
 CONFIG = {
     'version': 1,
     'disable_existing_loggers': False,
     'formatters': {
         'default': {
-            'format': '%(asctime)s %(name)s %(levelname)s %(message)s',
+            'format': FORMAT,
             'style': '%'
         }
     },
     'handlers': {
-        'console': {
-            'class': 'logging.StreamHandler',
-            'level': 'INFO',
-            'formatter': 'default',
-            'stream': sys.stdout
+        'queue': {
+            '()': lambda: QUEUE_HANDLER
         }
     },
     'loggers': {
         'commongroups': {
             'level': 'DEBUG',
-            'handlers': ['console'],
+            'handlers': ['queue'],
             'propagate': False
         },
         'sqlalchemy': {
             'level': 'WARNING',
-            'handlers': ['console'],
+            'handlers': ['queue'],
             'propagate': False
         }
     },
@@ -43,4 +64,88 @@ CONFIG = {
     }
 }
 
+# Console output, at INFO level by default.
+CONSOLE = logging.StreamHandler(sys.stdout)
+CONSOLE.setLevel('INFO')
+CONSOLE.setFormatter(logging.Formatter(FORMAT))
+
+_LOCK = threading.Lock()
+_HANDLERS = {}
+_LISTENER = None
+
+
+class JsonFormatter(logging.Formatter):
+    """Format the structured data of a log record as a line of JSON."""
+
+    def format(self, record):
+        data = {'time': self.formatTime(record),
+                'level': record.levelname,
+                'logger': record.name,
+                'process': record.process}
+        data.update(getattr(record, 'record', {}))
+        return json.dumps(data, sort_keys=True, default=str)
+
+
+def has_record(record):
+    """Filter for log records that carry structured data."""
+    return hasattr(record, 'record')
+
+
+def start_listener():
+    """(Re)start the thread that passes queued records on to handlers."""
+    global _LISTENER  # pylint: disable=global-statement
+    _LISTENER = QueueListener(QUEUE_HANDLER.queue, CONSOLE,
+                              *_HANDLERS.values(),
+                              respect_handler_level=True)
+    _LISTENER.start()
+
+
+def stop_listener():
+    """Stop the listener thread, after it has handled all queued records."""
+    global _LISTENER  # pylint: disable=global-statement
+    with _LOCK:
+        if _LISTENER is not None:
+            _LISTENER.stop()
+            _LISTENER = None
+
+
+def flush():
+    """Wait until all queued records have been handled, and flush handlers."""
+    QUEUE_HANDLER.queue.join()
+    for handler in (CONSOLE,) + tuple(_HANDLERS.values()):
+        handler.flush()
+
+
+def add_handler(key, create):
+    """
+    Add a handler for the output of all configured loggers, once per key.
+
+    Parameters:
+        key: Identifies the handler, e.g. a project and the kind of log.
+        create: Function returning a new :class:`logging.Handler`; only
+            called if there is no handler for ``key`` yet.
+
+    Returns:
+        The handler for ``key``.
+    """
+    with _LOCK:
+        if key not in _HANDLERS:
+            _HANDLERS[key] = create()
+            if _LISTENER is not None:
+                _LISTENER.handlers = (CONSOLE,) + tuple(_HANDLERS.values())
+        return _HANDLERS[key]
+
+
+def _after_fork():
+    """Give a forked child process its own queue and listener thread."""
+    global _LOCK  # pylint: disable=global-statement
+    _LOCK = threading.Lock()
+    QUEUE_HANDLER.queue = queue.Queue(-1)
+    start_listener()
+
+
 logging.config.dictConfig(CONFIG)
+start_listener()
+atexit.register(stop_listener)
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork)
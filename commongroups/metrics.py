@@ -0,0 +1,370 @@
+# coding: utf-8
+
+"""
+Instrumentation of compound group processing.
+
+Processing steps report into counters, gauges, and histograms kept in
+:data:`REGISTRY`: the groups completed, the rows returned by queries, the
+latency of queries and of writing output files, and the duration and peak
+memory of each stage of processing a group. These metrics can be exposed in
+the Prometheus text format, written periodically to a file (e.g. for the
+node exporter's textfile collector) or served over HTTP, and summarized in a
+live progress line on the console (see :class:`Reporter`).
+"""
+
+import bisect
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import logging
+from os.path import join as pjoin
+import sys
+import threading
+import time
+
+from boltons.fileutils import atomic_save
+
+from commongroups import logconf  # pylint: disable=unused-import
+logger = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+try:
+    import resource
+except ImportError:  # Not available on Windows.
+    resource = None  # pylint: disable=invalid-name
+
+# Upper bounds of histogram buckets, in seconds.
+BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60,
+           120, 300, 600]
+REFRESH_SECONDS = 5
+CONTENT_TYPE = 'text/plain; version=0.0.4'
+
+
+def _labels_text(labels):
+    """Format a sorted tuple of label pairs as in the Prometheus format."""
+    if not labels:
+        return ''
+    pairs = ['{0}="{1}"'.format(key, str(val).replace('"', r'\"'))
+             for key, val in labels]
+    return '{' + ','.join(pairs) + '}'
+
+
+class Metric(object):
+    """
+    Base class of metrics, with values for each combination of labels.
+
+    Parameters:
+        name (str): Metric name.
+        doc (str): Description of the metric.
+    """
+    kind = 'untyped'
+
+    def __init__(self, name, doc):
+        self.name = name
+        self.doc = doc
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def value(self, **labels):
+        """Return the value for some labels."""
+        with self._lock:
+            return self._values.get(tuple(sorted(labels.items())), 0)
+
+    def total(self):
+        """Return the sum of the values for all labels."""
+        with self._lock:
+            return sum(self._values.values())
+
+    def reset(self):
+        """Forget all values."""
+        with self._lock:
+            self._values.clear()
+
+    def samples(self):
+        """Generate the name, labels, and value of each sample."""
+        with self._lock:
+            items = sorted(self._values.items())
+        for labels, value in items:
+            yield self.name, labels, value
+
+    def render(self):
+        """Return the metric in the Prometheus text format."""
+        lines = ['# HELP {0} {1}'.format(self.name, self.doc),
+                 '# TYPE {0} {1}'.format(self.name, self.kind)]
+        for name, labels, value in self.samples():
+            lines.append('{0}{1} {2}'.format(name, _labels_text(labels),
+                                             repr(float(value))))
+        return '\n'.join(lines) + '\n'
+
+
+class Counter(Metric):
+    """A count that only increases."""
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        """Increase the count."""
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """A value that can go up and down."""
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        """Set the value."""
+        with self._lock:
+            self._values[tuple(sorted(labels.items()))] = value
+
+    def set_max(self, value, **labels):
+        """Set the value, if greater than the current value."""
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = max(self._values.get(key, value), value)
+
+
+class Histogram(Metric):
+    """
+    Distribution of observed values, counted in buckets.
+
+    Parameters:
+        buckets (list): Upper bounds of the buckets, in ascending order.
+    """
+    kind = 'histogram'
+
+    def __init__(self, name, doc, buckets=None):
+        super().__init__(name, doc)
+        self.buckets = list(buckets or BUCKETS)
+
+    def observe(self, value, **labels):
+        """Record an observed value."""
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            counts, total = self._values.get(
+                key, ([0] * (len(self.buckets) + 1), 0))
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self._values[key] = (counts, total + value)
+
+    def count(self, **labels):
+        """Return the number of observations."""
+        with self._lock:
+            counts, _ = self._values.get(tuple(sorted(labels.items())),
+                                         ([0], 0))
+            return sum(counts)
+
+    def total(self):
+        """Return the sum of all observations, for all labels."""
+        with self._lock:
+            return sum(total for _, total in self._values.values())
+
+    def samples(self):
+        with self._lock:
+            items = sorted((key, (list(counts), total))
+                           for key, (counts, total) in self._values.items())
+        for labels, (counts, total) in items:
+            cumulative = 0
+            for bound, num in zip(self.buckets + ['+Inf'], counts):
+                cumulative += num
+                yield ('{}_bucket'.format(self.name),
+                       labels + (('le', bound),), cumulative)
+            yield '{}_sum'.format(self.name), labels, total
+            yield '{}_count'.format(self.name), labels, cumulative
+
+
+class Registry(object):
+    """Collection of metrics, rendered together."""
+
+    def __init__(self):
+        self.metrics = []
+
+    def add(self, metric):
+        """Add a metric to the registry and return it."""
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        """Return all metrics in the Prometheus text format."""
+        return ''.join(metric.render() for metric in self.metrics)
+
+    def reset(self):
+        """Forget the values of all metrics."""
+        for metric in self.metrics:
+            metric.reset()
+
+
+REGISTRY = Registry()
+
+STARTED = REGISTRY.add(Gauge(
+    'commongroups_run_start_time_seconds',
+    'Start time of the run, in seconds since the epoch.'))
+GROUPS_PLANNED = REGISTRY.add(Gauge(
+    'commongroups_groups_planned',
+    'Number of compound groups to process in the run.'))
+GROUPS = REGISTRY.add(Counter(
+    'commongroups_groups_total',
+    'Compound groups completed, by status.'))
+ROWS = REGISTRY.add(Counter(
+    'commongroups_rows_total',
+    'Rows of compounds returned by queries.'))
+QUERY_SECONDS = REGISTRY.add(Histogram(
+    'commongroups_query_seconds',
+    'Latency of database queries, by method.'))
+WRITE_SECONDS = REGISTRY.add(Histogram(
+    'commongroups_write_seconds',
+    'Latency of writing output files, by file type.'))
+WRITTEN_BYTES = REGISTRY.add(Counter(
+    'commongroups_written_bytes_total',
+    'Bytes of output files written, by file type.'))
+STAGE_SECONDS = REGISTRY.add(Histogram(
+    'commongroups_stage_seconds',
+    'Duration of the stages of processing each group.'))
+PEAK_MEMORY = REGISTRY.add(Gauge(
+    'commongroups_peak_memory_bytes',
+    'Peak resident memory of the process by the end of each stage.'))
+
+
+def peak_memory():
+    """Return the peak resident memory of this process in bytes, if known."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Reported in kilobytes on Linux, in bytes on macOS.
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+@contextmanager
+def timed(histogram, **labels):
+    """Observe the duration of a block of code in a histogram."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        histogram.observe(time.perf_counter() - start, **labels)
+
+
+@contextmanager
+def stage(name):
+    """Record the duration and peak memory of a stage of processing."""
+    with timed(STAGE_SECONDS, stage=name):
+        yield
+    peak = peak_memory()
+    if peak is not None:
+        PEAK_MEMORY.set_max(peak, stage=name)
+
+
+def progress_text(now=None):
+    """Summarize the progress of the run in one line."""
+    now = now or time.time()
+    elapsed = max(now - (STARTED.value() or now), 1e-9)
+    done = GROUPS.total()
+    planned = GROUPS_PLANNED.value()
+    text = '{0:.0f}'.format(done)
+    if planned:
+        text += '/{0:.0f} groups ({1:.0%})'.format(planned, done / planned)
+    else:
+        text += ' groups'
+    text += ', {0:.2f} groups/s, {1:,.0f} rows/s'.format(
+        done / elapsed, ROWS.total() / elapsed)
+    if planned and done:
+        remaining = (planned - done) * elapsed / done
+        text += ', {0:.0f}:{1:02.0f} left'.format(*divmod(remaining, 60))
+    return text
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    """Serve the metrics of :data:`REGISTRY`."""
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        """Handle ``GET`` requests."""
+        data = REGISTRY.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        logger.debug('%s %s', self.address_string(), format % args)
+
+
+class Reporter(object):
+    """
+    Expose metrics while a run is in progress.
+
+    Use as a context manager around the run. A background thread refreshes
+    the outputs every ``interval`` seconds, and once more at the end.
+
+    Parameters:
+        path (str): Optional file to write the metrics to, in the Prometheus
+            text format.
+        port (int): Optional local port on which to serve the metrics over
+            HTTP (any path).
+        progress (bool): Whether to show a progress line on the console. If
+            the console is not a terminal, progress is logged instead.
+        interval (float): Seconds between refreshes.
+    """
+    def __init__(self, path=None, port=None, progress=True,
+                 interval=REFRESH_SECONDS):
+        self.path = path
+        self.port = port
+        self.progress = progress
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+        self._server = None
+
+    def refresh(self, final=False):
+        """Write the metrics file and show progress."""
+        if self.path:
+            with atomic_save(self.path, text_mode=True) as metrics_file:
+                metrics_file.write(REGISTRY.render())
+        if not self.progress:
+            return
+        text = progress_text()
+        if sys.stderr.isatty():
+            sys.stderr.write('\r\x1b[K' + text + ('\n' if final else ''))
+            sys.stderr.flush()
+        else:
+            logger.info('Progress: %s', text)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.refresh()
+
+    def __enter__(self):
+        REGISTRY.reset()
+        STARTED.set(time.time())
+        if self.port is not None:
+            self._server = HTTPServer(('127.0.0.1', self.port),
+                                      _MetricsHandler)
+            threading.Thread(target=self._server.serve_forever,
+                             daemon=True).start()
+            logger.info('Serving metrics on http://127.0.0.1:%i/metrics',
+                        self._server.server_address[1])
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.refresh(final=True)
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+
+
+def reporter_from_env(env):
+    """
+    Create a :class:`Reporter` configured by a project environment.
+
+    The ``metrics_file`` option gives the file for the metrics (``true`` for
+    ``metrics.prom`` in the project directory), ``metrics_port`` a port to
+    serve them on, and ``progress`` (default ``true``) whether to show
+    progress.
+    """
+    path = env.config.get('metrics_file')
+    if path is True:
+        path = pjoin(env.project_path, 'metrics.prom')
+    return Reporter(path=path or None,
+                    port=env.config.get('metrics_port'),
+                    progress=env.config.get('progress', True))
@@ -2,17 +2,44 @@
 
 """Common Groups operations."""
 
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from functools import partial
+from itertools import islice
+import csv
+import hashlib
+import os
 from os.path import abspath, join as pjoin
 import logging
 import json
+from textwrap import indent
+import time
 
-from commongroups.cmgroup import CMGroup
+from commongroups.cmgroup import (CMGroup,
+                                  BASE_PARAMS,
+                                  OPTIONAL_PARAMS,
+                                  validate_params)
+from commongroups.diff import MANIFEST
 from commongroups.errors import MissingParamError, NoCredentialsError
 from commongroups.googlesheet import SheetManager
 from commongroups.hypertext import directory
+from commongroups.invindex import build_index
+from commongroups import metrics
+from commongroups.outputs import output_file
+from commongroups.overlap import analyze_overlap
+from commongroups.preflight import pool_size, preflight_groups
+from commongroups.query import substructure_mol
+from commongroups.snapshot import current_snapshot
 from commongroups import logconf  # pylint: disable=unused-import
 logger = logging.getLogger(__name__)  # pylint: disable=invalid-name
 
+JOURNAL = 'journal.jsonl'
+COUNTS = 'counts.csv'
+COUNT_FIELDS = ['cmg_id', 'name', 'method', 'count', 'count_mode']
+# Number of groups above which parent detection warns about memory and time.
+DETECT_PARENTS_WARN = 10000
+
 
 def cmgs_from_googlesheet(env):
     """
@@ -42,7 +69,89 @@ def cmgs_from_googlesheet(env):
     return cmg_gen
 
 
-# TODO: Import group definitions from spreadsheet file.
+def split_params(record):
+    """
+    Split a flat record (e.g. a spreadsheet row) into parameters and info.
+
+    Keys that are among the :data:`commongroups.cmgroup.BASE_PARAMS` are
+    taken as parameters, as are any non-blank values of the
+    :data:`commongroups.cmgroup.OPTIONAL_PARAMS`. All other keys are taken as
+    additional information.
+
+    Parameters:
+        record (dict): Column names and values for one compound group.
+
+    Returns:
+        Parameters and info for the group, as nested dicts.
+    """
+    params = {}
+    info = {}
+    for key, val in record.items():
+        if key in BASE_PARAMS:
+            params[key] = '' if val is None else str(val)
+        elif key in OPTIONAL_PARAMS:
+            if val not in (None, ''):
+                params[key] = str(val)
+        else:
+            info[key] = '' if val is None else val
+    return {'params': params, 'info': info}
+
+
+def _read_json(path):
+    """Read definitions from a JSON file (a single array; not streamed)."""
+    with open(path, 'r') as json_file:
+        many_params = json.load(json_file)
+    for item in many_params:
+        yield item
+
+
+def _read_jsonl(path):
+    """Read definitions from a JSON Lines file, one line at a time."""
+    with open(path, 'r') as json_file:
+        for line in json_file:
+            if line.strip():
+                yield json.loads(line)
+
+
+def _read_csv(path, delimiter=','):
+    """Read definitions from a delimited text file with a header row."""
+    with open(path, 'r', newline='') as csv_file:
+        for row in csv.DictReader(csv_file, delimiter=delimiter):
+            yield split_params(row)
+
+
+def _read_xlsx(path):
+    """
+    Read definitions from the first worksheet of an Excel file.
+
+    The first row must contain column names. Stops reading the worksheet when
+    a blank row is encountered.
+    """
+    from openpyxl import load_workbook
+    workbook = load_workbook(path, read_only=True)
+    try:
+        rows = workbook.worksheets[0].iter_rows()
+        keys = [cell.value for cell in next(rows)]
+        for row in rows:
+            vals = [cell.value for cell in row]
+            if not any(val not in (None, '') for val in vals):
+                return
+            yield split_params(
+                {k: v for (k, v) in zip(keys, vals) if k is not None}
+            )
+    finally:
+        workbook.close()
+
+
+READERS = {
+    'json': _read_json,
+    'jsonl': _read_jsonl,
+    'csv': _read_csv,
+    'tsv': partial(_read_csv, delimiter='\t'),
+    'xlsx': _read_xlsx
+}
+
+
 def cmgs_from_file(env, path, filetype=None):
     """
     Generate compound group objects from a file.
@@ -51,6 +160,14 @@ def cmgs_from_file(env, path, filetype=None):
     group are imported from the file. Importing lists of compounds for already
     populated groups is *not supported.*
 
+    Supported file types are JSON (an array, as written by
+    :func:`commongroups.googlesheet.SheetManager.params_to_json`), JSON Lines
+    (``jsonl``, one such item per line), and spreadsheets (``csv``, ``tsv``,
+    ``xlsx``) with a header row, in which the :data:`BASE_PARAMS` columns are
+    read as parameters and any other columns as info. Except for JSON, files
+    are read incrementally, so groups are generated before the whole file has
+    been parsed. Each definition is validated as it is read.
+
     Parameters:
         env (:class:`commongroups.env.CommonEnv`): The project environment.
             Determines the environment used for the :class:`CMGroup` objects.
@@ -61,19 +178,306 @@ def cmgs_from_file(env, path, filetype=None):
 
     Yields:
         :class:`commongroups.cmgroup.CMGroup` objects.
+
+    Raises:
+        :class:`commongroups.errors.MissingParamError`: If a definition lacks
+            any of the :data:`BASE_PARAMS`.
     """
     filetype = filetype or path.split('.')[-1]
     filetype = filetype.lower()
     path = abspath(path)
-    logger.debug('Reading group parameters from %s', path)
-    if filetype == 'json':
-        with open(path, 'r') as json_file:
-            many_params = json.load(json_file)
-    else:
+    if filetype not in READERS:
         raise NotImplementedError(
             'File type unsupported: {}'.format(filetype))
-    for item in many_params:
-        yield CMGroup(env, item['params'], item['info'])
+    logger.debug('Reading group parameters from %s', path)
+    for num, item in enumerate(READERS[filetype](path), start=1):
+        try:
+            validate_params(item['params'])
+        except MissingParamError:
+            logger.error('Invalid group definition #%i in %s', num, path)
+            raise
+        yield CMGroup(env, item['params'], item.get('info'))
+
+
+def detect_parents(cmgs):
+    """
+    Infer parent groups by comparing group definitions.
+
+    For each group without a declared ``parent``, look for other groups whose
+    query structure is provably contained in this group's structure, so that
+    every member of this group must also be a member of the other. Of these,
+    the most specific (largest) structure is taken as the parent. Only plain
+    substructure searches are compared (see
+    :func:`commongroups.query.substructure_mol`). Requires RDKit.
+
+    A parent may be defined after its child, so all definitions are read into
+    memory first: a stream of definitions is materialized as a list, and a
+    warning is logged for more than ``DETECT_PARENTS_WARN`` groups, whose
+    structures are compared pairwise.
+
+    Parameters:
+        cmgs (iterable): :class:`commongroups.cmgroup.CMGroup` objects.
+
+    Returns:
+        List of the same compound groups, with parents set where detected.
+    """
+    if not isinstance(cmgs, list):
+        cmgs = list(cmgs)
+        logger.info('Read %i group definitions to detect parent groups',
+                    len(cmgs))
+    if len(cmgs) > DETECT_PARENTS_WARN:
+        logger.warning('Detecting parent groups among %i groups; all '
+                       'definitions are held in memory and compared '
+                       'pairwise', len(cmgs))
+    try:
+        mols = [substructure_mol(cmg.params) for cmg in cmgs]
+    except ImportError:
+        logger.warning('RDKit is not available; cannot detect parent groups')
+        return cmgs
+    sizes = [(mol.GetNumAtoms(), mol.GetNumBonds()) if mol else None
+             for mol in mols]
+    for i, cmg in enumerate(cmgs):
+        if not mols[i] or cmg.parent:
+            continue
+        best = None
+        for j, mol in enumerate(mols):
+            # A parent must be strictly smaller, or an identical structure
+            # that appears earlier, so that parents can never form a cycle.
+            if (not mol or j == i or sizes[j] > sizes[i]
+                    or (sizes[j] == sizes[i] and j > i)):
+                continue
+            if best is not None and sizes[j] <= sizes[best]:
+                continue
+            if mols[i].HasSubstructMatch(mol):
+                best = j
+        if best is not None:
+            cmg.set_detected_parent(cmgs[best].cmg_id)
+    return cmgs
+
+
+def dependency_order(cmgs, done):
+    """
+    Generate compound groups such that each follows its dependencies.
+
+    Groups are generated in the given order, except that a group is deferred
+    until all the groups it depends on are found in ``done``, which the caller
+    is expected to update as it processes each group. This works with
+    generators of any length. Groups with dependencies that never appear are
+    generated at the end, with a warning.
+
+    Parameters:
+        cmgs (iterable): :class:`commongroups.cmgroup.CMGroup` objects.
+        done (dict): Processed groups, keyed by ``cmg_id``.
+
+    Yields:
+        :class:`commongroups.cmgroup.CMGroup` objects.
+    """
+    waiting = []
+
+    def ready():
+        while True:
+            for cmg in waiting:
+                if all(dep in done for dep in cmg.dependencies):
+                    waiting.remove(cmg)
+                    break
+            else:
+                return
+            yield cmg
+
+    for cmg in cmgs:
+        waiting.append(cmg)
+        yield from ready()
+    for cmg in list(waiting):
+        logger.warning('Unresolved dependencies of %s: %s', cmg,
+                       [dep for dep in cmg.dependencies if dep not in done])
+        yield cmg
+
+
+def start_manifest(env, filename=None):
+    """
+    Start a new, empty JSON Lines manifest of processed compound groups.
+
+    The manifest (``cmgroups.jsonl`` in the environment's ``results``
+    directory, unless otherwise specified) is an append-only record with one
+    line of parameters and info per group, written as each group completes.
+
+    Parameters:
+        env (:class:`commongroups.env.CommonEnv`): Project environment.
+        filename (str): Optional alternative filename.
+
+    Returns:
+        Path to the manifest file.
+    """
+    path = pjoin(env.results_path, filename or MANIFEST)
+    logger.info('Starting manifest: %s', path)
+    open(path, 'w').close()
+    return path
+
+
+def append_to_manifest(cmg, env, filename=None):
+    """
+    Append a compound group's parameters and info to the manifest.
+
+    Each record is flushed to disk before returning, so the manifest always
+    reflects every group completed so far, even if the run is interrupted.
+
+    Parameters:
+        cmg: :class:`commongroups.cmgroup.CMGroup` object, or a dict of its
+            parameters and info.
+        env (:class:`commongroups.env.CommonEnv`): Project environment.
+        filename (str): Optional alternative filename.
+    """
+    path = pjoin(env.results_path, filename or MANIFEST)
+    record = cmg if isinstance(cmg, dict) else cmg.to_dict()
+    with open(path, 'a') as manifest:
+        manifest.write(json.dumps(record, sort_keys=True) + '\n')
+        manifest.flush()
+        os.fsync(manifest.fileno())
+
+
+def read_manifest(env, filename=None):
+    """
+    Read records of processed compound groups from the manifest, lazily.
+
+    An incomplete last line, as left by a crash in the middle of a write, is
+    skipped with a warning.
+
+    Parameters:
+        env (:class:`commongroups.env.CommonEnv`): Project environment.
+        filename (str): Optional alternative filename.
+
+    Yields:
+        Dicts of parameters and info, one for each group.
+    """
+    path = pjoin(env.results_path, filename or MANIFEST)
+    logger.debug('Reading manifest: %s', path)
+    with open(path, 'r') as manifest:
+        for line in manifest:
+            if not line.strip():
+                continue
+            try:
+                yield json.loads(line)
+            except ValueError:
+                logger.warning('Skipping incomplete manifest record: %s',
+                               line.strip())
+
+
+def params_hash(params):
+    """Return a SHA-256 hex digest of a group's parameters."""
+    text = json.dumps(params, sort_keys=True)
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def file_hash(path):
+    """Return a SHA-256 hex digest of a file's contents, read in blocks."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as data:
+        for block in iter(partial(data.read, 2**20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def output_files(cmg):
+    """Return the paths of the per-group output files of a compound group."""
+    return [pjoin(cmg.results_path, '{}.xlsx'.format(cmg.cmg_id)),
+            pjoin(cmg.results_path, '{}.json'.format(cmg.cmg_id)),
+            pjoin(cmg.results_path, 'members', '{}.txt'.format(cmg.cmg_id)),
+            pjoin(cmg.results_path, 'html', '{}.html'.format(cmg.cmg_id))]
+
+
+def start_journal(env):
+    """
+    Start a new, empty checkpoint journal of completed compound groups.
+
+    The journal (``journal.jsonl`` in the environment's ``data`` directory)
+    records, for each group completed in a run, a hash of its parameters and
+    of each of its output files, so that a later run can resume where this one
+    left off (see :func:`batch_process`).
+
+    Returns:
+        Path to the journal file.
+    """
+    path = pjoin(env.data_path, JOURNAL)
+    logger.info('Starting journal: %s', path)
+    open(path, 'w').close()
+    return path
+
+
+def append_to_journal(cmg, env):
+    """
+    Record the completion of a compound group in the checkpoint journal.
+
+    The record is flushed to disk before returning.
+
+    Parameters:
+        cmg (:class:`commongroups.cmgroup.CMGroup`): Group whose output has
+            been written.
+        env (:class:`commongroups.env.CommonEnv`): Project environment.
+    """
+    record = {
+        'cmg_id': cmg.cmg_id,
+        'params_hash': params_hash(cmg.params),
+        'outputs': {os.path.relpath(path, cmg.results_path): file_hash(path)
+                    for path in output_files(cmg)},
+        'info': cmg.info,
+        'time': datetime.now().isoformat()
+    }
+    path = pjoin(env.data_path, JOURNAL)
+    with open(path, 'a') as journal:
+        journal.write(json.dumps(record, sort_keys=True) + '\n')
+        journal.flush()
+        os.fsync(journal.fileno())
+
+
+def read_journal(env):
+    """
+    Read the checkpoint journal of an earlier run.
+
+    Returns:
+        Dict of the latest journal record of each group, keyed by ``cmg_id``.
+        Empty if there is no journal.
+    """
+    path = pjoin(env.data_path, JOURNAL)
+    records = {}
+    if not os.path.exists(path):
+        logger.warning('No journal to resume from: %s', path)
+        return records
+    with open(path, 'r') as journal:
+        for line in journal:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                logger.warning('Skipping incomplete journal record: %s',
+                               line.strip())
+                continue
+            records[record['cmg_id']] = record
+    return records
+
+
+def is_complete(cmg, record, updated=None):
+    """
+    Check whether a journal record shows a compound group to be complete.
+
+    The group is complete if its parameters are unchanged, all of its output
+    files are still those written when the record was made, and none of the
+    groups it depends on (its parent, or the groups in its set expression) has
+    been processed again since.
+
+    Parameters:
+        cmg (:class:`commongroups.cmgroup.CMGroup`): Group to check.
+        record (dict): Journal record of the group, or ``None``.
+        updated (set): Optional IDs of groups processed again in this run.
+    """
+    if not record or record['params_hash'] != params_hash(cmg.params):
+        return False
+    if updated and any(dep in updated for dep in cmg.dependencies):
+        return False
+    for path in output_files(cmg):
+        key = os.path.relpath(path, cmg.results_path)
+        if not os.path.exists(path) or \
+                file_hash(path) != record['outputs'].get(key):
+            return False
+    return True
 
 
 def collect_to_json(cmgs, env, filename=None):
@@ -81,49 +485,309 @@ def collect_to_json(cmgs, env, filename=None):
     Write parameters and info for a number of compound groups to a JSON file.
 
     The output is written to ``cmgroups.json`` (or other filename if specified)
-    in the project environment's ``results`` directory.
+    in the project environment's ``results`` directory. Groups are serialized
+    one at a time, so ``cmgs`` may be a generator of any length, and the output
+    replaces the existing file atomically once complete, if it has changed
+    (see :mod:`commongroups.outputs`).
 
     Parameters:
-        cmgs (iterable): :class:`commongroups.cmgroup.CMGroup` objects to write.
+        cmgs (iterable): :class:`commongroups.cmgroup.CMGroup` objects to
+            write, or dicts of their parameters and info.
         env (:class:`commongroups.env.CommonEnv`): Project environment.
         filename (str): Optional alternative filename.
     """
     filename = filename or 'cmgroups.json'
-    cmg_data = [cmg.to_dict() for cmg in cmgs]
     path = pjoin(env.results_path, filename)
     logger.info('Writing JSON file: %s', path)
-    with open(path, 'w') as json_file:
-        json.dump(cmg_data, json_file, indent=2, sort_keys=True)
+    with output_file(path, env.results_path, text_mode=True) as json_file:
+        json_file.write('[')
+        sep = '\n'
+        for cmg in cmgs:
+            record = cmg if isinstance(cmg, dict) else cmg.to_dict()
+            text = json.dumps(record, indent=2, sort_keys=True)
+            json_file.write(sep + indent(text, '  '))
+            sep = ',\n'
+        json_file.write('\n]\n')
+
+
+def collect_from_manifest(env, filename=None):
+    """
+    Build the aggregate outputs of a run by streaming over its manifest.
+
+    Writes ``cmgroups.json`` and the HTML directory (``html/index.html``) in
+    the environment's ``results`` directory. This also recovers aggregate
+    output from the groups that completed before an interrupted run.
+
+    Parameters:
+        env (:class:`commongroups.env.CommonEnv`): Project environment.
+        filename (str): Optional alternative manifest filename.
+    """
+    collect_to_json(read_manifest(env, filename), env)
+    directory(read_manifest(env, filename), env)
+
+
+def log_group(cmg, status, timings=None, **data):
+    """
+    Log a structured record of the processing of a compound group.
+
+    If the ``log_json`` option is set, these records are written to a JSON
+    Lines file in the project's log directory (see
+    :class:`commongroups.env.CommonEnv`).
+
+    Parameters:
+        cmg (:class:`commongroups.cmgroup.CMGroup`): Compound group.
+        status (str): Outcome, e.g. ``processed``, ``restored``, ``failed``.
+        timings (dict): Durations of processing steps, in seconds, keyed by
+            the name of the step.
+        data: Other items to include in the record.
+    """
+    timings = timings or {}
+    record = {'cmg_id': cmg.cmg_id,
+              'status': status,
+              'method': cmg.params.get('method'),
+              'count': cmg.info.get('count')}
+    record.update({'{}_seconds'.format(step): round(seconds, 4)
+                   for step, seconds in timings.items()})
+    record.update(data)
+    logger.info('%s %s: %s compounds in %.2f s', status.capitalize(),
+                cmg.cmg_id, record['count'], sum(timings.values()),
+                extra={'record': record})
 
 
-def batch_process(cmgs, env):
+def batch_process(cmgs, env, memory_limit=None, resume=False):
     """
     Process compound groups in a given environment and output all results.
 
     Use the database connection provided by the environment. Output results to
-    Excel (compound lists and group info) and JSON (group parameters and info).
-    Create a browseable HTML directory of all groups & results.
+    Excel (compound lists and group info), JSON (group parameters and info),
+    and sorted lists of member IDs (see :func:`CMGroup.to_members`).
+    Record each group in the run's manifest as soon as it is complete, then
+    create the collected JSON file and a browseable HTML directory of all
+    groups & results from the manifest.
+
+    If a memory limit is given (or configured as ``memory_limit`` in the
+    environment), compound data are spilled to the project ``data`` directory
+    after output, oldest groups first, whenever the data held in memory exceed
+    the limit. A limit of ``0`` releases each group's data right away. Spilled
+    data are reloaded on demand through :attr:`CMGroup.compounds`.
+
+    Groups that have a parent group are processed after their parent, and
+    only the members of the parent are evaluated for these groups. If
+    ``detect_parents`` is set in the environment's configuration, parent groups
+    are also inferred from the definitions (see :func:`detect_parents`). This
+    reads all group definitions before the first query, so a stream of
+    definitions is no longer processed as it is read.
+
+    Each completed group is recorded in a checkpoint journal. If ``resume`` is
+    true, groups that were completed according to the journal of an earlier
+    run, with the same parameters and unchanged output files, are not processed
+    again; their earlier output is reused (see :func:`is_complete`).
+
+    At the end, the inverted index of compounds to groups is built from the
+    groups of this run (see :func:`commongroups.invindex.build_index`); when
+    resuming, only the entries of groups processed in this run are updated.
+
+    If ``overlap`` is set in the environment's configuration, the overlap
+    between all groups is analyzed at the end (see
+    :func:`commongroups.overlap.analyze_overlap`).
+
+    If ``prewarm`` is set in the environment's configuration, the database's
+    cache is loaded first (see :func:`CommonEnv.prewarm_database`).
+
+    If ``optimize_queries`` is set in the environment's configuration, queries
+    are rewritten to use precomputed descriptors where possible (see
+    :func:`commongroups.query.optimize_where`). Set it to ``"check"`` to verify
+    that each rewritten query gives the same results as the original.
+
+    If ``snapshot`` is set in the environment's configuration, the compounds'
+    identifiers and names are joined to query results from a snapshot, which
+    is exported first if it does not match the database build (see
+    :mod:`commongroups.snapshot`).
+
+    If ``preflight`` is set in the environment's configuration, all group
+    definitions are checked before any query is executed (see
+    :mod:`commongroups.preflight`). Groups that fail are excluded, or if
+    ``preflight`` is ``"abort"``, the run stops.
+
+    Progress, throughput, and the time and memory taken by each stage are
+    reported as metrics while the run goes on (see :mod:`commongroups.metrics`
+    and :func:`commongroups.metrics.reporter_from_env`).
 
     Parameters:
         cmgs (iterable): :class:`commongroups.cmgroup.CMGroup` objects to
             process.
         env (:class:`commongroups.env.CommonEnv`): Environment.
+        memory_limit (float): Optional ceiling, in megabytes, on compound data
+            held in memory.
+        resume (bool): Whether to skip groups completed in an earlier run.
 
     Returns:
-        List of processed compound groups.
+        List of processed (or restored) compound groups.
+
+    Raises:
+        :class:`commongroups.errors.PreflightError`: If ``preflight`` is
+            ``"abort"`` and any group definition fails the checks.
     """
-    if not env.database:
-        env.connect_database()
+    with metrics.reporter_from_env(env):
+        if not env.database:
+            env.connect_database()
+        if env.config.get('prewarm'):
+            env.prewarm_database()
 
-    processed_cmgs = []
+        if memory_limit is None:
+            memory_limit = env.config.get('memory_limit')
+        if memory_limit is not None:
+            memory_limit = float(memory_limit) * 2**20
+            logger.info('Memory-bounded processing: limit %.0f bytes',
+                        memory_limit)
 
-    for cmg in cmgs:
-        cmg.process(env.database)
-        cmg.to_excel()
-        cmg.to_json()
-        cmg.to_html(formats=['xlsx', 'json'])
-        processed_cmgs.append(cmg)
-
-    collect_to_json(processed_cmgs, env)
-    directory(processed_cmgs, env)
-    return processed_cmgs
+        if env.config.get('preflight'):
+            with metrics.stage('preflight'):
+                cmgs = preflight_groups(
+                    cmgs, env, abort=env.config['preflight'] == 'abort')
+        if env.config.get('detect_parents'):
+            cmgs = detect_parents(cmgs)
+        optimize = env.config.get('optimize_queries', False)
+        snapshot = None
+        if env.config.get('snapshot'):
+            snapshot = current_snapshot(env, export=True)
+
+        processed_cmgs = []
+        updated = []
+        updated_ids = set()
+        done = {}
+        in_memory = deque()
+        held = 0
+        start_manifest(env)
+        if resume:
+            journal = read_journal(env)
+        else:
+            journal = {}
+            start_journal(env)
+
+        if hasattr(cmgs, '__len__'):
+            metrics.GROUPS_PLANNED.set(len(cmgs))
+        for cmg in dependency_order(cmgs, done):
+            record = journal.get(cmg.cmg_id)
+            if resume and is_complete(cmg, record, updated_ids):
+                logger.info('Already complete: %s', cmg)
+                cmg.restore(record['info'])
+                log_group(cmg, 'restored')
+                metrics.GROUPS.inc(status='restored')
+            else:
+                started = time.perf_counter()
+                with metrics.stage('query'):
+                    cmg.process(env.database, deps=done, optimize=optimize,
+                                snapshot=snapshot)
+                queried = time.perf_counter()
+                with metrics.stage('output'):
+                    cmg.to_excel()
+                    cmg.to_json()
+                    cmg.to_members()
+                    cmg.to_html(formats=['xlsx', 'json'])
+                    append_to_journal(cmg, env)
+                updated.append(cmg.cmg_id)
+                updated_ids.add(cmg.cmg_id)
+                log_group(cmg, 'processed',
+                          {'query': queried - started,
+                           'output': time.perf_counter() - queried})
+                metrics.GROUPS.inc(status='processed')
+            append_to_manifest(cmg, env)
+            processed_cmgs.append(cmg)
+            done[cmg.cmg_id] = cmg
+
+            if memory_limit is not None:
+                in_memory.append(cmg)
+                held += cmg.memory_usage()
+                while in_memory and held > memory_limit:
+                    held -= in_memory.popleft().spill()
+
+        with metrics.stage('collect'):
+            collect_from_manifest(env)
+            cmg_ids = [cmg.cmg_id for cmg in processed_cmgs]
+            build_index(env.results_path, updated if resume else None,
+                        groups=cmg_ids)
+        if env.config.get('overlap'):
+            with metrics.stage('overlap'):
+                analyze_overlap(env.results_path, groups=cmg_ids)
+        return processed_cmgs
+
+
+def count_groups(cmgs, env, mode='count', filename=None):
+    """
+    Count the compounds in compound groups, without retrieving them.
+
+    For a quick triage of group definitions, each group's query is only
+    counted, or in ``'estimate'`` mode, its number of compounds is estimated
+    (see :meth:`commongroups.cmgroup.CMGroup.count`). If ``estimate_sample``
+    is set in the environment's configuration, estimates count a sample of
+    that percentage of the compounds, rather than asking the query planner.
+    Groups are counted concurrently, using the connections of the database
+    pool. A group whose query fails is logged, and not counted.
+
+    No output files are written for the groups themselves; instead, a summary
+    table of all groups (:data:`COUNT_FIELDS`) is written to ``counts.csv``
+    (or other filename if specified) in the project environment's ``results``
+    directory.
+
+    Parameters:
+        cmgs (iterable): :class:`commongroups.cmgroup.CMGroup` objects.
+        env (:class:`commongroups.env.CommonEnv`): Environment.
+        mode (str): ``'count'`` or ``'estimate'``.
+        filename (str): Optional alternative filename.
+
+    Returns:
+        List of the compound groups, with ``count`` in their ``info``.
+    """
+    with metrics.reporter_from_env(env):
+        if not env.database:
+            env.connect_database()
+        if hasattr(cmgs, '__len__'):
+            metrics.GROUPS_PLANNED.set(len(cmgs))
+        optimize = bool(env.config.get('optimize_queries', False))
+        sample = env.config.get('estimate_sample')
+
+        def count(cmg):
+            started = time.perf_counter()
+            try:
+                num = cmg.count(env.database, mode, optimize=optimize,
+                                sample=sample)
+            except Exception as exc:  # pylint: disable=broad-except
+                logger.error('Failed to count %s: %r', cmg, exc)
+                cmg.add_info({'count': None, 'count_mode': mode})
+                metrics.GROUPS.inc(status='failed')
+                return cmg
+            if num is None:
+                logger.info('Not counted: %s', cmg)
+            else:
+                logger.info('%s %s: %i compounds in %.2f s',
+                            'Estimated' if mode == 'estimate' else 'Counted',
+                            cmg.cmg_id, num, time.perf_counter() - started)
+            metrics.GROUPS.inc(status=mode)
+            return cmg
+
+        workers = pool_size(env.database)
+        counted = []
+        pending = deque()
+        path = pjoin(env.results_path, filename or COUNTS)
+        logger.info('Writing count summary: %s', path)
+        with output_file(path, env.results_path, text_mode=True) as csv_file, \
+                ThreadPoolExecutor(max_workers=workers) as pool:
+            writer = csv.DictWriter(csv_file, COUNT_FIELDS)
+            writer.writeheader()
+            # Definitions are read only as far as the groups being counted, so
+            # that counting starts while a long file is still being read.
+            cmgs = iter(cmgs)
+            while True:
+                for cmg in islice(cmgs, 2 * workers - len(pending)):
+                    pending.append(pool.submit(count, cmg))
+                if not pending:
+                    break
+                cmg = pending.popleft().result()
+                writer.writerow({'cmg_id': cmg.cmg_id,
+                                 'name': cmg.params.get('name'),
+                                 'method': cmg.params.get('method'),
+                                 'count': cmg.info.get('count'),
+                                 'count_mode': mode})
+                counted.append(cmg)
+        return counted
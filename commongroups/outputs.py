@@ -0,0 +1,255 @@
+# coding: utf-8
+
+"""
+Writing output files only when their content changes.
+
+Every output file under a ``results`` directory is written through
+:func:`output_file`, which computes a SHA-256 hash of the content as it is
+written and compares it with the hash recorded when the file was last written.
+Unchanged files are left untouched, so that their modification times stay the
+same for tools like ``rsync`` and web caches; changed files are replaced
+atomically.
+
+The hashes are recorded in ``checksums.jsonl`` in the ``results`` directory,
+a change index: each line, with the keys ``path`` (relative to ``results``),
+``sha256``, ``size``, and ``time``, records a file that was created or
+changed. The last line for a path describes its current content. Lines are
+appended under an exclusive lock on the file, which is held while deciding
+whether to replace an output file, so that several processes (e.g. workers
+sharing a work queue) can write to the same ``results`` directory. When the
+index has grown to :data:`COMPACT_RATIO` times as many lines as files, it is
+rewritten with only the last line for each path.
+"""
+
+from contextlib import contextmanager
+from datetime import datetime
+import hashlib
+import io
+import json
+import logging
+import os
+from os.path import exists, getsize, join as pjoin, relpath, splitext
+import time
+
+from boltons.fileutils import atomic_save
+
+from commongroups import metrics
+from commongroups import logconf  # pylint: disable=unused-import
+logger = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+try:
+    import fcntl
+except ImportError:  # Not available on Windows.
+    fcntl = None  # pylint: disable=invalid-name
+
+CHECKSUMS = 'checksums.jsonl'
+
+# Ratio of lines to files in the change index at which it is compacted.
+COMPACT_RATIO = 2
+
+# Change indexes that have been read, keyed by path of the index file: the
+# index itself, and the inode, length read, and number of lines of the file.
+_INDEXES = {}
+
+
+class _HashingWriter(io.RawIOBase):
+    """Binary stream that hashes all data written through it to a file."""
+    def __init__(self, raw):
+        super().__init__()
+        self.raw = raw
+        self.digest = hashlib.sha256()
+        self.size = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.digest.update(data)
+        self.size += len(data)
+        return self.raw.write(data)
+
+
+def read_checksums(results_path):
+    """
+    Read the change index of a results directory.
+
+    Returns:
+        Dict of the latest record of each file, keyed by relative path.
+    """
+    path = pjoin(results_path, CHECKSUMS)
+    index = {}
+    if not exists(path):
+        return index
+    with open(path, 'rb') as checksums:
+        _read_records(checksums, index)
+    return index
+
+
+def _read_records(checksums, index):
+    """
+    Read records from a change index file into a dict, keyed by path.
+
+    Returns:
+        The length in bytes and the number of the complete lines read. A last
+        line without a newline, which is still being written, is not read.
+    """
+    length = lines = 0
+    for line in checksums:
+        if not line.endswith(b'\n'):
+            break
+        length += len(line)
+        lines += 1
+        try:
+            record = json.loads(line.decode('utf-8'))
+        except ValueError:
+            logger.warning('Skipping incomplete checksum record: %s',
+                           line.strip())
+            continue
+        index[record['path']] = record
+    return length, lines
+
+
+def _get_index(results_path):
+    """
+    Return the current change index of a results directory.
+
+    The index is cached, and brought up to date with the records appended
+    since it was last read, e.g. by other processes. If the file has been
+    replaced (compacted), it is read again.
+    """
+    path = pjoin(results_path, CHECKSUMS)
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        _INDEXES.pop(path, None)
+        return {}
+    cached = _INDEXES.get(path)
+    if cached is None or cached['inode'] != stat.st_ino \
+            or cached['length'] > stat.st_size:
+        cached = _INDEXES[path] = {'index': {}, 'inode': stat.st_ino,
+                                   'length': 0, 'lines': 0}
+    if cached['length'] < stat.st_size:
+        with open(path, 'rb') as checksums:
+            checksums.seek(cached['length'])
+            length, lines = _read_records(checksums, cached['index'])
+        cached['length'] += length
+        cached['lines'] += lines
+    return cached['index']
+
+
+@contextmanager
+def _locked_index(results_path):
+    """
+    Hold an exclusive lock on the change index of a results directory.
+
+    Yields:
+        The index file, opened for appending.
+    """
+    path = pjoin(results_path, CHECKSUMS)
+    while True:
+        checksums = open(path, 'a')
+        if fcntl is None:
+            break
+        fcntl.flock(checksums.fileno(), fcntl.LOCK_EX)
+        # Another process may have replaced the file while we waited.
+        if exists(path) and \
+                os.stat(path).st_ino == os.fstat(checksums.fileno()).st_ino:
+            break
+        checksums.close()
+    try:
+        yield checksums
+    finally:
+        checksums.close()
+
+
+def _record_change(results_path, checksums, record):
+    """
+    Add a record to the change index, whose lock is held.
+
+    The record is appended to the file, or if the file has grown to
+    :data:`COMPACT_RATIO` times as many lines as files, the file is replaced
+    with the last record of each file.
+    """
+    index = _get_index(results_path)
+    index[record['path']] = record
+    path = pjoin(results_path, CHECKSUMS)
+    cached = _INDEXES[path]
+    if cached['lines'] + 1 < COMPACT_RATIO * len(index):
+        checksums.write(json.dumps(record, sort_keys=True) + '\n')
+        checksums.flush()
+        return
+    logger.debug('Compacting change index: %s', path)
+    with atomic_save(path, text_mode=True) as compacted:
+        for item in index.values():
+            compacted.write(json.dumps(item, sort_keys=True) + '\n')
+    _INDEXES.pop(path, None)
+
+
+@contextmanager
+def output_file(path, results_path, text_mode=False):
+    """
+    Write an output file, replacing the existing file only if it has changed.
+
+    Content is written to a temporary file next to ``path`` and hashed along
+    the way. If the hash and size equal those recorded for the existing file,
+    the temporary file is discarded; otherwise it is moved into place
+    atomically and the change is recorded in the index.
+
+    Parameters:
+        path (str): Path of the output file.
+        results_path (str): The ``results`` directory containing the file.
+        text_mode (bool): Whether to yield a text (UTF-8) rather than binary
+            file object.
+
+    Yields:
+        File object to write to.
+    """
+    kind = splitext(path)[1].lstrip('.') or 'other'
+    started = time.perf_counter()
+    part = '{0}.{1}.part'.format(path, os.getpid())
+    with open(part, 'wb') as raw:
+        sink = _HashingWriter(raw)
+        stream = io.BufferedWriter(sink)
+        if text_mode:
+            stream = io.TextIOWrapper(stream, encoding='utf-8')
+        try:
+            yield stream
+        except BaseException:
+            stream.close()
+            raw.close()
+            os.remove(part)
+            raise
+        stream.close()
+        raw.flush()
+        os.fsync(raw.fileno())
+    metrics.WRITTEN_BYTES.inc(sink.size, kind=kind)
+    key = relpath(path, results_path)
+    sha256 = sink.digest.hexdigest()
+    with _locked_index(results_path) as checksums:
+        last = _get_index(results_path).get(key)
+        if last and last['sha256'] == sha256 and exists(path) \
+                and getsize(path) == last['size']:
+            logger.debug('Unchanged, not replaced: %s', path)
+            os.remove(part)
+        else:
+            os.replace(part, path)
+            _record_change(results_path, checksums,
+                           {'path': key,
+                            'sha256': sha256,
+                            'size': sink.size,
+                            'time': datetime.now().isoformat()})
+    metrics.WRITE_SECONDS.observe(time.perf_counter() - started, kind=kind)
+
+
+def save_output(path, results_path, content):
+    """
+    Write content to an output file if it has changed; see :func:`output_file`.
+
+    Parameters:
+        path (str): Path of the output file.
+        results_path (str): The ``results`` directory containing the file.
+        content (str or bytes): Content of the file.
+    """
+    text_mode = isinstance(content, str)
+    with output_file(path, results_path, text_mode=text_mode) as out:
+        out.write(content)
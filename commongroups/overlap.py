@@ -0,0 +1,276 @@
+# coding: utf-8
+
+"""
+Overlap analysis of the members of compound groups.
+
+The members of each group are read from the sorted member lists in the
+``members`` subdirectory of a results directory (see
+:func:`commongroups.cmgroup.CMGroup.to_members`), mapped onto a shared index
+of all compounds, and encoded as bitsets, packed 64 compounds to a word.
+The size of the intersection of every pair of groups is then computed with
+vectorized bitwise operations and population counts, in blocks of rows spread
+across parallel processes, which read the bitsets from a memory-mapped file.
+
+From the intersections follow the Jaccard similarity of each pair of groups,
+and whether one group is contained in (nested in) the other, which can help to
+spot redundant or inconsistent group definitions.
+
+Usage::
+
+   python -m commongroups.overlap <results> [-j <processes>]
+"""
+
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import csv
+import io
+import logging
+from os.path import join as pjoin
+import tempfile
+
+import numpy as np
+
+from commongroups.diff import group_ids, read_members, MEMBERS_DIR
+from commongroups.hypertext import render
+from commongroups.outputs import save_output
+from commongroups import logconf  # pylint: disable=unused-import
+logger = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+# Number of set bits in each possible byte value, for versions of numpy
+# without ``bitwise_count``.
+POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+# Number of rows of the overlap matrix computed by each task, and the numbers
+# of columns and of 64-bit words of each bitset (64 compounds each) per step,
+# which bound the memory used per step (rows * columns * words * 8 bytes).
+BLOCK_ROWS = 16
+BLOCK_COLS = 256
+BLOCK_WORDS = 256
+
+PAIR_FIELDS = ['cmg_id_a', 'cmg_id_b', 'size_a', 'size_b', 'overlap',
+               'jaccard', 'relation']
+
+
+def read_groups(results_path, groups=None):
+    """
+    Read the member lists of the groups of a run.
+
+    Parameters:
+        results_path (str): Results directory of the run.
+        groups (iterable): Optional IDs of the groups; by default, those of
+            the run (see :func:`commongroups.diff.run_group_ids`).
+
+    Returns:
+        List of group IDs, and list of lists of member IDs, in the same order.
+    """
+    ids = group_ids(results_path) if groups is None else sorted(set(groups))
+    members = [list(read_members(pjoin(results_path, MEMBERS_DIR,
+                                       '{}.txt'.format(cmg_id))))
+               for cmg_id in ids]
+    return ids, members
+
+
+def encode_bitsets(members):
+    """
+    Encode group memberships as packed bitsets over a shared compound index.
+
+    Parameters:
+        members (list): Lists of the member IDs of each group.
+
+    Returns:
+        Tuple of the shared index (sorted list of all compound IDs) and a
+        ``uint64`` array with one row of packed bits per group, in which bit
+        ``k`` is set if the group contains compound ``k`` of the index.
+    """
+    index = sorted(set().union(*members))
+    position = {key: pos for pos, key in enumerate(index)}
+    width = -(-len(index) // 64)
+    bitsets = np.zeros((len(members), width), dtype=np.uint64)
+    bits = np.zeros(width * 64, dtype=bool)
+    for row, ids in enumerate(members):
+        bits[:] = False
+        bits[np.array(list(map(position.__getitem__, ids)),
+                      dtype=np.int64)] = True
+        bitsets[row] = np.packbits(bits).view(np.uint64)
+    return index, bitsets
+
+
+def popcount(words):
+    """Count the set bits in each element of a ``uint64`` array."""
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(words)
+    return POPCOUNT[words.view(np.uint8)].reshape(words.shape + (8,)).sum(-1)
+
+
+# Bitsets opened by a worker process, keyed by path of their file.
+_BITSETS = {}
+
+
+def _load_bitsets(path):
+    """Open the bitsets saved to a file, memory-mapped, once per process."""
+    if path not in _BITSETS:
+        _BITSETS.clear()
+        _BITSETS[path] = np.load(path, mmap_mode='r')
+    return _BITSETS[path]
+
+
+def _overlap_block(path, start, stop):
+    """
+    Count the intersections of rows ``start:stop`` with rows ``start:``.
+
+    Parameters:
+        path (str): File of the bitsets, saved by :func:`numpy.save`.
+    """
+    bitsets = _load_bitsets(path)
+    num, width = bitsets.shape
+    rows = np.asarray(bitsets[start:stop])
+    counts = np.zeros((stop - start, num - start), dtype=np.int64)
+    for first in range(start, num, BLOCK_COLS):
+        last = min(first + BLOCK_COLS, num)
+        for word in range(0, width, BLOCK_WORDS):
+            block = np.bitwise_and(
+                rows[:, None, word:word + BLOCK_WORDS],
+                bitsets[None, first:last, word:word + BLOCK_WORDS])
+            counts[:, first - start:last - start] += \
+                popcount(block).sum(axis=2, dtype=np.int64)
+    return counts
+
+
+def overlap_matrix(bitsets, workers=None):
+    """
+    Compute the sizes of the intersections of all pairs of bitsets.
+
+    Blocks of :data:`BLOCK_ROWS` rows of the upper triangle of the matrix are
+    computed in parallel processes, :data:`BLOCK_COLS` columns and
+    :data:`BLOCK_WORDS` words at a time. The bitsets are passed to the
+    processes as a temporary file, which each process maps into memory.
+
+    Parameters:
+        bitsets (numpy.ndarray): Packed bitsets, one row per group, as returned
+            by :func:`encode_bitsets`.
+        workers (int): Number of processes; defaults to the number of CPUs.
+
+    Returns:
+        Square, symmetric ``int64`` array of intersection sizes; the diagonal
+        holds the sizes of the groups.
+    """
+    num = len(bitsets)
+    matrix = np.zeros((num, num), dtype=np.int64)
+    blocks = [(start, min(start + BLOCK_ROWS, num))
+              for start in range(0, num, BLOCK_ROWS)]
+    with tempfile.TemporaryDirectory() as tmp_path:
+        path = pjoin(tmp_path, 'bitsets.npy')
+        np.save(path, bitsets)
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(_overlap_block, path, start, stop)
+                       for start, stop in blocks]
+            for (start, stop), future in zip(blocks, futures):
+                block = future.result()
+                matrix[start:stop, start:] = block
+                matrix[start:, start:stop] = block.T
+    return matrix
+
+
+def overlap_pairs(ids, matrix):
+    """
+    Summarize each pair of groups that have members in common.
+
+    Parameters:
+        ids (list): Group IDs, in the order of the rows of ``matrix``.
+        matrix (numpy.ndarray): Intersection sizes from
+            :func:`overlap_matrix`.
+
+    Returns:
+        List of dicts with keys :data:`PAIR_FIELDS`, by decreasing Jaccard
+        similarity. The ``relation`` is ``identical``, ``a in b``, ``b in a``,
+        or ``overlap``.
+    """
+    sizes = np.diag(matrix).tolist()
+    rows, cols = np.nonzero(np.triu(matrix, k=1))
+    pairs = []
+    for i, j in zip(rows, cols):
+        common = int(matrix[i, j])
+        union = sizes[i] + sizes[j] - common
+        if sizes[i] == sizes[j] == common:
+            relation = 'identical'
+        elif sizes[i] == common:
+            relation = 'a in b'
+        elif sizes[j] == common:
+            relation = 'b in a'
+        else:
+            relation = 'overlap'
+        pairs.append({'cmg_id_a': ids[i],
+                      'cmg_id_b': ids[j],
+                      'size_a': sizes[i],
+                      'size_b': sizes[j],
+                      'overlap': common,
+                      'jaccard': round(common / union, 4),
+                      'relation': relation})
+    pairs.sort(key=lambda pair: -pair['jaccard'])
+    return pairs
+
+
+def overlap_to_html(pairs, results_path, title='Overlap between groups'):
+    """Write an HTML table of overlapping groups to ``html/overlap.html``."""
+    html = render('overlap.html', {'title': title, 'items': pairs})
+    path = pjoin(results_path, 'html', 'overlap.html')
+    logger.info('Writing HTML file: %s', path)
+    save_output(path, results_path, html)
+
+
+def analyze_overlap(results_path, workers=None, groups=None):
+    """
+    Compute the overlap between all groups of a run.
+
+    Writes the full matrix of intersection sizes to ``overlap.csv``, the
+    pairs of overlapping groups to ``overlap_pairs.csv``, and an HTML table of
+    these pairs to ``html/overlap.html``.
+
+    Parameters:
+        results_path (str): Results directory of a run.
+        workers (int): Number of processes; defaults to the number of CPUs.
+        groups (iterable): Optional IDs of the groups; see
+            :func:`read_groups`.
+
+    Returns:
+        List of overlapping pairs of groups; see :func:`overlap_pairs`.
+    """
+    ids, members = read_groups(results_path, groups)
+    index, bitsets = encode_bitsets(members)
+    logger.info('Computing overlap of %i groups over %i compounds',
+                len(ids), len(index))
+    matrix = overlap_matrix(bitsets, workers)
+    pairs = overlap_pairs(ids, matrix)
+
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(['cmg_id'] + ids)
+    for cmg_id, row in zip(ids, matrix):
+        writer.writerow([cmg_id] + row.tolist())
+    save_output(pjoin(results_path, 'overlap.csv'), results_path,
+                buf.getvalue())
+
+    buf = io.StringIO()
+    writer = csv.DictWriter(buf, PAIR_FIELDS)
+    writer.writeheader()
+    writer.writerows(pairs)
+    save_output(pjoin(results_path, 'overlap_pairs.csv'), results_path,
+                buf.getvalue())
+
+    overlap_to_html(pairs, results_path)
+    return pairs
+
+
+def main():
+    """Compute the overlap between all groups in a results directory."""
+    desc = 'Compute the overlap between all compound groups of a run.'
+    parser = argparse.ArgumentParser(description=desc)
+    parser.add_argument('results', help='results directory of the run')
+    parser.add_argument('-j', '--jobs', type=int,
+                        help='number of parallel processes')
+    args = parser.parse_args()
+    analyze_overlap(args.results, args.jobs)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,225 @@
+# coding: utf-8
+
+"""
+Checking group definitions before a run.
+
+A mistake in one group definition, such as a malformed SMARTS pattern or a
+typo in its SQL ``code``, otherwise only shows when the group's turn comes,
+possibly hours into a run. The pre-flight checks find such mistakes in all
+definitions within seconds, before any query is executed. For each group,
+:func:`check_group`:
+
+-  checks that the required parameters are present (see
+   :data:`commongroups.query.REQUIRED_PARAMS`) and that a query can be
+   composed from them;
+-  parses its structure and any other patterns with RDKit, if available (see
+   :func:`structure_problems`);
+-  checks that the groups it depends on are defined as well;
+-  asks the database to plan its query, without executing it (see
+   :meth:`commongroups.query.QueryMethod.explain`).
+
+:func:`preflight` checks all groups concurrently, over the connections of the
+database pool, and writes a single report to :data:`REPORT` in the project's
+``data`` directory.
+"""
+
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from importlib.util import find_spec
+import json
+import logging
+from os.path import join as pjoin
+import time
+
+from boltons.fileutils import atomic_save
+from sqlalchemy.exc import SQLAlchemyError
+
+from commongroups.cmgroup import validate_params
+from commongroups.errors import PreflightError
+from commongroups.query import pattern_list, QueryMethod
+from commongroups import logconf  # pylint: disable=unused-import
+logger = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+REPORT = 'preflight.json'
+
+# Number of groups checked at once if the database pool has no fixed size.
+DEFAULT_WORKERS = 4
+
+
+def structure_problems(params):
+    """
+    Parse the structure and patterns of a group definition using RDKit.
+
+    Parameters:
+        params (dict): Compound group parameters.
+
+    Returns:
+        List of problems (str); empty if all structures can be parsed.
+
+    Raises:
+        ImportError: If RDKit is not installed.
+    """
+    from rdkit import Chem
+    parsers = {'SMILES': Chem.MolFromSmiles, 'SMARTS': Chem.MolFromSmarts}
+    method = str(params['method']).upper()
+    structure = str(params['structure'])
+    if method == 'ELEMENTS':
+        return ['Not an element: {}'.format(sym)
+                for sym in structure.replace(',', ' ').split()
+                if Chem.MolFromSmarts('[{}]'.format(sym)) is None]
+    if method == 'SMARTS':
+        patterns = [('SMARTS', pat) for pat in [structure]
+                    + pattern_list(params.get('include'))
+                    + pattern_list(params.get('exclude'))]
+    elif method == 'SCAFFOLD':
+        smiles = str(params['structure_type']).upper() == 'SMILES'
+        patterns = [('SMILES' if smiles else 'SMARTS', structure)]
+    elif method == 'SIMILARITY':
+        patterns = [('SMILES', structure)]
+    elif str(params['structure_type']).upper() in parsers:
+        patterns = [(str(params['structure_type']).upper(), structure)]
+    else:
+        patterns = []
+    return ['Cannot parse {0}: {1}'.format(notation, pat)
+            for notation, pat in patterns if parsers[notation](pat) is None]
+
+
+def check_group(cmg, con=None, defined=None):
+    """
+    Check a group definition without executing its query.
+
+    Parameters:
+        cmg (:class:`commongroups.cmgroup.CMGroup`): Compound group.
+        con: Optional SQLAlchemy database :class:`Engine` object (or list of
+            these), to ask to plan the group's query.
+        defined (set): Optional IDs of all defined groups, among which the
+            groups that this one depends on must be.
+
+    Returns:
+        List of problems (str); empty if the definition passes all checks.
+    """
+    try:
+        validate_params(cmg.params)
+        query = QueryMethod(cmg.params)
+    except Exception as exc:  # pylint: disable=broad-except
+        return [str(exc) or repr(exc)]
+    problems = []
+    if defined is not None:
+        problems.extend('Unknown group: {}'.format(dep)
+                        for dep in cmg.dependencies if dep not in defined)
+    try:
+        problems.extend(structure_problems(cmg.params))
+    except ImportError:
+        pass
+    if con is not None and not problems:
+        try:
+            query.explain(con)
+        except SQLAlchemyError as exc:
+            msg = str(getattr(exc, 'orig', None) or exc).strip()
+            problems.append('Query rejected by database: {}'.format(
+                msg.splitlines()[0]))
+    return problems
+
+
+def pool_size(con):
+    """Return the number of connections in a database pool, if fixed."""
+    if isinstance(con, (list, tuple)):
+        con = con[0]
+    size = getattr(con.pool, 'size', None)
+    return size() if callable(size) else DEFAULT_WORKERS
+
+
+def preflight(cmgs, env, workers=None):
+    """
+    Check the definitions of compound groups before a run.
+
+    Groups that depend on groups failing the checks fail as well. All failed
+    groups are logged, and the report is written to :data:`REPORT` in the
+    project's ``data`` directory.
+
+    Parameters:
+        cmgs (iterable): :class:`commongroups.cmgroup.CMGroup` objects.
+        env (:class:`commongroups.env.CommonEnv`): Project environment, whose
+            database plans the queries.
+        workers (int): Number of groups checked at once; by default, the size
+            of the database connection pool.
+
+    Returns:
+        Report (dict) with the number of groups ``checked``, the ``seconds``
+        taken, and a list of the ``failed`` groups, each with its ``cmg_id``
+        and ``problems``.
+    """
+    started = time.perf_counter()
+    cmgs = list(cmgs)
+    if not env.database:
+        env.connect_database()
+    con = env.database
+    if find_spec('rdkit') is None:
+        logger.warning('RDKit is not available; not parsing structures')
+    ids = Counter(cmg.cmg_id for cmg in cmgs)
+    defined = set(ids)
+    workers = workers or pool_size(con)
+    logger.info('Checking %i group definitions (%i at once)',
+                len(cmgs), workers)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        problems = list(executor.map(
+            lambda cmg: check_group(cmg, con, defined), cmgs))
+    for cmg, probs in zip(cmgs, problems):
+        if ids[cmg.cmg_id] > 1:
+            probs.insert(0, 'Duplicate cmg_id')
+    failed = {cmg.cmg_id for cmg, probs in zip(cmgs, problems) if probs}
+    changed = True
+    while changed:
+        changed = False
+        for cmg, probs in zip(cmgs, problems):
+            if cmg.cmg_id in failed:
+                continue
+            deps = [dep for dep in cmg.dependencies if dep in failed]
+            if deps:
+                probs.extend('Depends on failed group: {}'.format(dep)
+                             for dep in deps)
+                failed.add(cmg.cmg_id)
+                changed = True
+    report = {'time': datetime.now().isoformat(),
+              'checked': len(cmgs),
+              'seconds': time.perf_counter() - started,
+              'failed': [{'cmg_id': cmg.cmg_id, 'problems': probs}
+                         for cmg, probs in zip(cmgs, problems) if probs]}
+    for item in report['failed']:
+        logger.error('Group %s failed pre-flight checks: %s',
+                     item['cmg_id'], '; '.join(item['problems']))
+    logger.info('Checked %i group definitions in %.1f s: %i failed',
+                len(cmgs), report['seconds'], len(report['failed']))
+    with atomic_save(pjoin(env.data_path, REPORT),
+                     text_mode=True) as report_file:
+        json.dump(report, report_file, indent=2, sort_keys=True)
+    return report
+
+
+def preflight_groups(cmgs, env, abort=False):
+    """
+    Check the definitions of compound groups, and exclude those that fail.
+
+    Parameters:
+        cmgs (iterable): :class:`commongroups.cmgroup.CMGroup` objects.
+        env (:class:`commongroups.env.CommonEnv`): Project environment.
+        abort (bool): Whether to raise an error if any group fails, rather
+            than excluding it.
+
+    Returns:
+        List of the compound groups that pass the checks.
+
+    Raises:
+        :class:`commongroups.errors.PreflightError`: If ``abort`` is set and
+            any group fails the checks.
+    """
+    cmgs = list(cmgs)
+    report = preflight(cmgs, env)
+    failed = sorted(set(item['cmg_id'] for item in report['failed']))
+    if failed and abort:
+        raise PreflightError(failed)
+    if failed:
+        logger.warning('Excluding %i groups that failed pre-flight checks',
+                       len(failed))
+    return [cmg for cmg in cmgs if cmg.cmg_id not in failed]
@@ -2,17 +2,28 @@
 
 """Database querying methods for compound groups."""
 
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache, partial
+import hashlib
+import heapq
+import json
 import logging
+from operator import itemgetter
+import re
 
-from pandas import DataFrame
+import numpy as np
+from pandas import DataFrame, concat
 
 # import rdkit
 # from rdkit import Chem, rdBase
 # from rdkit.Chem import AllChem, Draw, rdqueries, rdMolDescriptors
 
-from sqlalchemy import select, column, table, text  # and_, or_, not_
+from sqlalchemy import (and_, bindparam, cast, column, func, not_, select,
+                        table, tablesample, text, String)
+from sqlalchemy.types import UserDefinedType
 
 from commongroups.errors import MissingParamError
+from commongroups import metrics
 from commongroups import logconf  # pylint: disable=unused-import
 logger = logging.getLogger(__name__)  # pylint: disable=invalid-name
 
@@ -21,12 +32,96 @@ logger = logging.getLogger(__name__)  # pylint: disable=invalid-name
 REL = 'compounds'
 MOL = 'compounds.molecule'
 ORD = 'compounds.dtxsid'
+ORD_KEY = 'dtxsid'
 
-TABLE = table(REL)
+# Columns returned for each compound. Other columns, such as the precomputed
+# composition descriptors, are only used for selecting compounds.
+COLUMNS = ['dtxsid', 'inchi', 'inchikey', 'molecule', 'cid', 'casrn', 'name']
+ELEMENTS = 'compounds.elements'
+
+# Table of distinct Murcko scaffolds, and the column of compounds' scaffolds.
+SCAFFOLDS = table('scaffolds', column('scaffold'), column('molecule'))
+SCAFFOLD_COL = column('compounds.scaffold', is_literal=True)
+
+# Fingerprints for similarity searching, and the name of the similarity score
+# returned by similarity searches.
+FP_COL = column('compounds.mfp2', is_literal=True)
+SIMILARITY = 'similarity'
+DEFAULT_THRESHOLD = 0.5
+
+TABLE = table(REL, *[column(col) for col in COLUMNS])
 ORD_COL = column(ORD, is_literal=True)
 
+# Temporary table holding the compound IDs that a query is restricted to.
+SCOPE = 'cmg_scope'
+SCOPE_TABLE = table(SCOPE, column(ORD_KEY))
+
 REQUIRED_PARAMS = ['method', 'structure_type', 'structure']
 
+# Number of rows fetched at a time from each database shard.
+FETCH_ROWS = 10000
+
+# Element symbols as accepted by the ELEMENTS method.
+ELEMENT_SYMBOL = re.compile(r'^[A-Z][a-z]?$')
+
+# Query code that expresses nothing but a substructure search.
+SUBSTRUCTURE_CODE = [':m @> :s']
+
+# Substructures that are precomputed as boolean columns. Keep in sync with
+# FLAG_PATTERNS in tools/construct_database.py.
+FLAG_COLUMNS = {
+    '[C,c]~[C,c]': 'compounds.cc_bond',
+    '[C!H0,c!H0]': 'compounds.ch_bond'
+}
+
+# Elements that RDKit may perceive as aromatic. A bare atom pattern such as
+# [C] only matches aliphatic atoms, so it is not equivalent to the element.
+AROMATIC_ELEMENTS = ['B', 'C', 'N', 'O', 'P', 'S', 'Si', 'Ge', 'As', 'Se',
+                     'Sb', 'Te']
+
+# Symbols of the elements. In SMARTS, other bracketed letters, such as [A],
+# [R], [D], or [X], are atom primitives rather than elements.
+ELEMENT_SYMBOLS = frozenset('''
+    H He Li Be B C N O F Ne Na Mg Al Si P S Cl Ar K Ca Sc Ti V Cr Mn Fe Co
+    Ni Cu Zn Ga Ge As Se Br Kr Rb Sr Y Zr Nb Mo Tc Ru Rh Pd Ag Cd In Sn Sb
+    Te I Xe Cs Ba La Ce Pr Nd Pm Sm Eu Gd Tb Dy Ho Er Tm Yb Lu Hf Ta W Re
+    Os Ir Pt Au Hg Tl Pb Bi Po At Rn Fr Ra Ac Th Pa U Np Pu Am Cm Bk Cf Es
+    Fm Md No Lr Rf Db Sg Bh Hs Mt Ds Rg Cn Nh Fl Mc Lv Ts Og'''.split())
+
+# Elements whose bare atom pattern is not equivalent to the precomputed
+# elements: [H] only matches explicit hydrogen atoms, while the elements
+# include implicit hydrogens.
+INEXACT_ELEMENTS = AROMATIC_ELEMENTS + ['H']
+
+BARE_ATOM = re.compile(r'^\[([A-Z][a-z]?)\]$')
+SUBSTRUCTURE_TERM = re.compile(r"^:m @> (:s|'([^']*)')(?: ?::(mol|qmol))?$")
+SQL_TOKEN = re.compile(r"'[^']*'|\(|\)|\b(?:AND|OR|BETWEEN|CASE|END)\b",
+                       re.IGNORECASE)
+BIND_STRUCTURE = re.compile(r'(?<![:\w]):s(?![\w:])')
+ATOM_TOKEN = re.compile(r'\[[^\]]*\]|Cl|Br|[BCNOPSFIbcnops*]')
+
+# Operators of the SET method, from lowest to highest precedence (as for
+# Python sets), and the functions combining sorted arrays of compound IDs.
+SET_TOKEN = re.compile(r'[()|&]|[^\s()|&]+')
+SET_PRECEDENCE = ['|', '&', '-']
+SET_OPERATIONS = {
+    '|': np.union1d,
+    '&': partial(np.intersect1d, assume_unique=True),
+    '-': partial(np.setdiff1d, assume_unique=True)
+}
+
+
+class QMol(UserDefinedType):
+    """The RDKit extension's query molecule (``qmol``) type."""
+    def get_col_spec(self):
+        return 'qmol'
+
+
+class Mol(UserDefinedType):
+    """The RDKit extension's molecule (``mol``) type."""
+    def get_col_spec(self):
+        return 'mol'
+
 
 class QueryMethod(object):
     """
@@ -34,26 +129,188 @@ class QueryMethod(object):
 
     Parameters:
         params (dict): Compound group parameters of a :class:`CMGroup` object.
+        within (iterable): Optional compound IDs (``dtxsid``) to which the
+            query is restricted, e.g. the members of a parent group. These are
+            loaded into a temporary table when the query is executed.
+        optimize: Whether to rewrite common idioms in SQL ``code`` into fast
+            predicates (see :func:`optimize_where`). If ``'check'``, also run
+            the original query and use its results if they differ.
+        operands (dict): For the ``SET`` method, the compounds ``DataFrame`` of
+            each group referenced in the set expression, keyed by ``cmg_id``.
+        columns (list): Columns returned for each compound; by default, all of
+            the :data:`COLUMNS`. The others can be joined to the results from a
+            snapshot (see :mod:`commongroups.snapshot`).
     """
-    def __init__(self, params):
+    def __init__(self, params, within=None, optimize=False, operands=None,
+                 columns=None):
         self.params = params
+        self.within = None if within is None else list(within)
+        self.optimize = optimize
+        self.operands = operands or {}
+        self.columns = list(columns or COLUMNS)
+        if ORD_KEY not in self.columns:
+            self.columns.insert(0, ORD_KEY)
+        self.original = None
+        self.settings = {}
         self.expression = None
+        self.set_expression = None
         self.create_expression()
 
     def create_query_where(self):
-        """Generate a query expression from a WHERE clause."""
+        """
+        Generate a query expression from a WHERE clause.
+
+        If optimization is enabled and the clause can be rewritten, keep the
+        expression for the original clause as attribute ``original``.
+        """
         if 'code' not in self.params or not self.params['code']:
             raise MissingParamError('code')
-        where_txt = self.params['code'].replace(':m', MOL)
-        clause = text(where_txt).bindparams(s=self.params['structure'])
-        que = select([text('*')]).select_from(TABLE).where(clause)
+        code = self.params['code']
+        self.original = None
+        if self.optimize:
+            fast = optimize_where(code, self.params['structure'])
+            if fast:
+                logger.debug('Rewrote query code: %s', fast)
+                self.original = self.where_expression(code)
+                code = fast
+        self.expression = self.where_expression(code)
+
+    def where_expression(self, code):
+        """Compose a query expression from SQL ``code`` for a WHERE clause."""
+        where_txt = code.replace(':m', MOL)
+        clause = text(where_txt)
+        if BIND_STRUCTURE.search(where_txt):
+            clause = clause.bindparams(s=self.params['structure'])
+        que = select(self.fields()).where(clause)
+        que = que.order_by(ORD_COL)
+        return self.restrict(que)
+
+    def create_query_elements(self):
+        """
+        Generate a query expression matching compounds by their elements.
+
+        The ``structure`` lists element symbols that compounds must all
+        contain, separated by commas or spaces. Optionally, ``code`` gives
+        additional conditions as a SQL ``WHERE`` clause, which may refer to
+        the composition descriptors ``formula``, ``heavy_atoms``, and
+        ``carbon_atoms``. These queries are answered from indexes of the
+        precomputed composition descriptors.
+        """
+        symbols = self.params['structure'].replace(',', ' ').split()
+        clauses = [contains_elements(symbols)]
+        if self.params.get('code'):
+            clauses.append(text(self.params['code'].replace(':m', MOL)))
+        que = select(self.fields()).where(and_(*clauses))
+        que = que.order_by(ORD_COL)
+        self.expression = self.restrict(que)
+
+    def create_query_similarity(self):
+        """
+        Generate a query expression for a fingerprint similarity search.
+
+        Select compounds whose Tanimoto similarity to the ``structure`` (a
+        SMILES string) is at least the ``threshold`` parameter (default
+        :data:`DEFAULT_THRESHOLD`), using Morgan fingerprints (radius 2). The
+        search uses the index of precomputed fingerprints. Results are ordered
+        by decreasing similarity and include the similarity score.
+        """
+        threshold = float(self.params.get('threshold') or DEFAULT_THRESHOLD)
+        if not 0 <= threshold <= 1:
+            raise ValueError('Similarity threshold must be between 0 and 1:'
+                             ' {}'.format(threshold))
+        ref = func.morganbv_fp(
+            cast(bindparam('s', self.params['structure'], type_=String), Mol)
+        )
+        sim = func.tanimoto_sml(ref, FP_COL).label(SIMILARITY)
+        # As text, the operator is escaped for the database driver if needed.
+        near = text('{} % morganbv_fp(:s ::mol)'.format(FP_COL)).bindparams(
+            s=self.params['structure'])
+        que = select(self.fields() + [sim]).where(near)
+        que = que.order_by(sim.desc(), ORD_COL)
+        # The index search operator (%) uses this setting as its threshold.
+        self.settings['rdkit.tanimoto_threshold'] = threshold
+        self.expression = self.restrict(que)
+
+    def create_query_scaffold(self):
+        """
+        Generate a query expression that searches compounds by scaffold.
+
+        First find the Murcko scaffolds that contain the ``structure`` pattern
+        (SMARTS, or a SMILES molecule if the ``structure_type`` is ``SMILES``,
+        so that e.g. Kekulé structures match aromatic rings), using the much
+        smaller, indexed table of distinct scaffolds, then the compounds with
+        those scaffolds. Only these candidates are
+        verified by a substructure search of the compounds themselves, or by
+        the SQL ``code``, if given, as in the ``SQL`` method.
+
+        The pattern should describe a ring system or core structure: parts of
+        the pattern outside a compound's scaffold, such as side chains, are
+        not found in the scaffold, and such compounds are missed.
+        """
+        pattern = self.params['structure']
+        smiles = str(self.params['structure_type']).upper() == 'SMILES'
+        scaffolds = select([SCAFFOLDS.c.scaffold]).where(
+            SCAFFOLDS.c.molecule.op('@>')(pattern_param(pattern, smiles))
+        )
+        if self.params.get('code'):
+            where_txt = self.params['code'].replace(':m', MOL)
+            verify = text(where_txt)
+            if BIND_STRUCTURE.search(where_txt):
+                verify = verify.bindparams(s=pattern)
+        else:
+            verify = substructure_clause(pattern, smiles)
+        que = select(self.fields()).where(
+            and_(SCAFFOLD_COL.in_(scaffolds), verify)
+        )
+        que = que.order_by(ORD_COL)
+        self.expression = self.restrict(que)
+
+    def create_query_smarts(self):
+        """
+        Generate a query expression from lists of SMARTS patterns.
+
+        Compounds must contain the ``structure`` and any other patterns listed
+        as ``include``, and none of the patterns listed as ``exclude``. Each
+        pattern is compiled to a separate predicate (see
+        :func:`compile_patterns`).
+        """
+        includes = [self.params['structure']]
+        includes += pattern_list(self.params.get('include'))
+        excludes = pattern_list(self.params.get('exclude'))
+        clauses = compile_patterns(includes, excludes, fast=self.optimize)
+        que = select(self.fields()).where(and_(*clauses))
         que = que.order_by(ORD_COL)
-        self.expression = que
+        self.expression = self.restrict(que)
+
+    def fields(self):
+        """Return the columns selected by the query."""
+        return [TABLE.c[col] for col in self.columns]
+
+    def restrict(self, que):
+        """Restrict a query to the compound IDs given as ``within``."""
+        if self.within is None:
+            return que
+        return que.where(ORD_COL.in_(select([SCOPE_TABLE.c[ORD_KEY]])))
+
+    def create_query_set(self):
+        """
+        Parse the set expression of a group defined by other groups.
+
+        The ``structure`` combines the ``cmg_id`` of other groups using the
+        operators ``|`` (union), ``&`` (intersection), and ``-`` (difference),
+        and parentheses; see :func:`parse_set_expression`. No database query
+        is needed: the group is computed from the results of the other groups.
+        """
+        self.set_expression = parse_set_expression(self.params['structure'])
 
     def get_literal(self):
         """
         Return a string literal of the query expression, with bound parameters.
+
+        For the ``SET`` method, return the normalized set expression.
         """
+        if self.set_expression is not None:
+            return format_set_expression(self.set_expression)
         literal = str(
             self.expression.compile(compile_kwargs={'literal_binds': True})
         )
@@ -69,8 +326,19 @@ class QueryMethod(object):
             if req not in self.params or not self.params[req]:
                 raise MissingParamError(req)
 
-        if self.params['method'] == 'SQL':
+        method = self.params['method'].upper()
+        if method == 'SQL':
             self.create_query_where()
+        elif method == 'ELEMENTS':
+            self.create_query_elements()
+        elif method == 'SMARTS':
+            self.create_query_smarts()
+        elif method == 'SIMILARITY':
+            self.create_query_similarity()
+        elif method == 'SCAFFOLD':
+            self.create_query_scaffold()
+        elif method == 'SET':
+            self.create_query_set()
         else:
             raise NotImplementedError(
                 'Unsupported method: {}'.format(self.params['method']))
@@ -80,15 +348,238 @@ class QueryMethod(object):
         """
         Create a textual description of the query method with minimal HTML.
         """
+        if self.set_expression is not None:
+            ret = ('This group is defined as a combination of other groups:'
+                   ' <code>{}</code>.'.format(self.get_literal()))
+            if self.within is not None:
+                ret += ' Only members of the parent group are included.'
+            return ret
         ret = ('This group is defined by a {0} query using'
                ' the {1} structure <code>{2}</code>.')
         ret = ret.format(self.params['method'],
                          self.params['structure_type'],
                          self.params['structure'])
+        if self.params['method'].upper() == 'SIMILARITY':
+            ret += ' The similarity threshold is {}.'.format(
+                self.settings['rdkit.tanimoto_threshold'])
+        if self.params['method'].upper() == 'SMARTS':
+            for key, verb in [('include', 'required'),
+                              ('exclude', 'excluded')]:
+                pats = pattern_list(self.params.get(key))
+                if pats:
+                    ret += ' Compounds containing {0} are {1}.'.format(
+                        ', '.join('<code>{}</code>'.format(pat)
+                                  for pat in pats), verb)
+        if self.within is not None:
+            ret += (' Only the {} members of the parent group were'
+                    ' evaluated.'.format(len(self.within)))
         return ret
 
     def __call__(self, con):
-        return get_query_results(self.expression, con)
+        if self.set_expression is not None:
+            return evaluate_set(self.set_expression, self.operands,
+                                within=self.within)
+        res = self.execute(con)
+        if self.optimize == 'check' and self.original is not None:
+            ref = self.execute(con, self.original)
+            if list(ref[ORD_KEY]) != list(res[ORD_KEY]):
+                logger.error('Rewritten query gives different results for %s;'
+                             ' using the original query',
+                             self.params.get('cmg_id'))
+                self.expression, self.original = self.original, None
+                return ref
+            logger.info('Verified rewritten query for %s',
+                        self.params.get('cmg_id'))
+        return res
+
+    def execute(self, con, expression=None):
+        """
+        Execute the query expression (or another expression, if given).
+
+        Parameters:
+            con: SQLAlchemy database :class:`Engine` object, or a list of
+                these for a sharded database.
+            expression: Optional SQLAlchemy :class:`Select` object.
+
+        Returns:
+            A pandas :class:`DataFrame` containing all rows of results.
+        """
+        if expression is None:
+            expression = self.expression
+        method = self.params['method'].upper()
+        with metrics.timed(metrics.QUERY_SECONDS, method=method):
+            if isinstance(con, (list, tuple)):
+                res = get_sharded_results(
+                    partial(self.iter_results, expression=expression), con,
+                    sort_key=self.sort_key)
+            elif self.within is None and not self.settings:
+                res = get_query_results(expression, con)
+            else:
+                with con.connect() as conn, conn.begin():
+                    self.prepare(conn)
+                    res = get_query_results(expression, conn)
+        metrics.ROWS.inc(len(res))
+        return res
+
+    def count(self, con):
+        """
+        Count the compounds that the query selects, without retrieving them.
+
+        Parameters:
+            con: SQLAlchemy database :class:`Engine` object, or a list of
+                these for a sharded database.
+
+        Returns:
+            Number of compounds (int).
+        """
+        if self.set_expression is not None:
+            return len(self(con))
+        que = select([func.count()]).select_from(
+            self.expression.order_by(None).alias('counted'))
+        if isinstance(con, (list, tuple)):
+            with ThreadPoolExecutor(max_workers=len(con)) as executor:
+                return sum(executor.map(self.count, con))
+        if self.within is None and not self.settings:
+            return con.execute(que).scalar()
+        with con.connect() as conn, conn.begin():
+            self.prepare(conn)
+            return conn.execute(que).scalar()
+
+    def explain(self, con, fmt=None):
+        """
+        Ask the database to plan the query, without executing it.
+
+        The database parses the query's SQL ``code`` and structures, and
+        resolves the tables, columns, and functions it uses, just as it would
+        before executing it. For a sharded database, only the first shard is
+        asked, since all shards have the same schema.
+
+        Parameters:
+            con: SQLAlchemy database :class:`Engine` object, or a list of
+                these for a sharded database.
+            fmt (str): Optional output format of the plan, e.g. ``'json'``
+                (PostgreSQL only).
+
+        Returns:
+            List of the rows of the query plan, e.g. lines of text; empty for
+            the ``SET`` method.
+
+        Raises:
+            :class:`sqlalchemy.exc.SQLAlchemyError`: If the database cannot
+                plan the query.
+        """
+        if self.set_expression is not None:
+            return []
+        if isinstance(con, (list, tuple)):
+            con = con[0]
+        compiled = self.expression.compile(dialect=con.dialect)
+        params = compiled.construct_params()
+        if compiled.positional:
+            params = tuple(params[key] for key in compiled.positiontup)
+        statement = 'EXPLAIN '
+        if fmt:
+            statement += '(FORMAT {}) '.format(fmt.upper())
+        with con.connect() as conn, conn.begin():
+            self.prepare(conn)
+            res = conn.execute(statement + str(compiled), params)
+            return [row[0] for row in res]
+
+    def estimate(self, con, sample=None):
+        """
+        Estimate the number of compounds that the query selects, quickly.
+
+        By default, the database's query planner estimates the number of rows
+        from its statistics, without executing the query (PostgreSQL only).
+        This takes milliseconds, but the planner knows little about structure
+        searches, so the estimate may only be right to an order of magnitude.
+        With ``sample``, the query is instead counted among a random sample of
+        the compounds (``TABLESAMPLE SYSTEM``), and the count is scaled up.
+
+        Parameters:
+            con: SQLAlchemy database :class:`Engine` object, or a list of
+                these for a sharded database.
+            sample (float): Optional percentage of the compounds to sample.
+
+        Returns:
+            Estimated number of compounds (int), or ``None`` for the ``SET``
+            method.
+        """
+        if self.set_expression is not None:
+            return None
+        if isinstance(con, (list, tuple)):
+            return sum(self.estimate(shard, sample) for shard in con)
+        if not sample:
+            plan = self.explain(con, fmt='json')[0]
+            if isinstance(plan, str):
+                plan = json.loads(plan)
+            return int(plan[0]['Plan']['Plan Rows'])
+        sampled = tablesample(TABLE, func.system(float(sample)), name=REL)
+        que = select([func.count()]).select_from(
+            self.expression.order_by(None).replace_selectable(TABLE, sampled)
+            .alias('counted'))
+        with con.connect() as conn, conn.begin():
+            self.prepare(conn)
+            num = conn.execute(que).scalar()
+        return int(round(num * 100 / float(sample)))
+
+    def prepare(self, con):
+        """
+        Prepare a database connection, within a transaction, for the query.
+
+        Apply any database settings needed by the query method for the
+        duration of the transaction, and create the temporary table of
+        compound IDs if the query is restricted to these.
+        """
+        for name, value in sorted(self.settings.items()):
+            con.execute(text('SELECT set_config(:name, :value, true)'),
+                        name=name, value=str(value))
+        if self.within is not None:
+            create_scope(con, self.within)
+
+    def sort_key(self, columns):
+        """
+        Return a function giving the sort key of a result row.
+
+        Results are sorted by compound ID, except for similarity searches,
+        which are sorted by decreasing similarity first.
+
+        Parameters:
+            columns (list): Column names of the result rows.
+        """
+        ord_idx = columns.index(ORD_KEY)
+        if SIMILARITY not in columns:
+            return itemgetter(ord_idx)
+        sim_idx = columns.index(SIMILARITY)
+        return lambda row: (-row[sim_idx], row[ord_idx])
+
+    def iter_results(self, con, expression=None):
+        """
+        Execute the query and generate its results incrementally.
+
+        The first item generated is the list of column names; executing the
+        query happens when this item is requested. The result rows follow,
+        fetched in batches of :data:`FETCH_ROWS` from a server-side cursor
+        (where the database driver supports it, as ``psycopg2`` does), so
+        that only one batch at a time is transferred and held in memory.
+
+        Parameters:
+            con: SQLAlchemy database :class:`Engine` object.
+            expression: Optional SQLAlchemy :class:`Select` object to execute
+                instead of the query expression.
+        """
+        if expression is None:
+            expression = self.expression
+        with con.connect() as conn, conn.begin():
+            self.prepare(conn)
+            res = conn.execution_options(stream_results=True).execute(
+                expression)
+            yield list(res.keys())
+            while True:
+                rows = res.fetchmany(FETCH_ROWS)
+                if not rows:
+                    break
+                for row in rows:
+                    yield tuple(row)
 
     def __repr__(self):
         return 'QueryMethod({})'.format(repr(self.params))
@@ -111,52 +602,528 @@ def get_query_results(que, con):
     return ret
 
 
-# Previous attempts at factoring out query logic...
-###################################################
-
-# def substructure_query(pattern, mol, fields):
-#     """
-#     Construct a substructure query based on a SMARTS query molecule.
-
-#     Parameters:
-#         pattern: Substructure query molecule as SMARTS string.
-#         mol: SQLAlchemy object representing a column of searchable molecules.
-#         fields (iterable): SQLAlchemy selctable objects to select from.
-
-#     Returns:
-#         SQLAlchemy :class:`Select` object.
-#     """
-#     where_clause = mol.op('@>')(text(':q ::qmol').bindparams(q=str(pattern)))
-#     que = select(fields).where(where_clause)
-#     return que
-
-
-# def substruct_exclude(pattern, excludes, mol, fields):
-#     """
-#     Construct a query matching one substructure and excluding others.
-
-#     Parameters:
-#         pattern (str): Substructure to match, as a SMARTS string.
-#         excludes (iterable): Substructures to exclude, as SMARTS strings.
-#         mol: SQLAlchemy object representing a column of searchable molecules.
-#         fields (iterable): SQLAlchemy selctable objects to select from.
-
-#     Returns:
-#         SQLAlchemy :class:`Select` object.
-#     """
-#     sub_clause = mol.op('@>')(text(':p ::qmol').bindparams(p=pattern))
-#     not_clauses = []
-#     for pat in excludes:
-#         match = mol.op('@>')(text(':x ::qmol').bindparams(x=pat))
-#         not_clauses.append(not_(match))
-#     que = select(fields).where(and_(sub_clause, *not_clauses))
-#     return que
-
-
-# def get_element_inorganic(elem_smarts, mol, fields):
-#     """
-#     Match all compounds containing an element but exclude any compounds
-#     containing C-H or C-C bonds. Works OK most of the time.
-#     """
-#     organic_smarts = ['[C,c]~[C,c]', '[C!H0,c!H0]']
-#     return substruct_exclude(elem_smarts, organic_smarts, mol, fields)
+def parse_set_expression(text):
+    """
+    Parse an expression combining compound groups by set operations.
+
+    Operands are group IDs; operators are ``|`` (union), ``&``
+    (intersection), and ``-`` (difference), which must be separated from the
+    IDs by spaces. As for Python sets, ``-`` binds most tightly and ``|``
+    least; parentheses may be used for grouping.
+
+    Parameters:
+        text (str): Set expression, e.g. ``'(1001 | 1002) - 1003'``.
+
+    Returns:
+        A group ID, or a tuple of an operator and two such parsed operands.
+
+    Raises:
+        ValueError: If the expression is invalid.
+    """
+    tokens = SET_TOKEN.findall(text)
+    pos = 0
+
+    def parse(level):
+        nonlocal pos
+        if level == len(SET_PRECEDENCE):
+            return parse_operand()
+        left = parse(level + 1)
+        while pos < len(tokens) and tokens[pos] == SET_PRECEDENCE[level]:
+            pos += 1
+            left = (SET_PRECEDENCE[level], left, parse(level + 1))
+        return left
+
+    def parse_operand():
+        nonlocal pos
+        if pos == len(tokens):
+            raise ValueError('Incomplete set expression: {}'.format(text))
+        token = tokens[pos]
+        pos += 1
+        if token == '(':
+            ret = parse(0)
+            if pos == len(tokens) or tokens[pos] != ')':
+                raise ValueError('Unbalanced parentheses: {}'.format(text))
+            pos += 1
+            return ret
+        if token in SET_OPERATIONS or token == ')':
+            raise ValueError('Unexpected {0} in set expression: {1}'
+                             .format(token, text))
+        return token
+
+    ret = parse(0)
+    if pos != len(tokens):
+        raise ValueError('Unexpected {0} in set expression: {1}'
+                         .format(tokens[pos], text))
+    return ret
+
+
+def format_set_expression(tree):
+    """Format a parsed set expression as text, with explicit grouping."""
+    if isinstance(tree, tuple):
+        oper, left, right = tree
+        return '({0} {1} {2})'.format(format_set_expression(left), oper,
+                                      format_set_expression(right))
+    return tree
+
+
+def set_operands(tree):
+    """Return the distinct group IDs in a parsed set expression, in order."""
+    if not isinstance(tree, tuple):
+        return [tree]
+    ret = set_operands(tree[1])
+    ret.extend(dep for dep in set_operands(tree[2]) if dep not in ret)
+    return ret
+
+
+def set_dependencies(params):
+    """
+    Return the IDs of the groups that a ``SET`` group is computed from.
+
+    Returns an empty list for other methods, or if the set expression is
+    invalid (which is reported when the group is processed).
+    """
+    if str(params.get('method')).upper() != 'SET' or \
+            not params.get('structure'):
+        return []
+    try:
+        return set_operands(parse_set_expression(params['structure']))
+    except ValueError:
+        return []
+
+
+def evaluate_set(tree, operands, within=None):
+    """
+    Compute the compounds of a group defined by a set expression.
+
+    The expression is evaluated over the sorted arrays of compound IDs of the
+    operand groups, and the compounds are then taken from their results.
+
+    Parameters:
+        tree: Parsed set expression (see :func:`parse_set_expression`).
+        operands (dict): Compounds ``DataFrame`` of each referenced group,
+            keyed by ``cmg_id``.
+        within (iterable): Optional compound IDs to restrict the result to.
+
+    Returns:
+        A pandas :class:`DataFrame` of compounds, sorted by ``dtxsid``, with
+        the :data:`COLUMNS` found in the operands.
+
+    Raises:
+        :class:`commongroups.errors.MissingParamError`: If the results of a
+            referenced group are not available.
+    """
+    keys = {}
+    for dep in set_operands(tree):
+        if dep not in operands:
+            logger.error('Results of group %s are not available', dep)
+            raise MissingParamError(dep)
+        keys[dep] = np.unique(operands[dep][ORD_KEY].values.astype(str))
+
+    def evaluate(node):
+        if not isinstance(node, tuple):
+            return keys[node]
+        oper, left, right = node
+        return SET_OPERATIONS[oper](evaluate(left), evaluate(right))
+
+    ids = evaluate(tree)
+    if within is not None:
+        ids = np.intersect1d(ids, np.asarray(list(within), dtype=str))
+    frames = [operands[dep] for dep in keys]
+    cols = [col for col in COLUMNS if all(col in frame for frame in frames)]
+    pool = concat([frame[cols] for frame in frames], ignore_index=True)
+    pool = pool.drop_duplicates(ORD_KEY).set_index(ORD_KEY)
+    ret = pool.loc[ids].reset_index()
+    logger.info('%i results', len(ret))
+    return ret
+
+
+def get_sharded_results(iter_results, cons, sort_key=None):
+    """
+    Execute a query on several database shards and merge the results.
+
+    The query is run concurrently on all shards. Since each shard returns its
+    results sorted by compound ID (:data:`ORD_COL`), the result rows are then
+    combined with a streaming k-way merge, which preserves the global order
+    without sorting again. This assumes that the databases sort compound IDs
+    in the same way as Python does, which is the case for ``dtxsid`` values.
+
+    Parameters:
+        iter_results: Function generating column names followed by result rows
+            from one database, like :func:`QueryMethod.iter_results`.
+        cons (list): SQLAlchemy database :class:`Engine` objects.
+        sort_key: Optional function that takes the list of column names and
+            returns the key function for the order of results, like
+            :func:`QueryMethod.sort_key`. By default, rows are ordered by
+            compound ID.
+
+    Returns:
+        A pandas :class:`DataFrame` containing all rows of results.
+    """
+    shards = [iter_results(con) for con in cons]
+    try:
+        with ThreadPoolExecutor(max_workers=len(shards)) as pool:
+            keys = list(pool.map(next, shards))
+        columns = keys[0]
+        if sort_key:
+            key = sort_key(columns)
+        else:
+            key = itemgetter(columns.index(ORD_KEY))
+        rows = heapq.merge(*shards, key=key)
+        ret = DataFrame(list(rows), columns=columns)
+    finally:
+        for shard in shards:
+            shard.close()
+    logger.info('%i results from %i shards', len(ret), len(shards))
+    return ret
+
+
+def split_conjunction(code):
+    """
+    Split SQL code into the terms of a top-level conjunction (``AND``).
+
+    The ``AND`` of ``BETWEEN ... AND ...`` does not separate terms, and
+    ``CASE ... END`` expressions are nested like parentheses.
+
+    Returns:
+        List of terms, or ``None`` if the code has a top-level ``OR`` or
+        unbalanced parentheses.
+    """
+    terms = []
+    depth = 0
+    start = 0
+    # Depths of the BETWEEN operators still waiting for their AND.
+    between = []
+    for token in SQL_TOKEN.finditer(code):
+        word = token.group().upper()
+        if word in ('(', 'CASE'):
+            depth += 1
+        elif word in (')', 'END'):
+            depth -= 1
+            if depth < 0:
+                return None
+        elif word == 'BETWEEN':
+            between.append(depth)
+        elif word == 'AND' and between and between[-1] == depth:
+            between.pop()
+        elif depth == 0 and word == 'OR':
+            return None
+        elif depth == 0 and word == 'AND':
+            terms.append(code[start:token.start()])
+            start = token.end()
+    if depth != 0 or between:
+        return None
+    terms.append(code[start:])
+    return [unwrap(term) for term in terms]
+
+
+def unwrap(term):
+    """Remove whitespace and any parentheses enclosing the whole term."""
+    term = term.strip()
+    while term.startswith('(') and term.endswith(')'):
+        depth = 0
+        for token in SQL_TOKEN.finditer(term[1:-1]):
+            if token.group() == '(':
+                depth += 1
+            elif token.group() == ')':
+                depth -= 1
+                if depth < 0:
+                    return term
+        term = term[1:-1].strip()
+    return term
+
+
+def fast_predicate(term, structure):
+    """
+    Rewrite a substructure search term into an equivalent fast predicate.
+
+    Recognized terms are (possibly negated) substructure searches, either for
+    a single atom of an element that is never aromatic, such as ``[Au]``
+    (other than hydrogen, and not SMARTS primitives such as ``[R]``), or
+    for one of the :data:`FLAG_COLUMNS` patterns. These are rewritten into
+    predicates over the precomputed composition descriptors.
+
+    Parameters:
+        term (str): One term of a SQL WHERE clause, as in group ``code``.
+        structure (str): The group's ``structure``, substituted for ``:s``.
+
+    Returns:
+        The rewritten term, or ``None`` if it is not recognized.
+    """
+    negate = False
+    if term[:4].upper() == 'NOT ':
+        negate = True
+        term = unwrap(term[4:])
+    match = SUBSTRUCTURE_TERM.match(' '.join(term.split()))
+    if not match:
+        return None
+    pattern = structure if match.group(1) == ':s' else match.group(2)
+    atom = BARE_ATOM.match(pattern)
+    if (atom and atom.group(1) in ELEMENT_SYMBOLS
+            and atom.group(1) not in INEXACT_ELEMENTS):
+        fast = "{0} @> ARRAY['{1}']::text[]".format(ELEMENTS, atom.group(1))
+    elif pattern in FLAG_COLUMNS and match.group(3) == 'qmol':
+        fast = FLAG_COLUMNS[pattern]
+    else:
+        return None
+    return 'NOT ({})'.format(fast) if negate else fast
+
+
+def optimize_where(code, structure):
+    """
+    Rewrite group ``code`` using fast predicates where possible.
+
+    Terms of a top-level conjunction that can be answered from precomputed
+    descriptor columns (see :func:`fast_predicate`) are rewritten, and placed
+    before the remaining terms, so that cheap filters come before expensive
+    substructure searches.
+
+    For example, with the structure ``[Au]``, the code ``(:m @> :s ::qmol)
+    AND NOT (:m @> '[C,c]~[C,c]' ::qmol)`` is rewritten as
+    ``(compounds.elements @> ARRAY['Au']::text[]) AND
+    (NOT (compounds.cc_bond))``.
+
+    Parameters:
+        code (str): SQL code for a WHERE clause, as in group ``code``.
+        structure (str): The group's ``structure``, substituted for ``:s``.
+
+    Returns:
+        The rewritten code, or ``None`` if nothing can be rewritten.
+    """
+    terms = split_conjunction(code)
+    if not terms:
+        return None
+    cheap = []
+    costly = []
+    for term in terms:
+        fast = fast_predicate(term, structure)
+        if fast:
+            cheap.append(fast)
+        else:
+            costly.append(term)
+    if not cheap:
+        return None
+    return ' AND '.join('({})'.format(term) for term in cheap + costly)
+
+
+def contains_elements(symbols):
+    """
+    Create a clause matching compounds that contain all the given elements.
+
+    Uses the precomputed ``elements`` descriptor column, which is indexed for
+    this purpose, rather than substructure searching.
+
+    Parameters:
+        symbols (iterable): Element symbols, e.g. ``['Au']``.
+
+    Returns:
+        SQLAlchemy :class:`TextClause` object.
+    """
+    symbols = list(symbols)
+    if not symbols:
+        raise MissingParamError('structure')
+    for sym in symbols:
+        if not ELEMENT_SYMBOL.match(sym):
+            raise ValueError('Not an element symbol: {}'.format(sym))
+    # Name parameters after the symbols, so that clauses can be combined.
+    names = ['el_{}'.format(sym) for sym in symbols]
+    clause = text('{0} @> ARRAY[{1}]::text[]'.format(
+        ELEMENTS, ', '.join(':' + name for name in names)
+    ))
+    return clause.bindparams(**dict(zip(names, symbols)))
+
+
+def create_scope(con, ids):
+    """
+    Create a temporary table of compound IDs to restrict queries to.
+
+    The table lasts until the end of the current transaction.
+
+    Parameters:
+        con: SQLAlchemy database :class:`Connection` object, within a
+            transaction.
+        ids (list): Compound IDs (``dtxsid``).
+    """
+    logger.debug('Creating temporary table of %i compound IDs', len(ids))
+    con.execute(text(
+        'CREATE TEMPORARY TABLE {0} ({1} text PRIMARY KEY)'
+        ' ON COMMIT DROP'.format(SCOPE, ORD_KEY)
+    ))
+    con.execute(text(
+        'INSERT INTO {0} SELECT DISTINCT unnest(:ids ::text[])'.format(SCOPE)
+    ).bindparams(ids=ids))
+    con.execute(text('ANALYZE {}'.format(SCOPE)))
+
+
+def substructure_mol(params):
+    """
+    Return the query structure of a plain substructure search as a molecule.
+
+    Only definitions whose ``code`` is nothing but a substructure search, and
+    whose structure is given as SMILES, are considered: for these, containment
+    of one query structure in another guarantees that every compound matching
+    the larger structure also matches the smaller one.
+
+    Parameters:
+        params (dict): Compound group parameters.
+
+    Returns:
+        RDKit :class:`Mol` object, or ``None`` if the definition is not a plain
+        substructure search or the structure cannot be parsed.
+
+    Raises:
+        ImportError: If RDKit is not installed.
+    """
+    from rdkit import Chem
+    code = ' '.join(str(params.get('code', '')).split())
+    if (params.get('method') != 'SQL'
+            or str(params.get('structure_type', '')).upper() != 'SMILES'
+            or code not in SUBSTRUCTURE_CODE):
+        return None
+    return Chem.MolFromSmiles(params['structure'])
+
+
+def pattern_list(patterns):
+    """
+    Return SMARTS patterns as a list without duplicates.
+
+    Parameters:
+        patterns: A list of patterns, or a string of patterns separated by
+            whitespace (as in a spreadsheet cell), or ``None``.
+    """
+    if not patterns:
+        return []
+    if isinstance(patterns, str):
+        patterns = patterns.split()
+    ret = []
+    for pat in patterns:
+        if pat not in ret:
+            ret.append(pat)
+    return ret
+
+
+def pattern_size(pattern):
+    """
+    Estimate the specificity of a SMARTS pattern by its number of atoms and
+    bonds. Larger patterns generally match fewer compounds.
+    """
+    try:
+        from rdkit import Chem
+        qmol = Chem.MolFromSmarts(pattern)
+        if qmol is not None:
+            return qmol.GetNumAtoms() + qmol.GetNumBonds()
+    except ImportError:
+        pass
+    return 2 * len(ATOM_TOKEN.findall(pattern)) - 1
+
+
+@lru_cache(maxsize=1024)
+def substructure_clause(pattern, smiles=False):
+    """
+    Create a clause matching compounds that contain a substructure.
+
+    The pattern is passed to the database as a bound parameter, named after
+    the pattern itself, so that the same predicate compiles identically in
+    every query. Clauses are cached and shared between groups.
+
+    Parameters:
+        pattern (str): Substructure query molecule as SMARTS string.
+        smiles (bool): Whether the pattern is a SMILES string instead.
+
+    Returns:
+        SQLAlchemy :class:`BinaryExpression` object.
+    """
+    return TABLE.c.molecule.op('@>')(pattern_param(pattern, smiles))
+
+
+def pattern_param(pattern, smiles=False):
+    """
+    Return a SMARTS pattern as a bound parameter of the query molecule type.
+
+    The parameter is named after the pattern itself, so that the same pattern
+    always compiles identically. A SMILES string (if ``smiles`` is set) is
+    passed as a molecule (``mol``) instead, which is matched by its chemistry
+    rather than literally, e.g. with aromatic rather than Kekulé bonds.
+    """
+    digest = hashlib.md5(pattern.encode('utf-8')).hexdigest()[:12]
+    if smiles:
+        return cast(bindparam('m_' + digest, pattern, type_=String), Mol)
+    return cast(bindparam('q_' + digest, pattern, type_=String), QMol)
+
+
+def compile_patterns(includes, excludes=None, fast=False):
+    """
+    Compile substructure patterns into predicates, ordered by selectivity.
+
+    Patterns to include come first, most specific first; patterns to exclude
+    follow, most general (most likely to exclude compounds) first. If ``fast``
+    is set, patterns that can be answered from precomputed descriptors (see
+    :func:`fast_predicate`) are turned into such predicates and placed before
+    all substructure searches.
+
+    Parameters:
+        includes (iterable): SMARTS patterns that compounds must contain.
+        excludes (iterable): SMARTS patterns that compounds must not contain.
+        fast: Whether to use predicates over precomputed descriptors.
+
+    Returns:
+        List of SQLAlchemy clauses, to be combined with ``AND``.
+    """
+    includes = pattern_list(list(includes))
+    excludes = pattern_list(list(excludes or []))
+    cheap = []
+    costly = []
+    for pat in sorted(includes, key=pattern_size, reverse=True):
+        pred = fast_predicate(":m @> '{}' ::qmol".format(pat), None)
+        if fast and pred:
+            cheap.append(text(pred))
+        else:
+            costly.append(substructure_clause(pat))
+    for pat in sorted(excludes, key=pattern_size):
+        pred = fast_predicate(":m @> '{}' ::qmol".format(pat), None)
+        if fast and pred:
+            cheap.append(not_(text(pred)))
+        else:
+            costly.append(not_(substructure_clause(pat)))
+    return cheap + costly
+
+
+def substructure_query(pattern, fields=None):
+    """
+    Construct a substructure query based on a SMARTS query molecule.
+
+    Parameters:
+        pattern: Substructure query molecule as SMARTS string.
+        fields (iterable): SQLAlchemy selectable objects to select; by default,
+            all of the :data:`COLUMNS`.
+
+    Returns:
+        SQLAlchemy :class:`Select` object.
+    """
+    return substruct_exclude(pattern, [], fields)
+
+
+def substruct_exclude(pattern, excludes, fields=None):
+    """
+    Construct a query matching one substructure and excluding others.
+
+    Parameters:
+        pattern (str): Substructure to match, as a SMARTS string.
+        excludes (iterable): Substructures to exclude, as SMARTS strings.
+        fields (iterable): SQLAlchemy selectable objects to select; by default,
+            all of the :data:`COLUMNS`.
+
+    Returns:
+        SQLAlchemy :class:`Select` object.
+    """
+    clauses = compile_patterns([pattern], excludes)
+    que = select(fields or list(TABLE.c)).where(and_(*clauses))
+    return que.order_by(ORD_COL)
+
+
+def get_element_inorganic(elem_smarts, fields=None):
+    """
+    Match all compounds containing an element but exclude any compounds
+    containing C-H or C-C bonds. Works OK most of the time.
+    """
+    organic_smarts = ['[C,c]~[C,c]', '[C!H0,c!H0]']
+    return substruct_exclude(elem_smarts, organic_smarts, fields)
@@ -9,16 +9,24 @@ Invoking this module runs a collection of commongroups operations:
    from a JSON file if specified.
 -  Compile and perform database queries based on group definitions.
 -  Output results to Excel and JSON and create a browseable HTML directory.
+
+To triage group definitions quickly, the compounds in each group can instead
+only be counted, or estimated, without retrieving them (``--mode count`` or
+``--mode estimate``; see :func:`commongroups.ops.count_groups`).
+
+Alternatively, the groups can be processed by several worker processes, on
+any number of machines, using a shared work queue (see
+:mod:`commongroups.workqueue`).
+
+The modules for each operation, and their dependencies, are imported only
+when the operation is run, so that e.g. printing the version or reading group
+definitions from a file does not load libraries that are not needed.
 """
 
 import logging
 import argparse
 
-from commongroups.env import CommonEnv
-from commongroups.ops import (batch_process,
-                              cmgs_from_file,
-                              cmgs_from_googlesheet)
-from commongroups import logconf  # pylint: disable=unused-import
+from commongroups import logconf
 logger = logging.getLogger('commongroups')  # pylint: disable=invalid-name
 
 
@@ -29,7 +37,9 @@ def create_parser():
 
     parser.add_argument('-p', '--project', help='project name')
     parser.add_argument('-e', '--env_path', help='path to commongroups home')
-    parser.add_argument('-d', '--database_url', help='database URL')
+    parser.add_argument('-d', '--database_url', nargs='+', action='append',
+                        help='database URL, or URLs of several shards'
+                        ' (after one or several -d options)')
     parser.add_argument('-k', '--google_key_file',
                         help='Google credentials file')
     parser.add_argument('-g', '--google_sheet_title',
@@ -38,6 +48,33 @@ def create_parser():
                         help='worksheet containing group definitions')
     parser.add_argument('-f', '--params_file',
                         help='read group parameters from file')
+    parser.add_argument('-r', '--resume', action='store_true',
+                        help='skip groups completed in an interrupted run')
+    parser.add_argument('-m', '--mode', default='full',
+                        choices=['full', 'count', 'estimate'],
+                        help='process groups fully, or only count (or'
+                        ' estimate) their compounds (default: full)')
+    parser.add_argument('--check', action='store_true',
+                        help='only check group definitions, without'
+                        ' processing them')
+    parser.add_argument('--queue_url',
+                        help='database URL of shared work queue')
+    parser.add_argument('--enqueue', action='store_true',
+                        help='add groups to the work queue for workers')
+    parser.add_argument('--worker', action='store_true',
+                        help='process groups from the work queue')
+    parser.add_argument('--collect', action='store_true',
+                        help='collect results of groups in the work queue')
+    parser.add_argument('--serve', action='store_true',
+                        help='run a query service over HTTP')
+    parser.add_argument('--host', default='127.0.0.1',
+                        help='address for the query service to listen on')
+    parser.add_argument('--port', type=int,
+                        help='port for the query service to listen on'
+                        ' (default: 8765)')
+    parser.add_argument('--allow-remote', action='store_true',
+                        help='let the query service listen on a non-loopback'
+                        ' address (anyone who can reach it can run SQL)')
     parser.add_argument('-l', '--level', action='count',
                         help='show more logging output in console')
     parser.add_argument('-v', '--version', action='store_true',
@@ -47,11 +84,10 @@ def create_parser():
 
 def set_console_loglevel(level):
     """Change console log level from default (INFO), if specified."""
-    console = logger.handlers[0]
     if not level:
         return
     elif level > 0:
-        console.setLevel('DEBUG')
+        logconf.CONSOLE.setLevel('DEBUG')
 
 
 def print_version_info():
@@ -77,25 +113,79 @@ def main():
 
     set_console_loglevel(args.level)
 
+    distributed = args.enqueue or args.worker or args.collect
+    if distributed and args.mode != 'full':
+        parser.error('--mode {} cannot be used with a work queue'
+                     .format(args.mode))
+    if args.serve and not args.allow_remote:
+        from commongroups.service import is_loopback
+        if not is_loopback(args.host):
+            parser.error('--host {} is not a loopback address; the query '
+                         'service runs any SQL it is sent, so add '
+                         '--allow-remote to serve it anyway'.format(args.host))
+
+    if args.database_url:
+        # Each -d option gives a list of URLs.
+        args.database_url = [url for urls in args.database_url
+                             for url in urls]
+
     opt_keys = [
         'database_url',
         'google_key_file',
         'google_sheet_title',
-        'google_worksheet'
+        'google_worksheet',
+        'queue_url'
     ]
     _args = vars(args)
     opts = {k: _args[k] for k in opt_keys if _args[k] is not None}
 
+    from commongroups.env import CommonEnv
     env = CommonEnv(name=args.project,
                     env_path=args.env_path,
                     **opts)
 
+    if args.serve:
+        from commongroups.service import serve, DEFAULT_PORT
+        serve(env, args.host, args.port or DEFAULT_PORT, args.allow_remote)
+        return
+
+    from commongroups.ops import (batch_process,
+                                  cmgs_from_file,
+                                  cmgs_from_googlesheet,
+                                  count_groups)
     if args.params_file:
         cmg_gen = cmgs_from_file(env, args.params_file)
-    else:
+    elif not distributed or args.enqueue or args.check:
         cmg_gen = cmgs_from_googlesheet(env)
 
-    batch_process(cmg_gen, env)
+    if args.check:
+        from commongroups.preflight import preflight
+        if preflight(cmg_gen, env)['failed']:
+            raise SystemExit(1)
+        return
+
+    if args.mode != 'full':
+        count_groups(cmg_gen, env, mode=args.mode)
+        return
+
+    if not distributed:
+        batch_process(cmg_gen, env, resume=args.resume)
+        return
+
+    from commongroups.workqueue import (collect_from_queue,
+                                        queue_from_env,
+                                        run_worker)
+    queue = queue_from_env(env)
+    if args.enqueue:
+        if env.config.get('preflight'):
+            from commongroups.preflight import preflight_groups
+            cmg_gen = preflight_groups(
+                cmg_gen, env, abort=env.config['preflight'] == 'abort')
+        queue.enqueue(cmg_gen)
+    if args.worker:
+        run_worker(env, queue)
+    if args.collect:
+        collect_from_queue(env, queue)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,318 @@
+# coding: utf-8
+
+"""
+HTTP service for ad-hoc queries, with warm connections and caches.
+
+The service keeps a project environment, its database connection pool,
+compiled queries, and query results in memory between requests, so that
+questions like "what's in this group?" are answered without starting up a
+new process. Requests are handled concurrently, each in its own thread.
+
+Endpoints (all responses are JSON, except for metrics):
+
+-  ``GET /health``: Check that the service is running.
+-  ``GET /metrics``: Query latencies and row counts in the Prometheus text
+   format (see :mod:`commongroups.metrics`).
+-  ``POST /populate``: Populate a group. The request body is a group's
+   parameters, or an object with ``params`` and an optional ``limit`` on the
+   number of compounds returned (default :data:`DEFAULT_LIMIT`).
+-  ``POST /count``: Count the compounds in a group, with the same request body.
+-  ``GET /memberships/<id>``: List the groups that contain a compound, given
+   its DTXSID, CASRN, or CID, according to the inverted index in the project's
+   ``results`` directory (see :mod:`commongroups.invindex`).
+-  ``POST /memberships``: List the groups of many compounds at once. The
+   request body is an object with a list of ``ids``.
+-  ``POST /reload``: Reopen the index, e.g. after a new run.
+
+Since group parameters may include SQL ``code``, anyone who can send requests
+to the service can run SQL on the database, with the project's credentials.
+The service therefore only listens on a loopback address, unless explicitly
+allowed otherwise (see :func:`create_server`).
+"""
+
+import ipaddress
+import json
+import logging
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+import threading
+import time
+from weakref import WeakValueDictionary
+
+from boltons.cacheutils import LRU
+from sqlalchemy.exc import SQLAlchemyError
+
+from commongroups.errors import MissingParamError
+from commongroups.invindex import build_index, InvertedIndex
+from commongroups import metrics
+from commongroups.ops import params_hash
+from commongroups.query import QueryMethod
+from commongroups.snapshot import current_snapshot, QUERY_COLUMNS
+from commongroups import logconf  # pylint: disable=unused-import
+logger = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+DEFAULT_PORT = 8765
+DEFAULT_LIMIT = 100
+CACHE_SIZE = 256
+
+
+class QueryService(object):
+    """
+    Queries and lookups, with connections and caches kept warm.
+
+    Parameters:
+        env (:class:`commongroups.env.CommonEnv`): Project environment, whose
+            database is queried and whose results are used for lookups.
+        cache_size (int): Number of compiled queries, of query results, and of
+            counts kept in memory (least recently used are dropped first).
+    """
+    def __init__(self, env, cache_size=CACHE_SIZE):
+        self.env = env
+        if not env.database:
+            env.connect_database()
+        if env.config.get('prewarm'):
+            env.prewarm_database()
+        self.optimize = env.config.get('optimize_queries', False)
+        self.snapshot = None
+        if env.config.get('snapshot'):
+            self.snapshot = current_snapshot(env)
+        self._queries = LRU(max_size=cache_size)
+        self._results = LRU(max_size=cache_size)
+        self._counts = LRU(max_size=cache_size)
+        self._index = None
+        self._lock = threading.Lock()
+        # Locks are only kept while some thread uses them.
+        self._key_locks = WeakValueDictionary()
+
+    def _key_lock(self, key):
+        """Return a lock so that only one thread computes a missing item."""
+        with self._lock:
+            lock = self._key_locks.get(key)
+            if lock is None:
+                lock = self._key_locks[key] = threading.Lock()
+            return lock
+
+    def query_method(self, params):
+        """Return a (cached) query method for group parameters."""
+        key = params_hash(params)
+        qmethod = self._queries.get(key)
+        if qmethod is None:
+            columns = QUERY_COLUMNS if self.snapshot is not None else None
+            qmethod = QueryMethod(params, optimize=self.optimize,
+                                  columns=columns)
+            self._queries.setdefault(key, qmethod)
+        return qmethod
+
+    def populate(self, params):
+        """
+        Populate a group, using cached results if available.
+
+        Returns:
+            A pandas :class:`DataFrame` of compounds.
+        """
+        key = params_hash(params)
+        res = self._results.get(key)
+        if res is None:
+            with self._key_lock(key):
+                res = self._results.get(key)
+                if res is None:
+                    res = self.query_method(params)(self.env.database)
+                    if self.snapshot is not None:
+                        res = self.snapshot.join(res)
+                    self._results[key] = res
+        return res
+
+    def count(self, params):
+        """Count the compounds in a group, using cached results if any."""
+        key = params_hash(params)
+        res = self._results.get(key)
+        if res is not None:
+            return len(res)
+        num = self._counts.get(key)
+        if num is None:
+            num = self.query_method(params).count(self.env.database)
+            self._counts[key] = num
+        return num
+
+    def load_memberships(self):
+        """
+        (Re)open the inverted index of compounds to groups.
+
+        The index is built from the member lists if it does not exist yet.
+        """
+        try:
+            index = InvertedIndex(self.env.results_path)
+        except FileNotFoundError:
+            index = build_index(self.env.results_path)
+        self._index = index
+        logger.info('Loaded memberships of %i compounds', len(index))
+        return index
+
+    def lookup(self, keys):
+        """Return lists of the IDs of the groups that contain compounds."""
+        if self._index is None:
+            with self._key_lock('memberships'):
+                if self._index is None:
+                    self.load_memberships()
+        return self._index.lookup(keys)
+
+    def memberships(self, key):
+        """Return the IDs of the groups that contain a compound."""
+        return self.lookup([key])[0]
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    """Handle requests to a :class:`QueryService`."""
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        """Handle ``GET`` requests."""
+        service = self.server.service
+        path = self.path.rstrip('/')
+        if path == '/health':
+            self.respond(200, {'status': 'ok'})
+        elif path == '/metrics':
+            self.send(200, metrics.REGISTRY.render().encode('utf-8'),
+                      metrics.CONTENT_TYPE)
+        elif path.startswith('/memberships/'):
+            key = path[len('/memberships/'):]
+            try:
+                groups = service.memberships(key)
+            except Exception:  # pylint: disable=broad-except
+                logger.exception('Request failed: GET %s', self.path)
+                self.respond(500, {'error': 'Internal error'})
+                return
+            self.respond(200, {'id': key, 'groups': groups})
+        else:
+            self.respond(404, {'error': 'Not found: {}'.format(self.path)})
+
+    def do_POST(self):  # pylint: disable=invalid-name
+        """Handle ``POST`` requests."""
+        service = self.server.service
+        path = self.path.rstrip('/')
+        try:
+            if path == '/reload':
+                num = len(service.load_memberships())
+                self.respond(200, {'compounds': num})
+                return
+            body = self.read_json()
+            if path == '/memberships':
+                keys = body.get('ids')
+                if not isinstance(keys, list):
+                    raise ValueError('Request body must have a list of ids')
+                self.respond(200, {'memberships': dict(
+                    zip(keys, service.lookup(keys)))})
+                return
+            params = body.get('params', body)
+            if not isinstance(params, dict):
+                raise ValueError('Group parameters must be a JSON object')
+            params.setdefault('cmg_id', 'preview')
+            if path == '/count':
+                self.respond(200, {'cmg_id': params['cmg_id'],
+                                   'count': service.count(params)})
+            elif path == '/populate':
+                res = service.populate(params)
+                limit = int(body.get('limit', DEFAULT_LIMIT))
+                records = json.loads(res.head(limit).to_json(
+                    orient='records', default_handler=str))
+                self.respond(200, {'cmg_id': params['cmg_id'],
+                                   'count': len(res),
+                                   'compounds': records})
+            else:
+                self.respond(404, {'error': 'Not found: {}'.format(self.path)})
+        except (MissingParamError, NotImplementedError, ValueError) as exc:
+            self.respond(400, {'error': str(exc)})
+        except SQLAlchemyError as exc:
+            logger.error('Query failed: %s', exc)
+            self.respond(500, {'error': str(exc.__cause__ or exc)})
+        except Exception:  # pylint: disable=broad-except
+            logger.exception('Request failed: POST %s', self.path)
+            self.respond(500, {'error': 'Internal error'})
+
+    def read_json(self):
+        """Read the JSON request body."""
+        length = int(self.headers.get('Content-Length', 0))
+        body = json.loads(self.rfile.read(length).decode('utf-8') or '{}')
+        if not isinstance(body, dict):
+            raise ValueError('Request body must be a JSON object')
+        return body
+
+    def respond(self, status, content):
+        """Send a JSON response."""
+        self.send(status, json.dumps(content).encode('utf-8'),
+                  'application/json')
+
+    def send(self, status, data, content_type):
+        """Send a response."""
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        logger.debug('%s %s', self.address_string(), format % args)
+
+
+class ServiceServer(ThreadingMixIn, HTTPServer):
+    """HTTP server handling each request in a new thread."""
+    daemon_threads = True
+
+    def __init__(self, address, service):
+        super().__init__(address, RequestHandler)
+        self.service = service
+
+
+def is_loopback(host):
+    """Return whether a host name or address refers to the local machine."""
+    if host == 'localhost':
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+
+def create_server(env, host='127.0.0.1', port=DEFAULT_PORT,
+                  allow_remote=False):
+    """
+    Create a query service for a project environment.
+
+    Parameters:
+        env (:class:`commongroups.env.CommonEnv`): Project environment.
+        host (str): Address to listen on.
+        port (int): Port to listen on; ``0`` picks a free port.
+        allow_remote (bool): Whether to allow listening on an address other
+            than a loopback address. Anyone who can reach the service can run
+            arbitrary SQL on the database.
+
+    Returns:
+        :class:`ServiceServer` object; call its ``serve_forever`` method.
+
+    Raises:
+        ValueError: If ``host`` is not a loopback address, and
+            ``allow_remote`` is not set.
+    """
+    if not (allow_remote or is_loopback(host)):
+        raise ValueError('Refusing to serve queries on a non-loopback '
+                         'address: {}'.format(host))
+    if not is_loopback(host):
+        logger.warning('Query service is reachable from other machines, '
+                       'which can run any SQL on the database')
+    server = ServiceServer((host, port), QueryService(env))
+    logger.info('Query service listening on http://%s:%i/',
+                *server.server_address[:2])
+    return server
+
+
+def serve(env, host='127.0.0.1', port=DEFAULT_PORT, allow_remote=False):
+    """Run the query service until interrupted; see :func:`create_server`."""
+    server = create_server(env, host, port, allow_remote)
+    started = time.time()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        logger.info('Query service stopped after %.0f s',
+                    time.time() - started)
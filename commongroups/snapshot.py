@@ -0,0 +1,353 @@
+# coding: utf-8
+
+"""
+Snapshot of compound identifiers and names, for joining to query results.
+
+The identifiers and names of all compounds (:data:`SNAPSHOT_COLUMNS`) are
+exported once from the database to the ``snapshot`` subdirectory of the
+project's ``data`` directory, as columnar NumPy files:
+
+-  ``dtxsid.npy``: Sorted compound IDs. A compound with several CIDs or CASRNs
+   has one row for each, as in the database's ``compounds`` view.
+-  ``<column>.npy``, ``<column>.offsets.npy``: The UTF-8 encoded values of
+   each other column, concatenated, and the offset of each row's value.
+   Missing values are empty.
+-  ``snapshot.json``: The build of the database that the snapshot was taken
+   from (see ``tools/construct_database.py``), the number of rows, and the
+   type of the values of each column (:data:`COLUMN_TYPES`), so that e.g.
+   integer CIDs are joined to query results as integers, as the database
+   returns them.
+
+The files are memory-mapped when the snapshot is opened, so that any number of
+processes share them, and only the rows joined to a group's results are read.
+Queries then only need to return the compound IDs and structures.
+"""
+
+import argparse
+from datetime import datetime
+import json
+import logging
+from os.path import join as pjoin
+
+from boltons.fileutils import atomic_save, mkdir_p
+import numpy as np
+import pandas as pd
+from sqlalchemy import select, text
+from sqlalchemy.exc import SQLAlchemyError
+
+from commongroups.env import CommonEnv
+from commongroups.query import COLUMNS, ORD_KEY, TABLE
+from commongroups import logconf  # pylint: disable=unused-import
+logger = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+SNAPSHOT_DIR = 'snapshot'
+SNAPSHOT_COLUMNS = ['dtxsid', 'cid', 'casrn', 'name', 'inchikey']
+BUILD_TABLE = 'build_info'
+
+# Types of column values recorded in a snapshot, by Python type. Values of
+# other types are stored and joined as text.
+COLUMN_TYPES = {int: 'int', float: 'float'}
+
+# Columns that queries still return when a snapshot is joined to the results.
+QUERY_COLUMNS = [col for col in COLUMNS
+                 if col == ORD_KEY or col not in SNAPSHOT_COLUMNS]
+
+
+def database_build(con):
+    """
+    Return the build ID of a compounds database.
+
+    Parameters:
+        con: SQLAlchemy database :class:`Engine` object, or a list of these
+            for a sharded database.
+
+    Returns:
+        The latest ``build_id`` in the :data:`BUILD_TABLE` table (joined by
+        ``+`` for shards), or ``None`` if the database has no build info.
+    """
+    if isinstance(con, (list, tuple)):
+        builds = [database_build(shard) for shard in con]
+        return None if None in builds else '+'.join(builds)
+    que = text('SELECT build_id FROM {} ORDER BY created DESC'
+               ' LIMIT 1'.format(BUILD_TABLE))
+    try:
+        return con.execute(que).scalar()
+    except SQLAlchemyError:
+        return None
+
+
+def _fetch_rows(con):
+    """
+    Fetch the :data:`SNAPSHOT_COLUMNS` of all compounds.
+
+    Rows are sorted in Python, rather than by the database, so that their
+    order matches the binary search in :meth:`Snapshot.rows` regardless of
+    the database's collation.
+    """
+    cons = con if isinstance(con, (list, tuple)) else [con]
+    que = select([TABLE.c[col] for col in SNAPSHOT_COLUMNS])
+    rows = []
+    for shard in cons:
+        rows.extend(tuple(row) for row in shard.execute(que))
+    rows.sort(key=lambda row: tuple('' if val is None else str(val)
+                                    for val in row))
+    return rows
+
+
+def _encode(values):
+    """Encode text values as a byte array and an array of offsets."""
+    data = [b'' if val is None else str(val).encode('utf-8')
+            for val in values]
+    offsets = np.zeros(len(data) + 1, dtype=np.int64)
+    np.cumsum([len(val) for val in data], out=offsets[1:])
+    return np.frombuffer(b''.join(data), dtype=np.uint8), offsets
+
+
+def _column_type(values):
+    """Return the type of the values of a column; see :data:`COLUMN_TYPES`."""
+    kinds = {COLUMN_TYPES.get(type(val), 'str')
+             for val in values if val is not None}
+    return kinds.pop() if len(kinds) == 1 else 'str'
+
+
+def _typed(values, kind):
+    """
+    Convert the text values of a column back to their type.
+
+    Integers with missing values become a nullable integer array.
+    """
+    if kind == 'int':
+        values = [None if val is None else int(val) for val in values]
+        if None in values:
+            return pd.array(values, dtype='Int64')
+        return np.array(values, dtype=np.int64)
+    if kind == 'float':
+        return np.array([None if val is None else float(val)
+                         for val in values], dtype=np.float64)
+    return values
+
+
+def _save_array(path, arr):
+    """Save an array to a NumPy file, atomically."""
+    with atomic_save(path) as npy_file:
+        np.save(npy_file, arr)
+
+
+def export_snapshot(env, con=None):
+    """
+    Export the identifiers and names of all compounds to a snapshot.
+
+    Parameters:
+        env (:class:`commongroups.env.CommonEnv`): Project environment; the
+            snapshot is written to its ``data`` directory.
+        con: Optional SQLAlchemy database :class:`Engine` object (or list of
+            these); by default, the environment's database.
+
+    Returns:
+        :class:`Snapshot` object, or ``None`` if the database has no build
+        info, in which case a snapshot could not be kept up to date.
+    """
+    if con is None:
+        con = env.database or env.connect_database()
+    build = database_build(con)
+    if build is None:
+        logger.error('Database has no %s table; not exporting snapshot',
+                     BUILD_TABLE)
+        return None
+    logger.info('Exporting snapshot of compounds, database build %s', build)
+    rows = _fetch_rows(con)
+    columns = list(zip(*rows)) or [()] * len(SNAPSHOT_COLUMNS)
+    path = pjoin(env.data_path, SNAPSHOT_DIR)
+    mkdir_p(path)
+    _save_array(pjoin(path, '{}.npy'.format(ORD_KEY)),
+                np.array([val.encode('ascii') for val in columns[0]],
+                         dtype=bytes))
+    for col, values in zip(SNAPSHOT_COLUMNS[1:], columns[1:]):
+        data, offsets = _encode(values)
+        _save_array(pjoin(path, '{}.npy'.format(col)), data)
+        _save_array(pjoin(path, '{}.offsets.npy'.format(col)), offsets)
+    meta = {'build': build, 'rows': len(rows), 'columns': SNAPSHOT_COLUMNS,
+            'types': {col: _column_type(values)
+                      for col, values in zip(SNAPSHOT_COLUMNS, columns)},
+            'created': datetime.now().isoformat()}
+    with atomic_save(pjoin(path, 'snapshot.json'),
+                     text_mode=True) as meta_file:
+        json.dump(meta, meta_file, indent=2, sort_keys=True)
+    logger.info('Exported %i rows to snapshot: %s', len(rows), path)
+    return Snapshot(path)
+
+
+class Snapshot(object):
+    """
+    Memory-mapped snapshot of the :data:`SNAPSHOT_COLUMNS` of compounds.
+
+    Parameters:
+        path (str): Snapshot directory.
+
+    Raises:
+        FileNotFoundError: If there is no snapshot.
+        ValueError: If the snapshot files are inconsistent, e.g. while the
+            snapshot is being exported.
+    """
+    def __init__(self, path):
+        with open(pjoin(path, 'snapshot.json'), 'r') as meta_file:
+            meta = json.load(meta_file)
+        self.path = path
+        self.build = meta['build']
+        # Snapshots exported by earlier versions hold text only.
+        self.types = meta.get('types', {})
+        self.ids = np.load(pjoin(path, '{}.npy'.format(ORD_KEY)),
+                           mmap_mode='r')
+        self._columns = {}
+        for col in SNAPSHOT_COLUMNS[1:]:
+            data = np.load(pjoin(path, '{}.npy'.format(col)), mmap_mode='r')
+            offsets = np.load(pjoin(path, '{}.offsets.npy'.format(col)),
+                              mmap_mode='r')
+            if len(offsets) != meta['rows'] + 1 or offsets[-1] != len(data):
+                raise ValueError('Inconsistent snapshot: {}'.format(path))
+            self._columns[col] = (data, offsets)
+        if len(self.ids) != meta['rows']:
+            raise ValueError('Inconsistent snapshot: {}'.format(path))
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __repr__(self):
+        return 'Snapshot({})'.format(repr(self.path))
+
+    def rows(self, keys):
+        """
+        Find the rows of compounds in the snapshot.
+
+        Parameters:
+            keys (iterable): Compound IDs (``dtxsid``).
+
+        Returns:
+            Tuple of arrays: the number of rows of each compound, and the
+            positions of these rows, in order (``-1`` for one row of each
+            compound that is not in the snapshot).
+        """
+        keys = np.array([str(key).encode('ascii') for key in keys],
+                        dtype=bytes)
+        left = np.searchsorted(self.ids, keys, side='left')
+        right = np.searchsorted(self.ids, keys, side='right')
+        counts = right - left
+        missing = counts == 0
+        counts[missing] = 1
+        starts = np.cumsum(counts) - counts
+        pos = np.arange(counts.sum()) + np.repeat(left - starts, counts)
+        pos[np.repeat(missing, counts)] = -1
+        return counts, pos
+
+    def values(self, col, pos):
+        """
+        Read the values of a column in some rows.
+
+        Parameters:
+            col (str): One of the :data:`SNAPSHOT_COLUMNS`.
+            pos (numpy.ndarray): Row positions; ``-1`` gives ``None``.
+
+        Returns:
+            List of values (str or ``None``).
+        """
+        if col == ORD_KEY:
+            return [None if row < 0 else self.ids[row].decode('ascii')
+                    for row in pos.tolist()]
+        data, offsets = self._columns[col]
+        buf = memoryview(data)
+        starts = offsets[pos].tolist()
+        ends = offsets[pos + 1].tolist()
+        return [None if row < 0 or start == end else
+                str(buf[start:end], 'utf-8')
+                for row, start, end in zip(pos.tolist(), starts, ends)]
+
+    def join(self, frame):
+        """
+        Join the :data:`SNAPSHOT_COLUMNS` of compounds to query results.
+
+        A compound with several rows in the snapshot (e.g. several CASRNs)
+        gets as many rows in the result, as if the query had returned all
+        columns. Compounds that are not in the snapshot get ``None`` values.
+        Values are converted back to the type that they had in the database
+        (see :data:`COLUMN_TYPES`).
+
+        Parameters:
+            frame: A pandas :class:`DataFrame` of query results, with
+                :data:`commongroups.query.ORD_KEY` values.
+
+        Returns:
+            A new :class:`DataFrame`, with columns in the order of
+            :data:`commongroups.query.COLUMNS`, followed by any other columns
+            of ``frame``.
+        """
+        frame = frame.drop_duplicates(ORD_KEY)
+        counts, pos = self.rows(frame[ORD_KEY])
+        ret = frame.iloc[np.repeat(np.arange(len(frame)), counts)]
+        ret = ret.reset_index(drop=True)
+        for col in SNAPSHOT_COLUMNS[1:]:
+            ret[col] = _typed(self.values(col, pos),
+                              self.types.get(col, 'str'))
+        cols = [col for col in COLUMNS if col in ret]
+        cols += [col for col in ret if col not in cols]
+        return ret[cols]
+
+
+# Snapshots opened in this process, by path.
+_SNAPSHOTS = {}
+
+
+def current_snapshot(env, export=False):
+    """
+    Return the project's snapshot if it matches the database build.
+
+    Parameters:
+        env (:class:`commongroups.env.CommonEnv`): Project environment.
+        export (bool): Whether to export a new snapshot if there is none, or
+            if it is out of date.
+
+    Returns:
+        :class:`Snapshot` object, or ``None`` if there is no current snapshot.
+    """
+    path = pjoin(env.data_path, SNAPSHOT_DIR)
+    con = env.database or env.connect_database()
+    build = database_build(con)
+    snapshot = _SNAPSHOTS.get(path)
+    if snapshot is None or snapshot.build != build:
+        try:
+            snapshot = Snapshot(path)
+        except (OSError, ValueError):
+            snapshot = None
+    if snapshot is not None and (build is None or snapshot.build != build):
+        logger.warning('Snapshot is not from the current database build: %s',
+                       path)
+        snapshot = None
+    if snapshot is None and export:
+        snapshot = export_snapshot(env, con)
+    if snapshot is None:
+        _SNAPSHOTS.pop(path, None)
+    else:
+        _SNAPSHOTS[path] = snapshot
+    return snapshot
+
+
+def main():
+    """Export a snapshot of compounds from a project's database."""
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument('-p', '--project', help='project name')
+    parser.add_argument('-e', '--env_path', help='path to commongroups home')
+    parser.add_argument('-d', '--database_url', nargs='+', action='append',
+                        help='database URL, or URLs of several shards'
+                        ' (after one or several -d options)')
+    args = parser.parse_args()
+    opts = {}
+    if args.database_url:
+        # Each -d option gives a list of URLs.
+        opts['database_url'] = [url for urls in args.database_url
+                                for url in urls]
+    env = CommonEnv(name=args.project, env_path=args.env_path, **opts)
+    if current_snapshot(env, export=True) is None:
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -15,27 +15,64 @@ Side-effects:
 
 # pylint: disable=invalid-name,missing-docstring
 
+import hashlib
 from itertools import islice
 import json
+import logging
 import os
 from os.path import exists, join as pjoin
+import subprocess
+import sys
 from pkg_resources import resource_filename, resource_string
 
-from pandas import DataFrame
+from boltons.fileutils import mkdir_p
+from pandas import concat, DataFrame
+from pandas.api.types import is_integer_dtype
 import pytest
 from sqlalchemy.engine import Engine
 from sqlalchemy.sql import Select
 
-from commongroups.cmgroup import CMGroup
+from commongroups import logconf, metrics
+from commongroups.cmgroup import alias_text, CMGroup
 from commongroups.env import CommonEnv
-from commongroups.errors import MissingParamError, NoCredentialsError
-from commongroups.hypertext import directory
+from commongroups.diff import diff_runs, merge_diff, read_members
+from commongroups.errors import (MissingParamError, NoCredentialsError,
+                                 PreflightError)
+from commongroups.hypertext import directory, templates_dir
+from commongroups.invindex import build_index, InvertedIndex
 from commongroups.googlesheet import SheetManager
-from commongroups.ops import (batch_process,
+from commongroups.ops import (append_to_manifest,
+                              batch_process,
                               cmgs_from_file,
                               cmgs_from_googlesheet,
-                              collect_to_json)
-from commongroups.query import QueryMethod, get_query_results
+                              collect_from_manifest,
+                              collect_to_json,
+                              count_groups,
+                              dependency_order,
+                              detect_parents,
+                              is_complete,
+                              read_journal,
+                              read_manifest,
+                              start_manifest)
+from commongroups.outputs import read_checksums, save_output
+from commongroups.overlap import (analyze_overlap,
+                                  encode_bitsets,
+                                  overlap_matrix)
+from commongroups.preflight import (preflight,
+                                    preflight_groups,
+                                    structure_problems)
+from commongroups.query import (fast_predicate,
+                                get_query_results,
+                                optimize_where,
+                                pattern_list,
+                                QueryMethod,
+                                split_conjunction)
+from commongroups.service import create_server, QueryService
+from commongroups.snapshot import (current_snapshot,
+                                   database_build,
+                                   export_snapshot,
+                                   SNAPSHOT_COLUMNS)
+from commongroups.workqueue import WorkQueue, collect_from_queue, run_worker
 
 PARAMS_JSON = resource_filename(__name__, 'params.json')
 LOCAL_PARAMS = json.loads(resource_string(__name__, 'params.json').decode())
@@ -73,6 +110,16 @@ def check_cmg(cmg):
 
 
 # Tests:
+def test_lazy_imports():
+    code = ('import sys, commongroups.run, commongroups.hypertext; '
+            'print(" ".join(sorted(m for m in ["ashes", "gspread", "pandas", '
+            '"pkg_resources", "sqlalchemy"] if m in sys.modules)))')
+    out = subprocess.check_output([sys.executable, '-c', code],
+                                  universal_newlines=True)
+    assert out.strip() == ''
+    assert exists(pjoin(templates_dir(), 'cmgroup.html'))
+
+
 def test_env_config():
     assert env.config['google_worksheet'] == 'test'
     assert len(blank_env.config) == 0
@@ -83,11 +130,84 @@ def test_env_config():
         gen = cmgs_from_googlesheet(blank_env)
 
 
+def test_logging():
+    handlers = logging.getLogger('commongroups').handlers
+    assert handlers == [logconf.QUEUE_HANDLER]
+    keys = set(logconf._HANDLERS)  # pylint: disable=protected-access
+    CommonEnv('test')
+    assert set(logconf._HANDLERS) == keys  # pylint: disable=protected-access
+    json_env = CommonEnv('test', log_json=True)
+    batch_process(cmgs_from_file(json_env, PARAMS_JSON), json_env)
+    logconf.flush()
+    log_path = pjoin(json_env.project_path, 'log')
+    records = [json.loads(line)
+               for name in os.listdir(log_path) if name.endswith('.jsonl')
+               for line in open(pjoin(log_path, name))]
+    assert {'cmg_id', 'count', 'query_seconds'} <= set(records[-1])
+
+
+def test_metrics():
+    metrics_env = CommonEnv('test', metrics_file=True, progress=False)
+    cmgs = list(cmgs_from_file(metrics_env, PARAMS_JSON))
+    batch_process(cmgs, metrics_env)
+    assert metrics.GROUPS_PLANNED.value() == len(cmgs)
+    assert metrics.GROUPS.value(status='processed') == len(cmgs)
+    assert metrics.QUERY_SECONDS.count(method='SQL') > 0
+    assert metrics.STAGE_SECONDS.count(stage='output') == len(cmgs)
+    with open(pjoin(metrics_env.project_path, 'metrics.prom')) as prom:
+        text = prom.read()
+    assert 'commongroups_groups_total{{status="processed"}} {0}'.format(
+        float(len(cmgs))) in text
+    assert 'commongroups_write_seconds_bucket{kind="xlsx",le="+Inf"}' in text
+    assert '/{0} groups'.format(len(cmgs)) in metrics.progress_text()
+
+
+def test_preflight():
+    cmgs = list(cmgs_from_file(env, PARAMS_JSON))
+    bad_smarts = CMGroup(env, dict(LOCAL_PARAMS[1]['params'],
+                                   cmg_id='x900001', structure='[cH]1c('))
+    bad_code = CMGroup(env, dict(LOCAL_PARAMS[0]['params'], cmg_id='x900002',
+                                 code=':m @> :s AND compounds.nmae > 0'))
+    child = CMGroup(env, dict(LOCAL_PARAMS[0]['params'], cmg_id='x900003',
+                              parent='x900002'))
+    bad = [bad_smarts, bad_code, child]
+    report = preflight(cmgs + bad, env)
+    assert report['checked'] == len(cmgs) + 3
+    assert [item['cmg_id'] for item in report['failed']] == \
+        ['x900001', 'x900002', 'x900003']
+    assert exists(pjoin(env.data_path, 'preflight.json'))
+    assert preflight_groups(bad + cmgs, env) == cmgs
+    with pytest.raises(PreflightError):
+        preflight_groups(cmgs + bad, env, abort=True)
+
+
+def test_count_modes():
+    cmgs = list(cmgs_from_file(env, PARAMS_JSON))
+    count_groups(cmgs, env)
+    for cmg in cmgs:
+        assert cmg.info['count_mode'] == 'count'
+        assert cmg.info['count'] == len(cmg.query(env.database))
+    assert exists(pjoin(env.results_path, 'counts.csv'))
+    count_groups(cmgs, env, mode='estimate')
+    for cmg in cmgs:
+        assert cmg.info['count_mode'] == 'estimate'
+        assert isinstance(cmg.info['count'], int)
+
+
 def test_env_db():
     env.connect_database()
     assert isinstance(env.database, Engine)
 
 
+def test_env_db_tuning():
+    tuned_env = CommonEnv('test', engine_options={'pool_pre_ping': True},
+                          session_params={'work_mem': '64MB'},
+                          prewarm=['compounds'])
+    tuned_env.connect_database()
+    assert tuned_env.database.execute('SHOW work_mem').scalar() == '64MB'
+    tuned_env.prewarm_database()
+
+
 def test_cmgs_IO():
     for params in LOCAL_PARAMS:
         check_params(params)
@@ -104,6 +224,63 @@ def test_cmgs_IO():
     assert exists(html_dir_path)
 
 
+def test_cmgs_from_jsonl_csv():
+    jsonl_path = pjoin(env.data_path, 'params.jsonl')
+    with open(jsonl_path, 'w') as jsonl_file:
+        for params in LOCAL_PARAMS:
+            jsonl_file.write(json.dumps(params) + '\n')
+    csv_path = pjoin(env.data_path, 'params.csv')
+    DataFrame([dict(item['params'], **item['info'])
+               for item in LOCAL_PARAMS]).to_csv(csv_path, index=False)
+    for path in [jsonl_path, csv_path]:
+        cmgs = list(cmgs_from_file(env, path))
+        assert len(cmgs) == len(LOCAL_PARAMS)
+        for cmg, params in zip(cmgs, LOCAL_PARAMS):
+            check_cmg(cmg)
+            assert cmg.params == params['params']
+    bad_path = pjoin(env.data_path, 'bad_params.jsonl')
+    with open(bad_path, 'w') as jsonl_file:
+        jsonl_file.write(json.dumps({'params': PAR_FAIL_QM, 'info': {}}))
+    with pytest.raises(MissingParamError):
+        list(cmgs_from_file(env, bad_path))
+
+
+def test_cmgs_from_xlsx():
+    from openpyxl import Workbook
+    records = [dict(item['params'], **item['info']) for item in LOCAL_PARAMS]
+    keys = sorted(set().union(*records)) + ['include']
+    workbook = Workbook()
+    sheet = workbook.active
+    sheet.append(keys)
+    for num, record in enumerate(records):
+        # Patterns listed in one cell, separated by whitespace.
+        record['include'] = '[OH] [NH2]' if num == 0 else None
+        sheet.append([record.get(key) for key in keys])
+    sheet.append([])
+    sheet.append(['after a blank row'] * len(keys))
+    xlsx_path = pjoin(env.data_path, 'params.xlsx')
+    workbook.save(xlsx_path)
+    cmgs = list(cmgs_from_file(env, xlsx_path))
+    for cmg in cmgs:
+        check_cmg(cmg)
+    expected = [dict(item['params']) for item in LOCAL_PARAMS]
+    expected[0]['include'] = '[OH] [NH2]'
+    assert [cmg.params for cmg in cmgs] == expected
+    assert pattern_list(cmgs[0].params['include']) == ['[OH]', '[NH2]']
+
+
+def test_manifest():
+    cmgs = list(cmgs_from_file(env, PARAMS_JSON))
+    start_manifest(env, 'test.jsonl')
+    for cmg in cmgs:
+        append_to_manifest(cmg, env, 'test.jsonl')
+    records = list(read_manifest(env, 'test.jsonl'))
+    assert [rec['params'] for rec in records] == [cmg.params for cmg in cmgs]
+    collect_from_manifest(env, 'test.jsonl')
+    with open(pjoin(env.results_path, 'cmgroups.json')) as json_file:
+        assert len(json.load(json_file)) == len(cmgs)
+
+
 def test_googlesheet():
     with pytest.raises(NoCredentialsError):
         gsm = SheetManager('Untitled', 'Sheet 1', 'KEYFILE.DNE')
@@ -138,6 +315,85 @@ def test_querymethod():
     res = get_query_results(qmd.expression, env.database)
     assert isinstance(res, DataFrame)
     assert len(res) == TEST_LIMIT
+    merged = qmd([env.database, env.database])
+    assert len(merged) == 2 * TEST_LIMIT
+    assert list(merged['dtxsid']) == sorted(merged['dtxsid'])
+
+
+def test_querymethod_elements():
+    params = {'cmg_id': 'x100001', 'name': 'Gold compounds',
+              'method': 'ELEMENTS', 'structure_type': 'elements',
+              'structure': 'Au', 'code': 'carbon_atoms = 0'}
+    qmd = QueryMethod(params)
+    assert isinstance(qmd.expression, Select)
+    res = qmd(env.database)
+    assert isinstance(res, DataFrame)
+    with pytest.raises(ValueError):
+        QueryMethod(dict(params, structure='Au; DROP TABLE compounds'))
+
+
+def test_querymethod_optimize():
+    params = LOCAL_PARAMS[3]['params']
+    qmd = QueryMethod(params, optimize='check')
+    assert qmd.original is not None
+    assert 'compounds.cc_bond' in qmd.get_literal()
+    res = qmd(env.database)
+    assert qmd.original is not None
+    ref = QueryMethod(params)(env.database)
+    assert list(res['dtxsid']) == list(ref['dtxsid'])
+    qmethod = QueryMethod(LOCAL_PARAMS[2]['params'], optimize=True)
+    assert qmethod.original is None
+    assert fast_predicate(':m @> :s', '[Au]') is not None
+    for pattern in ['[A]', '[R]', '[D]', '[X]', '[H]', '[C]']:
+        assert fast_predicate(':m @> :s ::qmol', pattern) is None
+        assert optimize_where(':m @> :s', pattern) is None
+    # The AND of BETWEEN ... AND ... is not a separate term.
+    where = optimize_where(
+        '(:m @> :s ::qmol) AND compounds.heavy_atoms BETWEEN 2 AND 10',
+        '[Au]')
+    assert where.endswith('(compounds.heavy_atoms BETWEEN 2 AND 10)')
+    assert split_conjunction(
+        'CASE WHEN a AND b THEN 1 END = 1 AND c') == \
+        ['CASE WHEN a AND b THEN 1 END = 1', 'c']
+
+
+def test_querymethod_smarts():
+    params = dict(LOCAL_PARAMS[3]['params'], method='SMARTS', code='',
+                  exclude='[C,c]~[C,c] [C!H0,c!H0]')
+    qmd = QueryMethod(params)
+    assert isinstance(qmd.expression, Select)
+    assert '[C,c]~[C,c]' not in str(qmd.expression)
+    assert '[C,c]~[C,c]' in qmd.get_literal()
+    res = qmd(env.database)
+    ref = QueryMethod(LOCAL_PARAMS[3]['params'])(env.database)
+    assert list(res['dtxsid']) == list(ref['dtxsid'])
+
+
+def test_querymethod_similarity():
+    params = {'cmg_id': 'x100002', 'name': 'Similar to 2,3,7,8-TCDD',
+              'method': 'SIMILARITY', 'structure_type': 'SMILES',
+              'structure': 'Clc1cc2Oc3cc(Cl)c(Cl)cc3Oc2cc1Cl',
+              'threshold': '0.6'}
+    res = QueryMethod(params)(env.database)
+    assert 'similarity' in res.columns
+    assert (res['similarity'] >= 0.6).all()
+    assert list(res['similarity']) == sorted(res['similarity'], reverse=True)
+    with pytest.raises(ValueError):
+        QueryMethod(dict(params, threshold='2'))
+
+
+def test_querymethod_scaffold():
+    params = dict(LOCAL_PARAMS[0]['params'], method='SCAFFOLD',
+                  structure_type='SMARTS',
+                  structure='c1ccc2c(c1)Oc1ccccc1O2', code=':m @> :s ::qmol')
+    res = QueryMethod(params)(env.database)
+    ref = QueryMethod(dict(params, method='SQL'))(env.database)
+    assert list(res['dtxsid']) == list(ref['dtxsid'])
+    kekule = dict(params, structure_type='SMILES', code='',
+                  structure='C1=CC2=C(C=C1)OC3=CC=CC=C3O2')
+    res = QueryMethod(kekule)(env.database)
+    assert list(res['dtxsid']) == list(ref['dtxsid'])
+    assert structure_problems(kekule) == []
 
 
 def test_cmg_process():
@@ -157,6 +413,84 @@ def test_cmg_process():
     cmg.to_html(formats=['json'])
 
 
+def test_snapshot():
+    if database_build(env.database) is None:
+        pytest.skip('database has no build info')
+    snapshot = export_snapshot(env)
+    assert current_snapshot(env) is not None
+    assert len(snapshot) > 0
+    ref = CMGroup(env, LOCAL_PARAMS[0]['params'], LOCAL_PARAMS[0]['info'])
+    ref.process(env.database)
+    cmg = CMGroup(env, LOCAL_PARAMS[0]['params'], LOCAL_PARAMS[0]['info'])
+    cmg.process(env.database, snapshot=snapshot)
+    assert 'casrn' not in cmg.query.columns
+    assert list(cmg.compounds.columns) == list(ref.compounds.columns)
+    for col in SNAPSHOT_COLUMNS:
+        values = cmg.compounds[col].dropna()
+        expected = ref.compounds[col].dropna()
+        if snapshot.types.get(col) == 'int':
+            assert is_integer_dtype(cmg.compounds[col])
+            values, expected = values.astype(int), expected.astype(int)
+        assert sorted(values.astype(str)) == sorted(expected.astype(str))
+
+
+def test_parent_groups():
+    pytest.importorskip('rdkit')
+    parent_params = dict(LOCAL_PARAMS[0]['params'], cmg_id='x100000',
+                         name='Dibenzodioxins',
+                         structure='C1=CC2=C(C=C1)OC3=CC=CC=C3O2')
+    child = CMGroup(env, LOCAL_PARAMS[0]['params'])
+    parent = CMGroup(env, parent_params)
+    detect_parents([child, parent])
+    assert child.parent == parent.cmg_id
+    assert parent.parent is None
+    done = {}
+    order = []
+    for cmg in dependency_order([child, parent], done):
+        order.append(cmg)
+        cmg.process(env.database, deps=done)
+        done[cmg.cmg_id] = cmg
+    assert order == [parent, child]
+    assert child.info['parent'] == parent.cmg_id
+    assert set(child.compounds['dtxsid']) <= set(parent.compounds['dtxsid'])
+
+
+def test_set_groups():
+    union = {'cmg_id': 'x200000', 'name': 'Union', 'method': 'SET',
+             'structure_type': 'cmg_id', 'structure': 'x000001 | x000002',
+             'code': ''}
+    diff = dict(union, cmg_id='x200001', name='Difference',
+                structure='x200000 - x000002')
+    cmgs = [CMGroup(env, union), CMGroup(env, diff)] + \
+        [CMGroup(env, item['params']) for item in LOCAL_PARAMS[:2]]
+    assert cmgs[1].dependencies == ['x200000', 'x000002']
+    done = {}
+    for cmg in dependency_order(cmgs, done):
+        cmg.process(env.database, deps=done)
+        done[cmg.cmg_id] = cmg
+    ids = {cmg_id: set(done[cmg_id].compounds['dtxsid']) for cmg_id in done}
+    assert ids['x200000'] == ids['x000001'] | ids['x000002']
+    assert ids['x200001'] == ids['x000001'] - ids['x000002']
+    assert list(done['x200000'].compounds['dtxsid']) == \
+        sorted(ids['x200000'])
+    with pytest.raises(ValueError):
+        QueryMethod(dict(union, structure='x000001 |'))
+
+
+def test_cmg_spill():
+    cmg = CMGroup(env, LOCAL_PARAMS[0]['params'], LOCAL_PARAMS[0]['info'])
+    assert cmg.spill() == 0
+    cmg.process(env.database)
+    nrows = len(cmg.compounds)
+    assert cmg.memory_usage() > 0
+    assert cmg.spill() > 0
+    assert cmg.spilled
+    assert cmg.memory_usage() == 0
+    assert exists(pjoin(env.data_path, '{}.pkl'.format(cmg.cmg_id)))
+    assert isinstance(cmg.compounds, DataFrame)
+    assert len(cmg.compounds) == nrows
+
+
 def test_batch_process():
     cmg_gen = cmgs_from_file(env, PARAMS_JSON)
     cmgs_done = batch_process(cmg_gen, env)
@@ -172,3 +506,190 @@ def test_batch_process():
             pjoin(cmg.results_path, 'html', '{}.html'.format(cmg.cmg_id))
         )
     assert exists(pjoin(env.results_path, 'html', 'index.html'))
+
+
+def test_unchanged_outputs():
+    cmgs_done = batch_process(cmgs_from_file(env, PARAMS_JSON), env)
+    paths = [pjoin(env.results_path, '{}.{}'.format(cmg.cmg_id, ext))
+             for cmg in cmgs_done for ext in ['xlsx', 'json']]
+    mtimes = [os.stat(path).st_mtime_ns for path in paths]
+    checksums = read_checksums(env.results_path)
+    assert '{}.xlsx'.format(cmgs_done[0].cmg_id) in checksums
+    batch_process(cmgs_from_file(env, PARAMS_JSON), env)
+    assert [os.stat(path).st_mtime_ns for path in paths] == mtimes
+    assert read_checksums(env.results_path) == checksums
+
+
+def test_output_checksums():
+    path = pjoin(env.results_path, 'checksums_test.txt')
+    index = pjoin(env.results_path, 'checksums.jsonl')
+    save_output(path, env.results_path, 'one')
+    # Another process replaces the file and records it in the meantime.
+    with open(path, 'w') as out:
+        out.write('two')
+    with open(index, 'a') as checksums:
+        checksums.write(json.dumps({
+            'path': 'checksums_test.txt',
+            'sha256': hashlib.sha256(b'two').hexdigest(),
+            'size': 3, 'time': ''}) + '\n')
+    save_output(path, env.results_path, 'one')
+    with open(path, 'r') as out:
+        assert out.read() == 'one'
+    for num in range(10):
+        save_output(path, env.results_path, str(num))
+    with open(index, 'r') as checksums:
+        lines = len(checksums.readlines())
+    assert lines < 2 * len(read_checksums(env.results_path))
+
+
+def test_batch_process_resume():
+    cmgs_done = batch_process(cmgs_from_file(env, PARAMS_JSON), env)
+    journal = read_journal(env)
+    assert all(is_complete(cmg, journal[cmg.cmg_id]) for cmg in cmgs_done)
+    cmgs_resumed = batch_process(cmgs_from_file(env, PARAMS_JSON), env,
+                                 resume=True)
+    assert all(cmg.query is None for cmg in cmgs_resumed)
+    for old, new in zip(cmgs_done, cmgs_resumed):
+        assert new.info['count'] == old.info['count']
+        assert len(new.compounds) == len(old.compounds)
+    changed = CMGroup(env, dict(cmgs_done[0].params, name='Changed'))
+    assert not is_complete(changed, journal[changed.cmg_id])
+    child = CMGroup(env, cmgs_done[1].params)
+    child.set_detected_parent(cmgs_done[0].cmg_id)
+    assert is_complete(child, journal[child.cmg_id], set())
+    assert not is_complete(child, journal[child.cmg_id],
+                           {cmgs_done[0].cmg_id})
+
+
+def test_diff_runs():
+    assert merge_diff(['a', 'c', 'd'], ['b', 'c']) == (['b'], ['a', 'd'], 3, 2)
+    assert merge_diff(['a', 'c', 'c'], ['a', 'a', 'c']) == ([], [], 2, 2)
+    cmgs_done = batch_process(cmgs_from_file(env, PARAMS_JSON), env)
+    cmg = cmgs_done[0]
+    assert exists(pjoin(env.results_path, 'members',
+                        '{}.txt'.format(cmg.cmg_id)))
+    summary = {row['cmg_id']: row
+               for row in diff_runs(env.results_path, env.results_path)}
+    assert all(row['status'] == 'same' for row in summary.values())
+    for cmg in cmgs_done:
+        assert summary[cmg.cmg_id]['after'] == \
+            cmg.compounds['dtxsid'].nunique()
+    # A compound in two rows of the compounds view (one per CASRN) is listed
+    # once, so that gaining a row does not show as an added compound.
+    cmg = cmgs_done[0]
+    before = list(read_members(pjoin(env.results_path, 'members',
+                                     '{}.txt'.format(cmg.cmg_id))))
+    dup = cmg.compounds.iloc[:1]
+    key = dup['dtxsid'].iloc[0]
+    copy = CMGroup(env, dict(cmg.params))
+    # pylint: disable=protected-access
+    copy._compounds = concat([cmg.compounds, dup.assign(casrn='0-00-0')])
+    path = pjoin(env.results_path, 'members_duplicated.txt')
+    copy.to_members(path)
+    assert merge_diff(before, read_members(path))[:2] == ([], [])
+    with open(path, 'r') as members_file:
+        lines = [line.rstrip('\n').split('\t') for line in members_file
+                 if line.startswith(key + '\t')]
+    assert len(lines) == 1
+    assert '0-00-0' in lines[0][1].split(';')
+
+
+def test_overlap():
+    _, bitsets = encode_bitsets([['a', 'b', 'c'], ['b', 'c'], ['d']])
+    assert overlap_matrix(bitsets, workers=1).tolist() == \
+        [[3, 2, 0], [2, 2, 0], [0, 0, 1]]
+    batch_process(cmgs_from_file(env, PARAMS_JSON), env)
+    pairs = analyze_overlap(env.results_path, workers=2)
+    assert all(0 < pair['jaccard'] <= 1 for pair in pairs)
+    assert exists(pjoin(env.results_path, 'overlap.csv'))
+    assert exists(pjoin(env.results_path, 'html', 'overlap.html'))
+
+
+def test_query_service():
+    service = QueryService(env)
+    params = LOCAL_PARAMS[0]['params']
+    count = service.count(params)
+    assert count == QueryMethod(params).count(env.database)
+    assert len(service.populate(params)) == count
+    assert service.populate(params) is service.populate(dict(params))
+    assert not service._key_locks  # pylint: disable=protected-access
+    with pytest.raises(ValueError):
+        create_server(env, host='0.0.0.0', port=0)
+    cmgs_done = batch_process(cmgs_from_file(env, PARAMS_JSON), env)
+    service.load_memberships()
+    for cmg in cmgs_done:
+        for key in cmg.compounds['dtxsid']:
+            assert cmg.cmg_id in service.memberships(key)
+
+
+def test_inverted_index():
+    cmgs_done = batch_process(cmgs_from_file(env, PARAMS_JSON), env)
+    index = InvertedIndex(env.results_path)
+    for cmg in cmgs_done:
+        keys = list(cmg.compounds['dtxsid'])
+        assert all(cmg.cmg_id in groups for groups in index.lookup(keys))
+        keys = [alias_text(key) for key in cmg.compounds['casrn']
+                if alias_text(key)]
+        assert all(cmg.cmg_id in groups for groups in index.lookup(keys))
+    assert index.lookup(['no such compound']) == [[]]
+    cmg = cmgs_done[0]
+    with open(pjoin(env.results_path, 'members',
+                    '{}.txt'.format(cmg.cmg_id)), 'w') as members_file:
+        members_file.write('')
+    index = build_index(env.results_path, [cmg.cmg_id])
+    keys = list(cmg.compounds['dtxsid'])
+    assert all(cmg.cmg_id not in groups for groups in index.lookup(keys))
+    assert index.groups == build_index(env.results_path).groups
+    # Members files of groups that are not part of the run are not indexed.
+    stale = pjoin(env.results_path, 'members', 'x999999.txt')
+    with open(stale, 'w') as members_file:
+        members_file.write('{}\t\t\n'.format(keys[0]))
+    assert 'x999999' not in build_index(env.results_path).groups
+    os.remove(stale)
+
+
+def test_inverted_index_members():
+    path = pjoin(env.data_path, 'index_test')
+    mkdir_p(pjoin(path, 'members'))
+    members = {'g1': 'A\t1-1-1\t7\nA\t1-1-1\t7\nB\t\t\n',
+               'g2': 'A\t\t\nC\t1-1-1;2-2-2\t\n'}
+    for cmg_id, text in members.items():
+        with open(pjoin(path, 'members', '{}.txt'.format(cmg_id)),
+                  'w') as members_file:
+            members_file.write(text)
+    index = build_index(path)
+    # Repeated rows are indexed once, and an alias shared by two compounds
+    # finds the groups of both.
+    assert index.lookup(['A', '7', '1-1-1', '2-2-2', 'B']) == \
+        [['g1', 'g2'], ['g1', 'g2'], ['g1', 'g2'], ['g2'], ['g1']]
+    index = build_index(path, ['g1'], groups=['g1'])
+    assert index.groups == ['g1']
+    assert index.lookup(['A', '2-2-2']) == [['g1'], []]
+
+
+def test_work_queue():
+    url = 'sqlite:///{}'.format(pjoin(env.data_path, 'queue.db'))
+    queue = WorkQueue(url, env.name, lease=0)
+    cmgs = list(cmgs_from_file(env, PARAMS_JSON))
+    assert queue.enqueue(cmgs) == len(cmgs)
+    first = queue.claim('worker-a')
+    assert first['params']['cmg_id'] == cmgs[0].cmg_id
+    # With no lease time, the claim expires at once and can be taken over.
+    again = queue.claim('worker-b')
+    assert again['params']['cmg_id'] == cmgs[0].cmg_id
+    assert not queue.renew(cmgs[0].cmg_id, 'worker-a')
+    queue = WorkQueue(url, env.name)
+    queue.enqueue(cmgs)
+    assert run_worker(env, queue, 'worker-c') == len(cmgs)
+    assert queue.claim('worker-c') is None
+    assert queue.status()['done'] == len(cmgs)
+    collect_from_queue(env, queue)
+    assert exists(pjoin(env.results_path, 'html', 'index.html'))
+
+
+def test_batch_process_bounded():
+    cmg_gen = cmgs_from_file(env, PARAMS_JSON)
+    cmgs_done = batch_process(cmg_gen, env, memory_limit=0)
+    for cmg in cmgs_done:
+        assert cmg.memory_usage() == 0
+        assert isinstance(cmg.compounds, DataFrame)
@@ -0,0 +1,428 @@
+# coding: utf-8
+
+"""
+Shared work queue for processing compound groups on multiple nodes.
+
+A coordinator enqueues group definitions in a database table; any number of
+worker processes, on any machine that can reach the database and the shared
+commongroups home directory, claim groups one at a time, process them, and
+write results to the common project environment. Each claim is a lease that
+the worker renews while it is working. If a worker crashes, its lease expires
+and the group is claimed again by another worker.
+
+Leases are based on the clocks of the worker machines, which should be kept
+synchronized (e.g. using NTP).
+"""
+
+from contextlib import contextmanager
+import json
+import logging
+import os
+import socket
+import threading
+import time
+
+from sqlalchemy import (and_, create_engine, or_, Column, Float, Integer,
+                        MetaData, String, Table, Text)
+
+from commongroups.cmgroup import CMGroup
+from commongroups.errors import MissingParamError
+from commongroups.hypertext import directory
+from commongroups.invindex import build_index
+from commongroups import metrics
+from commongroups.ops import collect_to_json, log_group
+from commongroups.snapshot import current_snapshot
+from commongroups import logconf  # pylint: disable=unused-import
+logger = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+QUEUE_TABLE = 'cmg_queue'
+LEASE_SECONDS = 600
+POLL_SECONDS = 10
+
+PENDING = 'pending'
+CLAIMED = 'claimed'
+DONE = 'done'
+FAILED = 'failed'
+
+
+def worker_name():
+    """Return an identifier for this worker process: ``host:pid``."""
+    return '{0}:{1}'.format(socket.gethostname(), os.getpid())
+
+
+class WorkQueue(object):
+    """
+    Queue of compound group definitions, stored in a database table.
+
+    The table is created if it does not exist. Several projects can share the
+    same table; each queue only handles the groups of one project.
+
+    Parameters:
+        url (str): Database URL, e.g. of the compounds database, or of a
+            SQLite database on shared storage.
+        project (str): Project name, identifying the queue.
+        lease (float): Time, in seconds, for which a claimed group is reserved
+            for its worker unless the lease is renewed.
+    """
+    def __init__(self, url, project, lease=LEASE_SECONDS):
+        self.project = project
+        self.lease = float(lease)
+        self._engine = create_engine(url)
+        meta = MetaData()
+        self.table = Table(
+            QUEUE_TABLE, meta,
+            Column('project', String(255), primary_key=True),
+            Column('cmg_id', String(255), primary_key=True),
+            Column('position', Integer, nullable=False),
+            Column('definition', Text, nullable=False),
+            Column('state', String(16), nullable=False, index=True),
+            Column('worker', String(255)),
+            Column('lease_expires', Float),
+            Column('attempts', Integer, nullable=False, default=0),
+            Column('result', Text)
+        )
+        meta.create_all(self._engine, checkfirst=True)
+
+    def __repr__(self):
+        return 'WorkQueue({0}, {1})'.format(self._engine.url, self.project)
+
+    def _mine(self, cmg_id):
+        """Clause selecting a group of this queue by ID."""
+        return and_(self.table.c.project == self.project,
+                    self.table.c.cmg_id == cmg_id)
+
+    def _claimable(self, now):
+        """Clause selecting groups that are pending or whose lease expired."""
+        tbl = self.table
+        return or_(tbl.c.state == PENDING,
+                   and_(tbl.c.state == CLAIMED, tbl.c.lease_expires < now))
+
+    def enqueue(self, cmgs):
+        """
+        Replace the contents of the queue with the given compound groups.
+
+        Parameters:
+            cmgs (iterable): :class:`commongroups.cmgroup.CMGroup` objects.
+
+        Returns:
+            Number of groups enqueued.
+        """
+        tbl = self.table
+        num = 0
+        with self._engine.begin() as con:
+            con.execute(tbl.delete().where(tbl.c.project == self.project))
+            for num, cmg in enumerate(cmgs, start=1):
+                con.execute(tbl.insert().values(
+                    project=self.project,
+                    cmg_id=cmg.cmg_id,
+                    position=num,
+                    definition=json.dumps({'params': cmg.params,
+                                           'info': cmg.info,
+                                           'dependencies': cmg.dependencies}),
+                    state=PENDING,
+                    attempts=0
+                ))
+        logger.info('Enqueued %i groups in %s', num, self)
+        return num
+
+    def claim(self, worker):
+        """
+        Claim the next available group for a worker.
+
+        Candidates are pending groups and groups whose lease has expired, in
+        the order in which they were enqueued, if all the groups they depend on
+        are done. A claim only succeeds if no other worker has claimed the same
+        group in the meantime.
+
+        Parameters:
+            worker (str): Worker identifier.
+
+        Returns:
+            Dict of parameters, info, and dependencies of the claimed group, or
+            ``None`` if no group is available.
+        """
+        tbl = self.table
+        while True:
+            now = time.time()
+            cands = self._engine.execute(
+                tbl.select()
+                .where(and_(tbl.c.project == self.project,
+                            self._claimable(now)))
+                .order_by(tbl.c.position)
+            ).fetchall()
+            done = None
+            for cand in cands:
+                item = json.loads(cand['definition'])
+                if item.get('dependencies'):
+                    if done is None:
+                        done = set(self.done_ids())
+                    if not done.issuperset(item['dependencies']):
+                        continue
+                res = self._engine.execute(
+                    tbl.update()
+                    .where(and_(self._mine(cand['cmg_id']),
+                                self._claimable(now)))
+                    .values(state=CLAIMED, worker=worker,
+                            lease_expires=now + self.lease,
+                            attempts=tbl.c.attempts + 1)
+                )
+                if res.rowcount == 1:
+                    if cand['state'] == CLAIMED:
+                        logger.warning('Reclaimed %s from %s (expired lease)',
+                                       cand['cmg_id'], cand['worker'])
+                    logger.info('%s claimed %s', worker, cand['cmg_id'])
+                    return item
+                break
+            else:
+                return None
+
+    def renew(self, cmg_id, worker):
+        """
+        Extend the lease on a claimed group.
+
+        Returns:
+            Whether the worker still holds the lease.
+        """
+        tbl = self.table
+        res = self._engine.execute(
+            tbl.update()
+            .where(and_(self._mine(cmg_id), tbl.c.worker == worker,
+                        tbl.c.state == CLAIMED))
+            .values(lease_expires=time.time() + self.lease)
+        )
+        return res.rowcount == 1
+
+    def complete(self, cmg_id, worker, record):
+        """
+        Mark a claimed group as done and store its parameters and info.
+
+        Parameters:
+            cmg_id (str): ID of the group.
+            worker (str): Worker identifier.
+            record (dict): Parameters and info of the processed group.
+        """
+        self._finish(cmg_id, worker, DONE, record)
+
+    def fail(self, cmg_id, worker, message):
+        """Mark a claimed group as failed, with an error message."""
+        self._finish(cmg_id, worker, FAILED, {'error': message})
+
+    def _finish(self, cmg_id, worker, state, record):
+        tbl = self.table
+        res = self._engine.execute(
+            tbl.update()
+            .where(and_(self._mine(cmg_id), tbl.c.worker == worker))
+            .values(state=state, lease_expires=None,
+                    result=json.dumps(record, sort_keys=True))
+        )
+        if res.rowcount != 1:
+            logger.warning('%s no longer held the lease on %s',
+                           worker, cmg_id)
+
+    def status(self):
+        """Return the number of groups in each state, as a dict."""
+        tbl = self.table
+        rows = self._engine.execute(
+            tbl.select().with_only_columns([tbl.c.state])
+            .where(tbl.c.project == self.project)
+        ).fetchall()
+        ret = {PENDING: 0, CLAIMED: 0, DONE: 0, FAILED: 0}
+        for row in rows:
+            ret[row['state']] += 1
+        return ret
+
+    def done_ids(self):
+        """Return the IDs of the completed groups."""
+        tbl = self.table
+        rows = self._engine.execute(
+            tbl.select().with_only_columns([tbl.c.cmg_id])
+            .where(and_(tbl.c.project == self.project, tbl.c.state == DONE))
+        ).fetchall()
+        return [row['cmg_id'] for row in rows]
+
+    def results(self):
+        """
+        Generate the parameters and info of completed groups, in queue order.
+
+        Yields:
+            Dicts of parameters and info, one for each group.
+        """
+        tbl = self.table
+        res = self._engine.execute(
+            tbl.select()
+            .where(and_(tbl.c.project == self.project, tbl.c.state == DONE))
+            .order_by(tbl.c.position)
+        )
+        for row in res:
+            yield json.loads(row['result'])
+
+
+@contextmanager
+def leased(queue, cmg_id, worker):
+    """
+    Keep renewing the lease on a group while the context is active.
+
+    The lease is renewed in a background thread, at a third of the lease time.
+    """
+    stop = threading.Event()
+    interval = max(queue.lease / 3, 1)
+
+    def renew():
+        while not stop.wait(interval):
+            if not queue.renew(cmg_id, worker):
+                logger.warning('%s lost the lease on %s', worker, cmg_id)
+                return
+
+    thread = threading.Thread(target=renew, daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        thread.join()
+
+
+def queue_from_env(env):
+    """
+    Create the work queue for a project environment.
+
+    Uses the ``queue_url`` option, or else the (first) ``database_url``, and
+    the ``queue_lease`` option (in seconds), if given.
+    """
+    url = env.config.get('queue_url') or env.config.get('database_url')
+    if not url:
+        raise MissingParamError('queue_url')
+    if isinstance(url, list):
+        url = url[0]
+    lease = env.config.get('queue_lease', LEASE_SECONDS)
+    return WorkQueue(url, env.name, lease=lease)
+
+
+def restore_groups(env, queue, cmg_ids):
+    """
+    Restore completed groups from the work queue and their output files.
+
+    Returns:
+        Dict of restored :class:`commongroups.cmgroup.CMGroup` objects, keyed
+        by ``cmg_id``, whose compounds are reloaded on demand.
+    """
+    deps = {}
+    if not cmg_ids:
+        return deps
+    for record in queue.results():
+        if record['params']['cmg_id'] in cmg_ids:
+            cmg = CMGroup(env, record['params'])
+            cmg.restore(record.get('info', {}))
+            deps[cmg.cmg_id] = cmg
+    return deps
+
+
+def run_worker(env, queue, worker=None):
+    """
+    Process compound groups from the work queue until none are left.
+
+    Each group is processed using the environment's database connection, and
+    its results are written to the environment's ``results`` directory, as in
+    :func:`commongroups.ops.batch_process`. Groups that raise errors are marked
+    as failed, and the worker moves on.
+
+    Groups that depend on other groups (see :attr:`CMGroup.dependencies`) are
+    only claimed once those are done; their results are then reloaded from the
+    output of whichever worker processed them. While the only remaining groups
+    wait for groups being processed by other workers, the worker polls the
+    queue every :data:`POLL_SECONDS`.
+
+    If ``snapshot`` is set in the environment's configuration, a snapshot of
+    compounds is used as in :func:`commongroups.ops.batch_process`, if it
+    matches the database build. Workers do not export snapshots themselves;
+    export one before starting them (see :mod:`commongroups.snapshot`).
+
+    The groups completed by this worker, and the time and memory taken by
+    each stage, are reported as metrics while it runs (see
+    :func:`commongroups.metrics.reporter_from_env`).
+
+    Parameters:
+        env (:class:`commongroups.env.CommonEnv`): Environment.
+        queue (:class:`WorkQueue`): Work queue.
+        worker (str): Optional worker identifier; see :func:`worker_name`.
+
+    Returns:
+        Number of groups completed by this worker.
+    """
+    worker = worker or worker_name()
+    with metrics.reporter_from_env(env):
+        if not env.database:
+            env.connect_database()
+        optimize = env.config.get('optimize_queries', False)
+        snapshot = None
+        if env.config.get('snapshot'):
+            snapshot = current_snapshot(env)
+        num = 0
+        while True:
+            item = queue.claim(worker)
+            if item is None:
+                status = queue.status()
+                if status[PENDING] and status[CLAIMED]:
+                    time.sleep(POLL_SECONDS)
+                    continue
+                if status[PENDING]:
+                    logger.warning('%i groups have unresolved dependencies',
+                                   status[PENDING])
+                break
+            cmg = CMGroup(env, item['params'], item.get('info'))
+            with leased(queue, cmg.cmg_id, worker):
+                started = time.perf_counter()
+                try:
+                    deps = restore_groups(env, queue, cmg.dependencies)
+                    with metrics.stage('query'):
+                        cmg.process(env.database, deps=deps, optimize=optimize,
+                                    snapshot=snapshot)
+                    queried = time.perf_counter()
+                    with metrics.stage('output'):
+                        cmg.to_excel()
+                        cmg.to_json()
+                        cmg.to_members()
+                        cmg.to_html(formats=['xlsx', 'json'])
+                except Exception as exc:  # pylint: disable=broad-except
+                    logger.exception('Failed to process %s', cmg)
+                    queue.fail(cmg.cmg_id, worker, repr(exc))
+                    log_group(cmg, 'failed',
+                              {'total': time.perf_counter() - started},
+                              worker=worker, error=repr(exc))
+                    metrics.GROUPS.inc(status='failed')
+                    continue
+            queue.complete(cmg.cmg_id, worker, cmg.to_dict())
+            log_group(cmg, 'processed',
+                      {'query': queried - started,
+                       'output': time.perf_counter() - queried},
+                      worker=worker)
+            metrics.GROUPS.inc(status='processed')
+            num += 1
+        logger.info('%s finished after completing %i groups', worker, num)
+    return num
+
+
+def collect_from_queue(env, queue):
+    """
+    Build the aggregate outputs of a distributed run from the work queue.
+
+    Writes ``cmgroups.json`` and the HTML directory (``html/index.html``) in
+    the environment's ``results`` directory, for all completed groups, and
+    builds the inverted index of compounds to groups (see
+    :func:`commongroups.invindex.build_index`).
+
+    Parameters:
+        env (:class:`commongroups.env.CommonEnv`): Project environment.
+        queue (:class:`WorkQueue`): Work queue.
+    """
+    status = queue.status()
+    if status[PENDING] or status[CLAIMED]:
+        logger.warning('Collecting results while groups are unfinished: %s',
+                       status)
+    if status[FAILED]:
+        logger.warning('%i groups failed and are not included',
+                       status[FAILED])
+    collect_to_json(queue.results(), env)
+    directory(queue.results(), env)
+    build_index(env.results_path, groups=[rec['params']['cmg_id']
+                                          for rec in queue.results()])
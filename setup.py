@@ -32,7 +32,9 @@ setup(
         'ashes',
         'boltons',
         'gspread',
+        'numpy',
         'oauth2client',
+        'openpyxl',
         'pandas',
         'psycopg2',
         'sqlalchemy',
@@ -42,7 +44,11 @@ setup(
     setup_requires=['pytest-runner'],
     tests_require=['pytest'],
     entry_points={
-        'console_scripts': ['commongroups=commongroups.run:main']
+        'console_scripts': ['commongroups=commongroups.run:main',
+                            'commongroups-diff=commongroups.diff:main',
+                            'commongroups-overlap=commongroups.overlap:main',
+                            'commongroups-index=commongroups.invindex:main',
+                            'commongroups-snapshot=commongroups.snapshot:main']
     },
     include_package_data=True,
     package_data={
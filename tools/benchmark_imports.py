@@ -0,0 +1,98 @@
+# coding: utf-8
+
+"""
+Import-time benchmark for Common Groups.
+
+This script measures how long it takes to start up Common Groups for a few
+common operations, each in a fresh Python process, and which of the heavy
+third-party libraries (see ``HEAVY_MODULES``) each of them loads. It exits
+with an error if an operation loads a library that it should not need (see
+``SCENARIOS``), or if printing the version takes longer than the target.
+
+Requirements:
+-   Common Groups and its Python dependencies.
+"""
+
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+
+HEAVY_MODULES = ['ashes', 'gspread', 'numpy', 'oauth2client', 'pandas',
+                 'pkg_resources', 'rdkit', 'sqlalchemy']
+
+# Code run for each operation, and the heavy modules it may load.
+SCENARIOS = [
+    ('run --version',
+     "sys.argv = ['commongroups', '--version']\n"
+     "import commongroups.run\n"
+     "commongroups.run.main()",
+     []),
+    ('import ops (groups from file)',
+     'import commongroups.ops',
+     ['numpy', 'pandas', 'sqlalchemy']),
+    ('import hypertext',
+     'import commongroups.hypertext',
+     []),
+    ('import googlesheet',
+     'import commongroups.googlesheet',
+     ['numpy', 'pandas', 'sqlalchemy']),
+    ('import service',
+     'import commongroups.service',
+     ['numpy', 'pandas', 'sqlalchemy']),
+]
+
+PROBE = """
+import io, json, sys, time
+start = time.perf_counter()
+stdout, sys.stdout = sys.stdout, io.StringIO()
+{code}
+elapsed = time.perf_counter() - start
+sys.stdout = stdout
+print(json.dumps({{'seconds': elapsed,
+                   'loaded': [m for m in {heavy!r} if m in sys.modules]}}))
+"""
+
+
+def measure(code):
+    """Run code in a new Python process; return its time and heavy imports."""
+    probe = PROBE.format(code=code, heavy=HEAVY_MODULES)
+    out = subprocess.run([sys.executable, '-c', probe], check=True,
+                         stdout=subprocess.PIPE, universal_newlines=True)
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+def create_parser():
+    """Create command-line argument parser."""
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument('-n', '--repeat', type=int, default=5,
+                        help='number of runs of each operation')
+    parser.add_argument('--target', type=float, default=100,
+                        help='target time for printing the version (ms)')
+    return parser
+
+
+def main():
+    """Measure the import time of Common Groups operations."""
+    args = create_parser().parse_args()
+    failed = False
+    for name, code, allowed in SCENARIOS:
+        runs = [measure(code) for _ in range(args.repeat)]
+        median = statistics.median(run['seconds'] for run in runs) * 1000
+        loaded = runs[0]['loaded']
+        print('{0:32} {1:8.1f} ms   {2}'.format(name, median,
+                                                ', '.join(loaded) or '-'))
+        unexpected = sorted(set(loaded) - set(allowed))
+        if unexpected:
+            print('==> Unexpected imports: {}'.format(', '.join(unexpected)))
+            failed = True
+        if name == 'run --version' and median > args.target:
+            print('==> Exceeds target of {} ms'.format(args.target))
+            failed = True
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -10,6 +10,22 @@ Set up the database so that it can be used for substructure searching via the
 RDKit PostgreSQL database `extension`_. Also include CASRNs and PubChem CIDs as
 much as possible.
 
+Simple descriptors of each compound's composition (the set of elements, the
+molecular formula, and numbers of heavy atoms and carbon atoms) are computed
+while the database is built, and indexed, so that groups defined by their
+elements can be queried without substructure searching. The same goes for a
+few structural flags that are commonly used in group definitions (see
+``FLAG_PATTERNS``). Morgan fingerprints are also generated and indexed for
+similarity searching. Finally, each compound's Murcko scaffold is computed,
+and the distinct scaffolds are collected in a table indexed for substructure
+searching, so that groups of compounds sharing a core structure can be found
+by searching scaffolds rather than all compounds.
+
+Each build of the database is recorded with a unique ID in the ``build_info``
+table, so that snapshots of compound data exported from the database (see
+``commongroups.snapshot``) can be checked against it. To record a build of an
+existing database, e.g. after modifying it, run with ``--stamp``.
+
 Requirements:
 -   A running instance of PostgreSQL and an empty initialized database with
     the RDKit extension activated. See Common Groups installation instructions.
@@ -25,15 +41,74 @@ import argparse
 import os
 from os.path import join as pjoin
 import sys
+import uuid
 
 import pandas as pd
 
 from rdkit import Chem
 
+from rdkit.Chem import rdMolDescriptors
+from rdkit.Chem.Scaffolds import MurckoScaffold
 from sqlalchemy import create_engine, text, types
+from sqlalchemy.dialects.postgresql import ARRAY
 from sqlalchemy.exc import ArgumentError
 
 
+# Substructures that are precomputed as boolean columns, matched exactly as the
+# RDKit extension would match these SMARTS patterns. Keep in sync with
+# commongroups.query.FLAG_COLUMNS.
+FLAG_PATTERNS = {
+    'cc_bond': '[C,c]~[C,c]',
+    'ch_bond': '[C!H0,c!H0]'
+}
+FLAG_QUERIES = {k: Chem.MolFromSmarts(v) for (k, v) in FLAG_PATTERNS.items()}
+
+
+def composition(mol):
+    """
+    Compute composition descriptors of a molecule.
+
+    Returns:
+        A :class:`pandas.Series` containing the sorted list of element symbols
+        (including ``H`` if the molecule has any hydrogens), the molecular
+        formula, the numbers of heavy atoms and carbon atoms, and whether the
+        molecule contains each of the ``FLAG_PATTERNS``.
+    """
+    symbols = set()
+    carbons = 0
+    hydrogens = 0
+    for atom in mol.GetAtoms():
+        symbols.add(atom.GetSymbol())
+        hydrogens += atom.GetTotalNumHs()
+        if atom.GetAtomicNum() == 6:
+            carbons += 1
+    if hydrogens:
+        symbols.add('H')
+    ret = {'elements': sorted(symbols),
+           'formula': rdMolDescriptors.CalcMolFormula(mol),
+           'heavy_atoms': mol.GetNumHeavyAtoms(),
+           'carbon_atoms': carbons}
+    for key, query in FLAG_QUERIES.items():
+        ret[key] = mol.HasSubstructMatch(query)
+    return pd.Series(ret)
+
+
+def scaffolds(mol):
+    """
+    Compute the Murcko scaffold of a molecule.
+
+    Returns:
+        A :class:`pandas.Series` containing canonical SMILES for the scaffold
+        (ring systems and linkers); an empty string for acyclic molecules or
+        if it cannot be computed.
+    """
+    try:
+        scaffold = Chem.MolToSmiles(MurckoScaffold.GetScaffoldForMol(mol))
+    except (ValueError, RuntimeError):
+        scaffold = ''
+    return pd.Series({'scaffold': scaffold})
+
+
 def construct_db(con, data_path):
     """
     Construct database using US EPA chemical datasets and the RDKit extension.
@@ -49,7 +124,14 @@ def construct_db(con, data_path):
             dtxsid text PRIMARY KEY,
             inchi text NOT NULL,
             inchikey text NOT NULL,
-            bin bytea NOT NULL
+            bin bytea NOT NULL,
+            elements text[] NOT NULL,
+            formula text NOT NULL,
+            heavy_atoms integer NOT NULL,
+            carbon_atoms integer NOT NULL,
+            cc_bond boolean NOT NULL,
+            ch_bond boolean NOT NULL,
+            scaffold text NOT NULL
         );
 
         CREATE TABLE dtx_casrn (
@@ -86,12 +168,21 @@ def construct_db(con, data_path):
     #   very specific errors. The number of molecules we have in the end will
     #   probably be less than 720K.
     # - This will take a while and consume a lot of CPU and memory resources.
+    # - Composition descriptors are computed from the same `Mol` objects, so
+    #   they are consistent with the molecules in the database.
 
     print('==> Generating molecular structures from InChI strings...')
     dtypes = {'dtxsid': types.Text,
               'inchi': types.Text,
               'inchikey': types.Text,
-              'bin': types.Binary}
+              'bin': types.Binary,
+              'elements': ARRAY(types.Text),
+              'formula': types.Text,
+              'heavy_atoms': types.Integer,
+              'carbon_atoms': types.Integer,
+              'cc_bond': types.Boolean,
+              'ch_bond': types.Boolean,
+              'scaffold': types.Text}
 
     ninput = 719996
     ncreated = 0
@@ -109,6 +200,8 @@ def construct_db(con, data_path):
         ncreated += num
         print('==> {0} molecules created, {1} errors'.format(num, chunk - num))
         frame['bin'] = frame.mol.apply(lambda m: m.ToBinary())
+        frame = frame.join(frame.mol.apply(composition))
+        frame = frame.join(frame.mol.apply(scaffolds))
         frame.drop('mol', axis=1, inplace=True)
         frame.to_sql('dsstox',
                      con,
@@ -134,6 +227,37 @@ def construct_db(con, data_path):
         """
     ))
 
+    # Generate fingerprints for similarity searching
+    print('==> Generating molecular fingerprints.')
+    con.execute(text(
+        """
+        ALTER TABLE dsstox ADD COLUMN mfp2 bfp;
+
+        UPDATE dsstox SET mfp2 = morganbv_fp(molecule);
+        """
+    ))
+
+    # Collect distinct scaffolds in a separate, structure-searchable table
+    print('==> Creating table of scaffolds.')
+    con.execute(text(
+        """
+        CREATE TABLE scaffolds AS
+            SELECT DISTINCT scaffold FROM dsstox WHERE scaffold <> '';
+
+        ALTER TABLE scaffolds ADD PRIMARY KEY (scaffold);
+
+        ALTER TABLE scaffolds ADD COLUMN molecule mol;
+
+        UPDATE scaffolds SET molecule = mol_from_smiles(scaffold::cstring);
+
+        DELETE FROM scaffolds WHERE molecule IS NULL;
+
+        CREATE INDEX scaffoldmolidx ON scaffolds USING gist(molecule);
+        """
+    ))
+    nrows = con.execute(text('select count(*) from scaffolds;')).scalar()
+    print('==> {} distinct scaffolds'.format(nrows))
+
     nmols = con.execute(text('select count(molecule) from dsstox;')).scalar()
 
     # Check results. The AssertionError should not happen.
@@ -211,6 +335,14 @@ def construct_db(con, data_path):
             dsstox.inchi,
             dsstox.inchikey,
             dsstox.molecule,
+            dsstox.elements,
+            dsstox.formula,
+            dsstox.heavy_atoms,
+            dsstox.carbon_atoms,
+            dsstox.cc_bond,
+            dsstox.ch_bond,
+            dsstox.mfp2,
+            dsstox.scaffold,
             dtx_cid.cid,
             dtx_casrn.casrn,
             dtx_casrn.name
@@ -228,11 +360,51 @@ def construct_db(con, data_path):
         'SELECT COUNT(*) FROM compounds where casrn is null;')).scalar()
     print('  --> {} rows without CASRN'.format(casrn_null))
 
-    # Create the index
+    # Create the indexes
     print('==> Creating index...')
     cmd = text('CREATE INDEX molidx ON compounds USING gist(molecule);')
     res = con.execute(cmd)
 
+    print('==> Creating indexes of composition descriptors...')
+    con.execute(text(
+        """
+        CREATE INDEX elemidx ON compounds USING gin(elements);
+        CREATE INDEX formulaidx ON compounds (formula);
+        CREATE INDEX heavyidx ON compounds (heavy_atoms);
+        CREATE INDEX carbonidx ON compounds (carbon_atoms);
+        CREATE INDEX ccidx ON compounds (cc_bond);
+        CREATE INDEX chidx ON compounds (ch_bond);
+        CREATE INDEX dtxsididx ON compounds (dtxsid);
+        CREATE INDEX scaffoldidx ON compounds (scaffold);
+        """
+    ))
+
+    print('==> Creating index of fingerprints...')
+    con.execute(text('CREATE INDEX fpidx ON compounds USING gist(mfp2);'))
+
+    record_build(con)
+
+
+def record_build(con):
+    """Record a new build of the database in the ``build_info`` table."""
+    con.execute(text(
+        """
+        CREATE TABLE IF NOT EXISTS build_info (
+            build_id text PRIMARY KEY,
+            created timestamp NOT NULL DEFAULT now(),
+            compounds integer
+        );
+        """
+    ))
+    build_id = uuid.uuid4().hex
+    con.execute(text(
+        """
+        INSERT INTO build_info (build_id, compounds)
+        SELECT :build_id, count(*) FROM compounds;
+        """
+    ), build_id=build_id)
+    print('==> Recorded database build {}'.format(build_id))
+
 
 def create_parser():
     parser = argparse.ArgumentParser(description=main.__doc__)
@@ -242,8 +414,10 @@ def create_parser():
                         required=True)
     parser.add_argument('-d',
                         '--data_path',
-                        help='path to data sources',
-                        required=True)
+                        help='path to data sources')
+    parser.add_argument('--stamp',
+                        action='store_true',
+                        help='only record a new build of an existing database')
     return parser
 
 
@@ -252,6 +426,12 @@ def main():
     parser = create_parser()
     args = parser.parse_args()
 
+    if args.stamp:
+        record_build(create_engine(args.db_url))
+        return
+    if not args.data_path:
+        parser.error('the following arguments are required: -d/--data_path')
+
     try:
         con = create_engine(args.db_url)
         data_path = os.path.abspath(args.data_path)
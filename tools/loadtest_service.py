@@ -0,0 +1,155 @@
+# coding: utf-8
+
+"""
+Load test for the Common Groups query service.
+
+This script sets up a stand-in compounds database (SQLite) with synthetic
+compounds, and member lists for a number of groups, in a temporary
+commongroups home directory. It then starts the query service (see
+``commongroups.service``) and sends it a mix of concurrent requests: counting
+and populating groups defined by SQL conditions on compound names, and looking
+up the group memberships of compounds. It reports the latency of requests and
+the throughput, and exits with an error if the median latency exceeds the
+target.
+
+The stand-in database cannot perform structure searches, so this measures the
+overhead of the service itself (request handling, connection pool, caches)
+rather than the speed of the RDKit database extension.
+
+Requirements:
+-   Common Groups and its Python dependencies.
+"""
+
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+from os.path import join as pjoin
+import random
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from urllib.request import Request, urlopen
+
+from commongroups.env import CommonEnv
+from commongroups.service import create_server
+
+COLUMNS = ['dtxsid', 'inchi', 'inchikey', 'molecule', 'cid', 'casrn', 'name']
+WORDS = ['acid', 'chloro', 'methyl', 'ethyl', 'benzo', 'nitro', 'amine',
+         'phenol', 'sulfon', 'fluoro', 'bromo', 'oxide']
+
+
+def create_standin_db(path, num_compounds):
+    """Create a SQLite database with a table of synthetic compounds."""
+    con = sqlite3.connect(path)
+    con.execute('CREATE TABLE compounds ({})'.format(', '.join(COLUMNS)))
+    rows = []
+    for i in range(num_compounds):
+        name = '-'.join(random.sample(WORDS, 3))
+        rows.append(('DTXSID{:07d}'.format(i), 'InChI=1S/X', 'KEY{}'.format(i),
+                     'C', i, '{}-00-0'.format(i), name))
+    con.executemany('INSERT INTO compounds VALUES (?, ?, ?, ?, ?, ?, ?)',
+                    rows)
+    con.execute('CREATE INDEX dtxsididx ON compounds (dtxsid)')
+    con.commit()
+    con.close()
+
+
+def create_members(env, num_compounds, num_groups):
+    """Write member lists of synthetic groups to the results directory."""
+    members_path = pjoin(env.results_path, 'members')
+    os.makedirs(members_path, exist_ok=True)
+    for group in range(num_groups):
+        size = random.randint(1, num_compounds // 10)
+        ids = sorted('DTXSID{:07d}'.format(i) for i in
+                     random.sample(range(num_compounds), size))
+        with open(pjoin(members_path, 'g{}.txt'.format(group)), 'w') as out:
+            out.write('\n'.join(ids) + '\n')
+
+
+def group_params(word):
+    """Parameters of a group of compounds whose names contain a word."""
+    return {'cmg_id': word, 'name': word, 'method': 'SQL',
+            'structure_type': 'text', 'structure': '%{}%'.format(word),
+            'code': 'compounds.name LIKE :s'}
+
+
+def send(base_url, num_compounds):
+    """Send a random request; return the latency in seconds."""
+    kind = random.choice(['count', 'populate', 'memberships'])
+    if kind == 'memberships':
+        req = Request('{0}/memberships/DTXSID{1:07d}'.format(
+            base_url, random.randrange(num_compounds)))
+    else:
+        body = {'params': group_params(random.choice(WORDS)), 'limit': 10}
+        req = Request('{0}/{1}'.format(base_url, kind),
+                      data=json.dumps(body).encode('utf-8'),
+                      headers={'Content-Type': 'application/json'})
+    start = time.perf_counter()
+    with urlopen(req) as resp:
+        resp.read()
+    return time.perf_counter() - start
+
+
+def percentile(values, pct):
+    """Return a percentile of a sorted list of values."""
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def create_parser():
+    """Create command-line argument parser."""
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument('-n', '--requests', type=int, default=2000,
+                        help='number of requests')
+    parser.add_argument('-c', '--concurrency', type=int, default=8,
+                        help='number of concurrent clients')
+    parser.add_argument('--compounds', type=int, default=20000,
+                        help='number of compounds in stand-in database')
+    parser.add_argument('--groups', type=int, default=200,
+                        help='number of groups with member lists')
+    parser.add_argument('--target', type=float, default=50,
+                        help='target median latency (ms)')
+    return parser
+
+
+def main():
+    """Measure the latency of the Common Groups query service."""
+    args = create_parser().parse_args()
+    home = tempfile.mkdtemp()
+    db_path = pjoin(home, 'standin.db')
+    create_standin_db(db_path, args.compounds)
+    env = CommonEnv('loadtest', env_path=home,
+                    database_url='sqlite:///{}'.format(db_path))
+    create_members(env, args.compounds, args.groups)
+
+    server = create_server(env, port=0)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    base_url = 'http://{0}:{1}'.format(*server.server_address[:2])
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        latencies = sorted(executor.map(lambda _: send(base_url,
+                                                       args.compounds),
+                                        range(args.requests)))
+    elapsed = time.perf_counter() - start
+    server.shutdown()
+    server.server_close()
+
+    p50 = percentile(latencies, 50) * 1000
+    print('{0} requests, {1} concurrent: {2:.0f} requests/s'.format(
+        args.requests, args.concurrency, args.requests / elapsed))
+    print('Latency (ms): p50 {0:.1f}, p90 {1:.1f}, p99 {2:.1f}, '
+          'max {3:.1f}'.format(p50, percentile(latencies, 90) * 1000,
+                               percentile(latencies, 99) * 1000,
+                               latencies[-1] * 1000))
+    if p50 > args.target:
+        print('==> Median latency exceeds target of {} ms'.format(
+            args.target))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()